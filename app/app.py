@@ -4,11 +4,12 @@ import socket
 
 import dash_bootstrap_components as dbc
 from dash import (
+    ClientsideFunction,
     Dash,
     Input,
     Output,
     State,
-    callback,
+    clientside_callback,
     dcc,
     html,
     page_container,
@@ -58,41 +59,20 @@ def serve_layout():
     )
 
 
-@callback(
+# The navbar and breadcrumb are updated in the browser, see assets/app.js
+clientside_callback(
+    ClientsideFunction(namespace="app", function_name="toggleNavbarCollapse"),
     Output("navbar-collapse", "is_open"),
-    [Input("navbar-toggler", "n_clicks")],
-    [State("navbar-collapse", "is_open")],
+    Input("navbar-toggler", "n_clicks"),
+    State("navbar-collapse", "is_open"),
+)
+
+
+clientside_callback(
+    ClientsideFunction(namespace="app", function_name="renderBreadcrumb"),
+    Output("breadcrumb", "children"),
+    Input("url", "pathname"),
 )
-def toggle_navbar_collapse(n, is_open):
-    if n:
-        return not is_open
-    return is_open
-
-
-@callback(Output("breadcrumb", "children"), [Input("url", "pathname")])
-def render_breadcrumb(pathname):
-    if pathname and "/scientific-images/" in pathname and len(pathname) > 28:
-        # break out the parts of the path
-        parts = pathname.split("/")
-        # get first six characters of final path child and make them upper case
-        block = parts[-1][:6].upper()
-        if block[-1] == "-":
-            block = block[:5]
-        oc = parts[-1].split("-")
-        bc = dbc.Breadcrumb(
-            items=[
-                {"label": "Home", "href": "/", "external_link": False},
-                {
-                    "label": f"{block} scientific image sets",
-                    "href": f"/scientific-images-list/{parts[-2]}",
-                    "external_link": False,
-                },
-                {"label": f"{block} scientific image set {oc[-1]}", "active": True},
-            ],
-        )
-        return bc
-    else:
-        pass
 
 
 if __name__ == "__main__":
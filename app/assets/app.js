@@ -0,0 +1,40 @@
+window.dash_clientside = window.dash_clientside || {};
+
+window.dash_clientside.app = {
+    toggleNavbarCollapse: function (n, isOpen) {
+        if (n) {
+            return !isOpen;
+        }
+        return isOpen;
+    },
+
+    renderBreadcrumb: function (pathname) {
+        if (!pathname || !pathname.includes("/scientific-images/") || pathname.length <= 28) {
+            return null;
+        }
+        // break out the parts of the path
+        const parts = pathname.split("/");
+        const last = parts[parts.length - 1];
+        // get first six characters of final path child and make them upper case
+        let block = last.slice(0, 6).toUpperCase();
+        if (block.endsWith("-")) {
+            block = block.slice(0, 5);
+        }
+        const oc = last.split("-");
+        return {
+            namespace: "dash_bootstrap_components",
+            type: "Breadcrumb",
+            props: {
+                items: [
+                    {label: "Home", href: "/", external_link: false},
+                    {
+                        label: `${block} scientific image sets`,
+                        href: `/scientific-images-list/${parts[parts.length - 2]}`,
+                        external_link: false,
+                    },
+                    {label: `${block} scientific image set ${oc[oc.length - 1]}`, active: true},
+                ],
+            },
+        };
+    },
+};
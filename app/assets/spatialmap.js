@@ -0,0 +1,64 @@
+window.dash_clientside = window.dash_clientside || {};
+
+// Visual-only changes to the volumetric map are applied to the figure that is already in
+// the browser, so changing the color scheme or opacity does not rebuild it on the server.
+window.dash_clientside.spatialmap = {
+    store: function (value) {
+        return value;
+    },
+
+    restyleColor: function (value, figure, colorscales) {
+        const scheme = value || "haline";
+        return [scheme, restyle(figure, null, {colorscale: colorscales[scheme]})];
+    },
+
+    restyleCubeOpacity: function (value, figure) {
+        const opacity = value === null || value === undefined ? 0.4 : value;
+        return [value, restyle(figure, "mesh3d", {opacity: opacity})];
+    },
+
+    restylePointOpacity: function (value, figure) {
+        const opacity = value === null || value === undefined ? 0.1 : value;
+        return [value, restyle(figure, "volume", {opacity: opacity})];
+    },
+
+    // The region of interest is null while the sliders cover the whole block, so the
+    // uncropped views keep matching the cached and prerendered figures.
+    storeRoi: function (x, y, z, axes) {
+        const roi = {X: x, Y: y, Z: z};
+        const whole = Object.keys(roi).every(function (axis) {
+            const edges = axes[axis];
+            return (
+                !roi[axis] ||
+                (roi[axis][0] <= edges[0] && roi[axis][1] >= edges[edges.length - 1])
+            );
+        });
+        return whole ? null : roi;
+    },
+
+    // Returns whether to hide the graph and the slice browser
+    showSlices: function (tab) {
+        const slices = tab === "slice-tab";
+        return [slices, !slices];
+    },
+};
+
+// Returns a copy of figure with update applied to every trace of traceType (or to every
+// trace if traceType is null), or no_update if there is nothing to restyle.
+function restyle(figure, traceType, update) {
+    if (!figure || !figure.data || Object.values(update).includes(undefined)) {
+        return window.dash_clientside.no_update;
+    }
+    let changed = false;
+    const data = figure.data.map(function (trace) {
+        if (traceType !== null && trace.type !== traceType) {
+            return trace;
+        }
+        changed = true;
+        return Object.assign({}, trace, update);
+    });
+    if (!changed) {
+        return window.dash_clientside.no_update;
+    }
+    return Object.assign({}, figure, {data: data});
+}
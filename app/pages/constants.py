@@ -5,6 +5,8 @@ FILE_DESTINATION = {
     },
     # "assets/config/volumetric-map"
     "volumetric-map": "/app/assets/config/volumetric-map",
+    # rendered volumetric map figures, shared by the gunicorn workers
+    "figure-cache": "/dev/shm/volumetric-map-figures",
     "obj-files": {
         "summary": "/app/assets/config/obj",
         "volumes": "/app/assets/config/obj/volumes",
@@ -1,8 +1,12 @@
+import functools
 import logging
 from dash import (
+    ClientsideFunction,
     Input,
     Output,
     callback,
+    clientside_callback,
+    ctx,
     dcc,
     html,
     register_page,
@@ -10,13 +14,14 @@ from dash import (
     MATCH,
     no_update,
 )
+from dash.exceptions import MissingCallbackContextException
 import pandas as pd
-import numpy as np
 from pathlib import Path
 from pages.constants import FILE_DESTINATION as FD
-from components import alerts
+from components import alerts, figures, slices, volumetric
+from components.figure_cache import FigureCache, data_version
+from components.volumetric import find_global_value_bounds, make_axes, make_defaults
 import pages.ui as ui
-import math
 
 app_logger = logging.getLogger(__name__)
 gunicorn_logger = logging.getLogger("gunicorn.error")
@@ -38,27 +43,94 @@ register_page(
 )
 
 
-# Initial data retrieval tasks
+# Parsed block files are shared by layout, update_fig and display_output
+data_cache = volumetric.BlockCache(max_entries=64)
+# Built figures are shared by all workers
+figure_cache = FigureCache(FD["figure-cache"])
+
+
+def read_csv(path: str, **kwargs) -> pd.DataFrame:
+    """Reads a csv through the data cache, once for each set of read_csv keyword arguments.
+    The returned DataFrame is shared and must not be modified in place."""
+    return data_cache.get(
+        path,
+        lambda p: pd.read_csv(p, **kwargs),
+        key=(str(path), *sorted(kwargs.items())),
+    )
+
+
+def read_voxels(block: str, name: str) -> volumetric.VolumetricBlock:
+    """Opens a block's voxel table from the file chosen by volumetric.voxel_source.
+    Columns are loaded as they are requested."""
+    dir = f"{FD["volumetric-map"]}/{block}"
+    path = volumetric.voxel_source(dir, name)
+    axes = None
+    if path.endswith(".vti"):
+        axes = make_axes(read_csv(f"{dir}/vol_measurements.csv"))
+    return data_cache.get(path, lambda path: volumetric.open_voxels(path, axes))
+
+
+def read_value_stats(block: str) -> pd.DataFrame | None:
+    """Reads the protein statistics written by the config portal, or returns None for blocks
+    published without them."""
+    try:
+        return read_csv(
+            f"{FD["volumetric-map"]}/{block}/value_stats.csv", index_col="Row Label"
+        )
+    except FileNotFoundError:
+        return None
+
+
+@functools.lru_cache(maxsize=128)
+def render_slices(
+    block: str,
+    version: str,
+    proteins: tuple,
+    layer: int,
+    color: str,
+    value_ranges: tuple,
+    roi: tuple | None,
+) -> tuple[str, ...]:
+    """Draws one layer (counted from 0) of a block for several proteins at once, see
+    slices.render_layer. roi is a region of interest as a tuple of (axis, range) pairs.
+    Images are cached by this worker, and version (see figure_cache.data_version) is only
+    part of the key, so they are redrawn when the block's data changes."""
+    voxels = read_voxels(block, "points_data")
+    vol_measurements = read_csv(f"{FD["volumetric-map"]}/{block}/vol_measurements.csv")
+    images = slices.render_layer(
+        voxels,
+        list(proteins),
+        make_axes(vol_measurements),
+        layer,
+        ui.LUTS[color],
+        value_ranges,
+        roi=dict(roi) if roi else None,
+    )
+    return tuple(images)
 
 
-def make_defaults(ranges_df: pd.DataFrame) -> dict:
-    defaults = {"d_scheme": "haline", "d_layer": "All", "d_category": "All"}
-    d_val = ranges_df.columns[np.nonzero(ranges_df.loc["Default"])].values[0]
-    defaults["d_value"] = d_val
-    return defaults
+# Initial data retrieval tasks
 
 
-def make_axes(df: pd.DataFrame) -> dict:
-    axes = {}
-    axis_labels = ["X", "Y", "Z"]
+def triggered_inputs() -> set:
+    """Returns the ids of the inputs that triggered the running callback. The set is empty
+    outside of a callback, e.g. when a callback function is called directly."""
+    try:
+        return set(ctx.triggered_prop_ids.values())
+    except MissingCallbackContextException:
+        return set()
 
-    for label in axis_labels:
-        axis_min = df.loc[0, f"{label} Min"]
-        axis_max = df.loc[0, f"{label} Max"]
-        axis_step = df.loc[0, f"{label} Size"]
-        axes[label] = [x for x in range(axis_min, axis_max + 1, axis_step)]
 
-    return axes
+def read_block_info(block: str) -> tuple[dict, tuple, dict]:
+    """Returns a block's axes, the range of all its proteins' values and its category
+    labels. Raises FileNotFoundError if the block's files are missing."""
+    dir = f"{FD["volumetric-map"]}/{block}"
+    value_ranges = read_csv(f"{dir}/value_ranges.csv", index_col="Row Label")
+    return (
+        make_axes(read_csv(f"{dir}/vol_measurements.csv")),
+        find_global_value_bounds(value_ranges.iloc[0:2].to_dict()),
+        read_csv(f"{dir}/category_labels.csv").iloc[0].to_dict(),
+    )
 
 
 def make_layers(z_axis: list) -> list:
@@ -72,11 +144,11 @@ def make_layers(z_axis: list) -> list:
 def load_data(block: str) -> tuple[dict, dict, list, list, list, dict]:
     # page info dict, defaults dict, layers, category options, values, axes
     dir = f"{FD["volumetric-map"]}/{block}"
-    meta = pd.read_csv(f"{dir}/meta.csv")
-    value_ranges = pd.read_csv(f"{dir}/value_ranges.csv", index_col="Row Label")
-    category_labels = pd.read_csv(f"{dir}/category_labels.csv")
-    vol_measurements = pd.read_csv(f"{dir}/vol_measurements.csv")
-    downloads = pd.read_csv(f"{FD["volumetric-map"]}/downloads.csv")
+    meta = read_csv(f"{dir}/meta.csv")
+    value_ranges = read_csv(f"{dir}/value_ranges.csv", index_col="Row Label")
+    category_labels = read_csv(f"{dir}/category_labels.csv")
+    vol_measurements = read_csv(f"{dir}/vol_measurements.csv")
+    downloads = read_csv(f"{FD["volumetric-map"]}/downloads.csv")
 
     # Get title and desc
     page_info = meta.iloc[0].to_dict()
@@ -99,13 +171,6 @@ def load_data(block: str) -> tuple[dict, dict, list, list, list, dict]:
     return page_info, defaults, layers, category_opts, value_info, axes, downloads
 
 
-def find_global_value_bounds(value_info: dict) -> tuple[float, float]:
-    value_keys = value_info.keys()
-    mins = [value_info[key]["Min"] for key in value_keys]
-    maxes = [value_info[key]["Max"] for key in value_keys]
-    return math.floor(min(mins)), math.ceil(max(maxes))
-
-
 def layout(block=None, **kwargs):
     try:
         page_info, defaults, layers, category_opts, value_info, axes, downloads = (
@@ -121,6 +186,7 @@ def layout(block=None, **kwargs):
     values = list(value_info.keys())
     category_opts["Selected"] = defaults["d_category"]
     value_min_max = find_global_value_bounds(value_info)
+    has_stats = read_value_stats(block) is not None
 
     download_content = ui.make_downloads_ui_elements(
         downloads[downloads["Block"] == block]
@@ -133,14 +199,22 @@ def layout(block=None, **kwargs):
                 children=[
                     html.Header(html.H2(page_info["Title"])),
                     html.P(page_info["Description"]),
-                    ui.make_volumetric_map_filters(defaults, layers, values),
+                    ui.make_volumetric_map_filters(defaults, layers, values, has_stats),
+                    ui.make_roi_filters(axes),
                     html.Div(id="current-filters"),
                     ui.volumetric_map_tab_content,
+                    ui.value_histogram if has_stats else None,
                     dcc.Store(id="value-store"),
                     dcc.Store(id="color-store-sm"),
+                    dcc.Store(id="colorscale-store", data=ui.COLORSCALES),
                     dcc.Store(id="cube-opacity-store-sm"),
                     dcc.Store(id="point-opacity-store-sm"),
+                    dcc.Store(id="cube-mesh-store-sm", data=False),
                     dcc.Store(id="layer-store-sm"),
+                    dcc.Store(id="color-range-store-sm"),
+                    dcc.Store(id="roi-store-sm"),
+                    dcc.Store(id="threshold-store-sm"),
+                    dcc.Store(id="slice-store-sm"),
                     dcc.Store(id="category-selected"),
                     dcc.Store(id="category-store", data=category_opts),
                     dcc.Store(id="value-range-store", data=value_min_max),
@@ -154,37 +228,114 @@ def layout(block=None, **kwargs):
     return content
 
 
-@callback(
+# Controls are copied into stores in the browser, see assets/spatialmap.js
+# update_controls creates the category dropdown and cube mesh switch from their stores'
+# values, so they are only stored once they are changed. Storing them when they are
+# created would run update_fig again and resend the whole figure.
+clientside_callback(
+    ClientsideFunction(namespace="spatialmap", function_name="store"),
     Output("category-selected", "data"),
     Input("categorydd", "value"),
+    prevent_initial_call=True,
+)
+
+
+clientside_callback(
+    ClientsideFunction(namespace="spatialmap", function_name="store"),
+    Output("value-store", "data"),
+    Input("proteinsdd", "value"),
+)
+
+
+clientside_callback(
+    ClientsideFunction(namespace="spatialmap", function_name="store"),
+    Output("layer-store-sm", "data"),
+    Input("layersdd", "value"),
 )
-def save_category_opt(data):
-    return data
 
 
-@callback(Output("value-store", "data"), Input("proteinsdd", "value"))
-def save_protein_filter(value):
-    return value
+clientside_callback(
+    ClientsideFunction(namespace="spatialmap", function_name="store"),
+    Output("color-range-store-sm", "data"),
+    Input("colorrangedd", "value"),
+)
 
 
-@callback(Output("color-store-sm", "data"), Input("cschemedd", "value"))
-def save_color_scheme(value):
-    return value
+clientside_callback(
+    ClientsideFunction(namespace="spatialmap", function_name="storeRoi"),
+    Output("roi-store-sm", "data"),
+    Input("roi-x", "value"),
+    Input("roi-y", "value"),
+    Input("roi-z", "value"),
+    State("axes-store", "data"),
+)
 
 
-@callback(Output("layer-store-sm", "data"), Input("layersdd", "value"))
-def save_layer(value):
-    return value
+# Color scheme and opacity changes restyle the current figure in the browser, see
+# assets/spatialmap.js. update_fig only reads them when it has to rebuild the figure.
+clientside_callback(
+    ClientsideFunction(namespace="spatialmap", function_name="restyleColor"),
+    Output("color-store-sm", "data"),
+    Output("volumetric-map-graph", "figure", allow_duplicate=True),
+    Input("cschemedd", "value"),
+    State("volumetric-map-graph", "figure"),
+    State("colorscale-store", "data"),
+    prevent_initial_call=True,
+)
 
 
-@callback(Output("cube-opacity-store-sm", "data"), Input("cubeslider", "value"))
-def save_cube_opacity(value):
-    return value
+clientside_callback(
+    ClientsideFunction(namespace="spatialmap", function_name="restyleCubeOpacity"),
+    Output("cube-opacity-store-sm", "data"),
+    Output("volumetric-map-graph", "figure", allow_duplicate=True),
+    Input("cubeslider", "value"),
+    State("volumetric-map-graph", "figure"),
+    prevent_initial_call=True,
+)
 
 
-@callback(Output("point-opacity-store-sm", "data"), Input("pointslider", "value"))
-def save_point_opacity(value):
-    return value
+clientside_callback(
+    ClientsideFunction(namespace="spatialmap", function_name="restylePointOpacity"),
+    Output("point-opacity-store-sm", "data"),
+    Output("volumetric-map-graph", "figure", allow_duplicate=True),
+    Input("pointslider", "value"),
+    State("volumetric-map-graph", "figure"),
+    prevent_initial_call=True,
+)
+
+
+clientside_callback(
+    ClientsideFunction(namespace="spatialmap", function_name="store"),
+    Output("cube-mesh-store-sm", "data"),
+    Input("cubemesh", "value"),
+    prevent_initial_call=True,
+)
+
+
+# The slider starts at the threshold the figure is drawn with, so it is only stored once it
+# is moved. Storing it when it is created would rebuild the prerendered default view.
+clientside_callback(
+    ClientsideFunction(namespace="spatialmap", function_name="store"),
+    Output("threshold-store-sm", "data"),
+    Input("isoslider", "value"),
+    prevent_initial_call=True,
+)
+
+
+clientside_callback(
+    ClientsideFunction(namespace="spatialmap", function_name="store"),
+    Output("slice-store-sm", "data"),
+    Input("sliceslider", "value"),
+)
+
+
+# The slice view replaces the graph, which keeps its figure for when a 3D view is reopened
+clientside_callback(
+    ClientsideFunction(namespace="spatialmap", function_name="showSlices"),
+    Output("graph-view", "hidden"),
+    Output("slice-view", "hidden"),
+    Input("tabs", "active_tab"),
+)
 
 
 @callback(
@@ -194,8 +345,28 @@ def save_point_opacity(value):
     State("category-store", "data"),
     State("point-opacity-store-sm", "data"),
     State("cube-opacity-store-sm", "data"),
+    State("cube-mesh-store-sm", "data"),
+    State("threshold-store-sm", "data"),
+    State("value-store", "data"),
+    State("color-range-store-sm", "data"),
+    State("slice-store-sm", "data"),
+    State("axes-store", "data"),
+    State("block-store", "data"),
 )
-def update_controls(at, category_selected, category_data, point_opacity, cube_opacity):
+def update_controls(
+    at,
+    category_selected,
+    category_data,
+    point_opacity,
+    cube_opacity,
+    cube_mesh,
+    threshold=None,
+    value=None,
+    color_range=None,
+    slice_layer=None,
+    axes={},
+    block="",
+):
     if at == "layer-tab" or not at:
         return
     else:
@@ -205,28 +376,70 @@ def update_controls(at, category_selected, category_data, point_opacity, cube_op
             if key != "Category" and key != "Selected":
                 dd_opts.append(category_data[key])
         if at == "cube-tab":
-            return [ui.make_extra_filters(at, category_selected, dd_opts, cube_opacity)]
+            return [
+                ui.make_extra_filters(
+                    at, category_selected, dd_opts, cube_opacity, bool(cube_mesh)
+                )
+            ]
         if at == "point-tab":
             return [
                 ui.make_extra_filters(at, category_selected, dd_opts, point_opacity)
             ]
         if at == "sphere-tab":
             return [ui.make_extra_filters(at, category_selected, dd_opts)]
+        if at == "iso-tab":
+            # the slider spans the color range update_fig draws the isosurface in
+            try:
+                _, value_ranges, _ = read_block_info(block)
+            except FileNotFoundError:
+                return
+            value_range = volumetric.stats_value_range(
+                read_value_stats(block),
+                value,
+                color_range or figures.DEFAULT_SETTINGS["color_range"],
+                value_ranges,
+            )
+            return [
+                ui.make_extra_filters(at, threshold=threshold, value_range=value_range)
+            ]
+        if at == "slice-tab":
+            return [
+                ui.make_extra_filters(
+                    at, slice_layer=slice_layer or 1, num_layers=len(axes["Z"]) - 1
+                )
+            ]
+
+
+def make_fig(tab, block, axes, value_ranges, category_data, settings):
+    """Builds the figure for a tab of the volumetric map. Raises FileNotFoundError if the
+    block's files are missing."""
+    voxels = read_voxels(block, "points_data")
+    vol_measurements = read_csv(f"{FD["volumetric-map"]}/{block}/vol_measurements.csv")
+    return figures.make_view_fig(
+        tab,
+        voxels,
+        volumetric.voxel_sizes(vol_measurements),
+        axes,
+        value_ranges,
+        category_data,
+        settings,
+    )
 
 
 @callback(
     Output("volumetric-map-graph", "figure"),
     Input("tabs", "active_tab"),
-    Input("color-store-sm", "data"),
+    State("color-store-sm", "data"),
     Input("value-store", "data"),
-    Input("cube-opacity-store-sm", "data"),
-    Input("point-opacity-store-sm", "data"),
+    State("cube-opacity-store-sm", "data"),
+    State("point-opacity-store-sm", "data"),
     Input("layer-store-sm", "data"),
     Input("category-selected", "data"),
-    State("category-store", "data"),
-    State("value-range-store", "data"),
-    State("axes-store", "data"),
     State("block-store", "data"),
+    Input("cube-mesh-store-sm", "data"),
+    Input("color-range-store-sm", "data"),
+    Input("roi-store-sm", "data"),
+    Input("threshold-store-sm", "data"),
 )
 def update_fig(
     tab,
@@ -236,10 +449,11 @@ def update_fig(
     pointopacity=0.1,
     layer="All",
     category_selected="All",
-    category_data={},
-    value_ranges=(0, 1),
-    axes={},
     block="",
+    cube_mesh=False,
+    color_range="global",
+    roi=None,
+    threshold=None,
 ):
     # Dash overrides the parameter defaults by passing in None sometimes, must reset defaults in that case
     props = {
@@ -249,94 +463,219 @@ def update_fig(
         "pointopacity": pointopacity,
         "layer": layer,
         "category_selected": category_selected,
+        "cube_mesh": cube_mesh,
+        "color_range": color_range,
+        "roi": roi,
+        "threshold": threshold,
     }
-    settings = {
-        "color": "haline",
-        "value": "",
-        "cubeopacity": 0.4,
-        "pointopacity": 0.1,
-        "layer": "All",
-        "category_selected": "All",
-    }
+    settings = dict(figures.DEFAULT_SETTINGS)
     for key in settings.keys():
         if props[key] is not None:
             settings[key] = props[key]
+    settings["cube_mesh"] = bool(settings["cube_mesh"])
 
-    if tab == "cube-tab":
-        try:
-            df = pd.read_csv(f"{FD["volumetric-map"]}/{block}/cube_data.csv")
-        except FileNotFoundError:
-            return alerts.send_toast(
-                "Cannot load page",
-                "Missing required configuration, please contact an administrator to resolve the issue.",
-                "failure",
-            )
+    if tab not in figures.VIEW_PARAMS:
+        # the slice view is drawn by update_slices
+        return no_update
 
-        return ui.make_cube_fig(
-            axes,
-            value_ranges,
-            category_data,
-            df,
-            colorscheme=settings["color"],
-            value=settings["value"],
-            opacity=settings["cubeopacity"],
-            layer=settings["layer"],
-            category_opt=settings["category_selected"],
-        )
-    elif tab == "point-tab":
-        try:
-            df = pd.read_csv(f"{FD["volumetric-map"]}/{block}/points_data.csv")
-        except FileNotFoundError:
-            return alerts.send_toast(
-                "Cannot load page",
-                "Missing required configuration, please contact an administrator to resolve the issue.",
-                "failure",
+    dir = f"{FD["volumetric-map"]}/{block}"
+    try:
+        version = data_version(dir)
+        # The block's axes, value range and category labels are read from its files rather
+        # than taken from the browser, so cached figures only depend on the key below.
+        axes, value_ranges, category_data = read_block_info(block)
+        # the default views are prerendered when a block is published
+        fig = None
+        ranges_df = read_csv(f"{dir}/value_ranges.csv", index_col="Row Label")
+        if figures.view_settings(tab, settings) == figures.view_settings(
+            tab, figures.default_settings(ranges_df)
+        ):
+            fig = figures.read_prerendered(dir, tab, version)
+        if fig is None:
+            value_ranges = volumetric.stats_value_range(
+                read_value_stats(block),
+                settings["value"],
+                settings["color_range"],
+                value_ranges,
             )
-        return ui.make_point_fig(
-            axes,
-            value_ranges,
-            df,
-            colorscheme=settings["color"],
-            value=settings["value"],
-            opacity=settings["pointopacity"],
-            layer=settings["layer"],
-        )
-    elif tab == "layer-tab":
-        try:
-            df = pd.read_csv(f"{FD["volumetric-map"]}/{block}/points_data.csv")
-        except FileNotFoundError:
-            return alerts.send_toast(
-                "Cannot load page",
-                "Missing required configuration, please contact an administrator to resolve the issue.",
-                "failure",
+            # Everything a view depends on, so equal keys always mean equal figures.
+            # Concurrent requests for the same figure wait for a single build.
+            key = figure_cache.key(
+                block=block,
+                tab=tab,
+                version=version,
+                render_version=figures.RENDER_VERSION,
+                binary_arrays=figures.BINARY_ARRAYS,
+                **figures.view_settings(tab, settings),
             )
-        return ui.make_layer_fig(
-            axes,
-            value_ranges,
-            df,
-            colorscheme=settings["color"],
-            value=settings["value"],
-            layer=settings["layer"],
-        )
-    elif tab == "sphere-tab":
-        try:
-            df = pd.read_csv(f"{FD["volumetric-map"]}/{block}/points_data.csv")
-        except FileNotFoundError:
-            return alerts.send_toast(
-                "Cannot load page",
-                "Missing required configuration, please contact an administrator to resolve the issue.",
-                "failure",
+            fig = figure_cache.get_or_build(
+                key,
+                lambda: figures.encode_figure(
+                    make_fig(tab, block, axes, value_ranges, category_data, settings)
+                ),
             )
-        return ui.make_sphere_fig(
+    except FileNotFoundError:
+        return alerts.send_toast(
+            "Cannot load page",
+            "Missing required configuration, please contact an administrator to resolve the issue.",
+            "failure",
+        )
+
+    # The figure in the browser already has the geometry of this tab. A protein change
+    # only replaces the values it is colored by, in views whose geometry does not depend
+    # on the protein, and other single changes replace the traces and title but keep the
+    # rest of the layout. Tab changes and the first load send the whole figure.
+    trigger = triggered_inputs()
+    if len(trigger) == 1 and "tabs" not in trigger:
+        if trigger == {"value-store"} and tab in figures.FIXED_GEOMETRY_TABS:
+            return ui.make_value_patch(fig)
+        return ui.make_data_patch(fig)
+    return fig
+
+
+@callback(
+    Output("slice-browser", "children"),
+    Input("tabs", "active_tab"),
+    Input("value-store", "data"),
+    Input("color-store-sm", "data"),
+    Input("slice-store-sm", "data"),
+    Input("color-range-store-sm", "data"),
+    Input("roi-store-sm", "data"),
+    State("value-range-store", "data"),
+    State("axes-store", "data"),
+    State("block-store", "data"),
+)
+def update_slices(
+    tab,
+    value,
+    color="haline",
+    layer=1,
+    color_range="global",
+    roi=None,
+    value_ranges=(0, 1),
+    axes={},
+    block="",
+):
+    # Layers are sent as small images of every protein, which need no WebGL
+    if tab != "slice-tab" or not value:
+        return no_update
+    color = color or figures.DEFAULT_SETTINGS["color"]
+    color_range = color_range or figures.DEFAULT_SETTINGS["color_range"]
+    layer = layer or 1
+
+    dir = f"{FD["volumetric-map"]}/{block}"
+    try:
+        version = data_version(dir)
+        ranges_df = read_csv(f"{dir}/value_ranges.csv", index_col="Row Label")
+        voxels = read_voxels(block, "points_data")
+        num_layers = len(read_block_info(block)[0]["Z"]) - 1
+    except FileNotFoundError:
+        return alerts.send_toast(
+            "Cannot load page",
+            "Missing required configuration, please contact an administrator to resolve the issue.",
+            "failure",
+        )
+    stats = read_value_stats(block)
+    proteins = [p for p in ranges_df.columns if p in voxels.columns]
+    if value not in proteins or color not in ui.LUTS:
+        return no_update
+    if not isinstance(layer, int) or not 1 <= layer <= num_layers:
+        return no_update
+    images = render_slices(
+        block,
+        version,
+        tuple(proteins),
+        layer - 1,
+        color,
+        tuple(
+            volumetric.stats_value_range(stats, p, color_range, value_ranges)
+            for p in proteins
+        ),
+        tuple((a, tuple(roi[a])) for a in "XYZ") if roi else None,
+    )
+    aspect_ratio = (axes["X"][-1] - axes["X"][0]) / (axes["Y"][-1] - axes["Y"][0])
+    return ui.make_slice_browser(
+        value, dict(zip(proteins, images)), aspect_ratio, layer
+    )
+
+
+@callback(
+    Output("value-histogram", "figure"),
+    Input("value-store", "data"),
+    Input("color-range-store-sm", "data"),
+    State("value-range-store", "data"),
+    State("block-store", "data"),
+)
+def update_histogram(value, color_range, value_ranges, block):
+    stats = read_value_stats(block)
+    if stats is None or value not in stats.columns:
+        return {}
+    value_range = volumetric.stats_value_range(stats, value, color_range, value_ranges)
+    return figures.make_histogram_fig(stats, value, value_range)
+
+
+@callback(
+    Output("voxel-details", "children"),
+    Input("volumetric-map-graph", "clickData"),
+    State("value-store", "data"),
+    State("block-store", "data"),
+    State("tabs", "active_tab"),
+    State("layer-store-sm", "data"),
+    State("category-selected", "data"),
+    State("roi-store-sm", "data"),
+)
+def display_voxel_details(
+    click_data,
+    value,
+    block,
+    tab=None,
+    layer="All",
+    category_selected="All",
+    roi=None,
+):
+    # Only the clicked point is sent. The voxel under it is looked up on the grid, so
+    # figures do not carry any per-voxel details.
+    if not click_data or not click_data.get("points"):
+        return ui.make_voxel_card()
+    point = click_data["points"][0]
+    dir = f"{FD["volumetric-map"]}/{block}"
+    try:
+        voxels = read_voxels(block, "points_data")
+        ranges_df = read_csv(f"{dir}/value_ranges.csv", index_col="Row Label")
+        # as in update_fig, the grid is sized by the block's files, not the browser
+        axes, _, category_data = read_block_info(block)
+    except FileNotFoundError:
+        return ui.make_voxel_card()
+    # Only the voxels the view draws can be clicked, which matters where the point is on a
+    # face shared with a voxel outside the selection
+    selected = None
+    params = figures.VIEW_PARAMS.get(tab, [])
+    if "layer" in params:
+        category = category_selected if "category_selected" in params else None
+        selected = voxels.crop_rows(
+            voxels.select(layer or "All", axes["Z"], category or "All", category_data),
             axes,
-            value_ranges,
-            category_data,
-            df,
-            colorscheme=settings["color"],
-            value=settings["value"],
-            layer=settings["layer"],
-            category_opt=settings["category_selected"],
+            roi,
+        )
+    row = voxels.find_row([point.get(a) for a in "xyz"], axes, selected=selected)
+    if row is None:
+        return ui.make_voxel_card()
+
+    center = [voxels.x[row], voxels.y[row], voxels.z[row]]
+    layer = voxels.grid_cells(axes)[row, 2] + 1
+    details = {"Center": ", ".join(f"{c:g}" for c in center), "Layer": layer}
+    if "Category" in voxels.columns:
+        in_category = bool(voxels.row_values(row, ["Category"])["Category"])
+        label = "Label (Only True)" if in_category else "Label (Only False)"
+        details[category_data.get("Category", "Category")] = category_data.get(
+            label, in_category
         )
+    proteins = [p for p in ranges_df.columns if p in voxels.columns]
+    title = "Voxel"
+    if "Block ID" in voxels.columns:
+        title = f"Voxel {voxels.row_values(row, ["Block ID"])["Block ID"]}"
+    app_logger.debug(f"Displaying details of voxel {row} of {block}")
+    return ui.make_voxel_card(title, details, voxels.row_values(row, proteins), value)
 
 
 @callback(
@@ -347,7 +686,7 @@ def update_fig(
 )
 def display_output(n_clicks, id):
     try:
-        downloads = pd.read_csv(f"{FD["volumetric-map"]}/downloads.csv")
+        downloads = read_csv(f"{FD["volumetric-map"]}/downloads.csv")
     except FileNotFoundError:
         return alerts.send_toast(
             "Cannot load page",
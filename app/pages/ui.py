@@ -1,8 +1,11 @@
-from dash import dcc, html
+import math
+
+from dash import Patch, dcc, html
 import dash_bootstrap_components as dbc
 import pandas as pd
-import numpy as np
-import plotly.graph_objects as go
+from plotly.colors import get_colorscale
+
+from components import figures, slices
 
 
 C_SCHEMES = [
@@ -22,10 +25,26 @@ C_SCHEMES = [
     "ylgnbu",
     "ylorrd",
 ]
+# Resolved color scales for restyling figures in the browser, which only knows Plotly.js's
+# own named scales
+COLORSCALES = {scheme: get_colorscale(scheme) for scheme in C_SCHEMES}
+# Color lookup tables for drawing layers as images in the slice view
+LUTS = {scheme: slices.make_lut(COLORSCALES[scheme]) for scheme in C_SCHEMES}
+
+
+# Color ranges the volumetric map can be drawn with, see volumetric.stats_value_range. Only
+# the first is offered for blocks published without value_stats.csv.
+COLOR_RANGES = [
+    {"label": "All proteins", "value": "global"},
+    {"label": "This protein", "value": "protein"},
+    {"label": "This protein, 1st to 99th percentile", "value": "robust"},
+]
 
 
 # Layout functions
-def make_volumetric_map_filters(defaults: dict, layers: dict, values: list):
+def make_volumetric_map_filters(
+    defaults: dict, layers: dict, values: list, has_stats: bool = False
+):
     return dbc.Card(
         dbc.CardBody(
             dbc.Row(
@@ -60,6 +79,17 @@ def make_volumetric_map_filters(defaults: dict, layers: dict, values: list):
                             ),
                         ]
                     ),
+                    dbc.Col(
+                        [
+                            html.P("Choose a color range:", className="card-text"),
+                            dcc.Dropdown(
+                                COLOR_RANGES if has_stats else COLOR_RANGES[:1],
+                                figures.DEFAULT_SETTINGS["color_range"],
+                                id="colorrangedd",
+                                clearable=False,
+                            ),
+                        ]
+                    ),
                 ],
                 justify="center",
             ),
@@ -69,6 +99,41 @@ def make_volumetric_map_filters(defaults: dict, layers: dict, values: list):
     )
 
 
+def make_roi_filters(axes: dict):
+    """Returns range sliders that crop the volumetric map to a box, snapping to voxel
+    boundaries. They start out covering the whole block."""
+    sliders = []
+    for axis in "XYZ":
+        edges = axes[axis]
+        sliders.append(
+            dbc.Col(
+                [
+                    html.P(f"{axis} range:", className="card-text"),
+                    dcc.RangeSlider(
+                        edges[0],
+                        edges[-1],
+                        edges[1] - edges[0],
+                        value=[edges[0], edges[-1]],
+                        marks=None,
+                        tooltip={"placement": "bottom"},
+                        allowCross=False,
+                        id=f"roi-{axis.lower()}",
+                    ),
+                ]
+            )
+        )
+    return dbc.Card(
+        dbc.CardBody(
+            [
+                html.P("Crop to a region of interest:", className="card-text"),
+                dbc.Row(sliders, justify="center"),
+            ]
+        ),
+        color="light",
+        class_name="volumetric-map-filter",
+    )
+
+
 def make_downloads_ui_elements(downloads: pd.DataFrame) -> list:
     download_items = [html.Header(html.H2("Download Data Here"))]
     for i in downloads.index:
@@ -83,23 +148,69 @@ def make_downloads_ui_elements(downloads: pd.DataFrame) -> list:
     return download_items
 
 
+def make_voxel_card(title=None, details: dict = {}, values: dict = {}, selected=None):
+    """Returns the contents of the card describing a clicked voxel. details are labelled
+    properties of the voxel and values its protein values, with the selected protein shown
+    first. Without a title, returns the card shown before a voxel is clicked."""
+    if title is None:
+        return [
+            dbc.CardHeader("Voxel Data"),
+            dbc.CardBody(html.P("Click on a voxel to view its data")),
+        ]
+    body = [html.P(f"{label}: {value}") for label, value in details.items()]
+    proteins = sorted(values, key=lambda protein: protein != selected)
+    for protein in proteins:
+        value = "No value" if math.isnan(values[protein]) else f"{values[protein]:.6g}"
+        name = html.B(protein) if protein == selected else protein
+        body.append(html.P([name, f": {value}"], className="mb-1"))
+    return [
+        dbc.CardHeader(title, class_name="card-title"),
+        dbc.CardBody(body),
+    ]
+
+
 volumetric_map_fig = dbc.Row(
-    dbc.Col(
-        dcc.Loading(
-            dcc.Graph(
-                figure={},
-                className="dcc-graph",
-                id="volumetric-map-graph",
+    [
+        dbc.Col(
+            [
+                html.Div(
+                    dcc.Loading(
+                        dcc.Graph(
+                            figure={},
+                            className="dcc-graph",
+                            id="volumetric-map-graph",
+                        ),
+                        style={
+                            "visibility": "visible",
+                            "backgroundColor": "transparent",
+                            "opacity": 0.7,
+                        },
+                        type="dot",
+                        parent_className="loader-wrapper",
+                    ),
+                    id="graph-view",
+                ),
+                html.Div(
+                    dcc.Loading(html.Div(id="slice-browser"), type="dot"),
+                    id="slice-view",
+                    hidden=True,
+                ),
+            ],
+            width=12,
+            lg=9,
+        ),
+        dbc.Col(
+            dbc.Card(
+                make_voxel_card(),
+                id="voxel-details",
+                color="light",
+                class_name="block-card",
             ),
-            style={
-                "visibility": "visible",
-                "backgroundColor": "transparent",
-                "opacity": 0.7,
-            },
-            type="dot",
-            parent_className="loader-wrapper",
+            width=12,
+            lg=3,
         ),
-    )
+    ],
+    className="g-3",
 )
 
 volumetric_map_tab_content = dbc.Card(
@@ -111,6 +222,8 @@ volumetric_map_tab_content = dbc.Card(
                     dbc.Tab(label="Point View", tab_id="point-tab"),
                     dbc.Tab(label="Layer View", tab_id="layer-tab"),
                     dbc.Tab(label="Sphere View", tab_id="sphere-tab"),
+                    dbc.Tab(label="Isosurface View", tab_id="iso-tab"),
+                    dbc.Tab(label="Slice View", tab_id="slice-tab"),
                 ],
                 id="tabs",
                 active_tab="cube-tab",
@@ -127,6 +240,18 @@ volumetric_map_tab_content = dbc.Card(
 )
 
 
+value_histogram = dbc.Card(
+    dbc.CardBody(
+        dcc.Graph(
+            figure={},
+            id="value-histogram",
+            config={"displayModeBar": False},
+        )
+    ),
+    color="light",
+)
+
+
 def make_opacity_slider(id, opacity):
     return [
         html.P("Adjust the opacity of the model:"),
@@ -151,7 +276,56 @@ def make_category_slider(start="All", category_options=["All"]):
     ]
 
 
-def make_extra_filters(tab, category_opt="All", category_dd_opts=["All"], opacity=0.4):
+def make_mesh_switch(culled=False):
+    return [
+        dbc.Switch(
+            id="cubemesh",
+            label="Hide internal faces",
+            value=culled,
+        ),
+    ]
+
+
+def make_threshold_slider(threshold, value_range):
+    return [
+        html.P("Show the surface around values of at least:"),
+        dcc.Slider(
+            value_range[0],
+            value_range[1],
+            (value_range[1] - value_range[0]) / 100,
+            value=threshold,
+            marks=None,
+            tooltip={"placement": "bottom", "always_visible": True},
+            id="isoslider",
+        ),
+    ]
+
+
+def make_slice_slider(layer, num_layers):
+    return [
+        html.P("Choose a layer:"),
+        dcc.Slider(
+            1,
+            num_layers,
+            1,
+            value=layer,
+            marks={n: str(n) for n in range(1, num_layers + 1)},
+            id="sliceslider",
+        ),
+    ]
+
+
+def make_extra_filters(
+    tab,
+    category_opt="All",
+    category_dd_opts=["All"],
+    opacity=0.4,
+    culled=False,
+    threshold=None,
+    value_range=(0, 1),
+    slice_layer=1,
+    num_layers=1,
+):
     controls = []
     if tab == "cube-tab":
         controls = [
@@ -160,7 +334,8 @@ def make_extra_filters(tab, category_opt="All", category_dd_opts=["All"], opacit
                 width=6,
                 lg=4,
             ),
-            dbc.Col(children=make_opacity_slider("cubeslider", opacity), width=6, lg=8),
+            dbc.Col(children=make_opacity_slider("cubeslider", opacity), width=6, lg=6),
+            dbc.Col(children=make_mesh_switch(culled), width=12, lg=2),
         ]
     elif tab == "point-tab":
         controls = [
@@ -175,6 +350,22 @@ def make_extra_filters(tab, category_opt="All", category_dd_opts=["All"], opacit
                 children=make_category_slider(category_opt, category_dd_opts),
             ),
         ]
+    elif tab == "iso-tab":
+        if threshold is None:
+            threshold = (value_range[0] + value_range[1]) / 2
+        controls = [
+            dbc.Col(
+                children=make_threshold_slider(threshold, value_range),
+                width=12,
+            ),
+        ]
+    elif tab == "slice-tab":
+        controls = [
+            dbc.Col(
+                children=make_slice_slider(slice_layer, num_layers),
+                width=12,
+            ),
+        ]
 
     return dbc.Card(
         dbc.CardBody(
@@ -184,311 +375,66 @@ def make_extra_filters(tab, category_opt="All", category_dd_opts=["All"], opacit
     )
 
 
-# Graph functions
-def select_layer(zlayer: str, df: pd.DataFrame, z_axis: list):
-    if zlayer == "All":
-        return df
-    else:
-        # get layer num
-        layer = int(zlayer[-1])
-        lower = z_axis[layer - 1]
-        upper = z_axis[layer]
-        return df[(df["Z Center"] >= lower) & (df["Z Center"] < upper)]
-
-
-def select_category(category_opt, category_labels, df):
-    if category_opt == "All":
-        return df
-    elif category_opt == category_labels["Label (Only True)"]:
-        return df[df["Category"]]
-    elif category_opt == category_labels["Label (Only False)"]:
-        return df[~df["Category"]]
-
-
-def set_layout(fig, axes):
-    fig.update_layout(
-        scene=dict(
-            xaxis=dict(
-                nticks=10,
-                range=[axes["X"][0], axes["X"][-1]],
-            ),
-            yaxis=dict(
-                nticks=6,
-                range=[axes["Y"][0], axes["Y"][-1]],
-            ),
-            zaxis=dict(
-                nticks=5,
-                range=[axes["Z"][0], axes["Z"][-1]],
-            ),
-            aspectmode="manual",
-            aspectratio=dict(x=0.9, y=0.5, z=0.4),
-            camera=dict(eye=dict(x=0.7, y=0.7, z=0.7)),
-        ),
-    )
-
-
-def get_colors(df, value, y_axis):
-    colors = []
-    for i in range(len(y_axis) - 1):
-        colors.append(
-            df[(df["Y Center"] >= y_axis[i]) & (df["Y Center"] < y_axis[i + 1])]
-            .loc[:, value]
-            .to_list(),
-        )
-    return colors
-
-
-def make_point_fig(
-    axes,
-    value_ranges,
-    df,
-    opacity=0.1,
-    colorscheme="haline",
-    value="",
-    layer="All",
-):
-    """Create figure for point view of volumetric map data"""
-    df4 = select_layer(layer, df, axes["Z"])
-    X = df4.loc[:, "X Center"]
-    Y = df4.loc[:, "Y Center"]
-    Z = df4.loc[:, "Z Center"]
-    values = df4.loc[:, value]
-
-    fig2 = go.Figure(
-        data=go.Volume(
-            x=X,
-            y=Y,
-            z=Z,
-            value=values,
-            isomin=value_ranges[0],
-            isomax=value_ranges[1],
-            opacity=opacity,
-            colorscale=colorscheme,
-            surface_count=21,
-            name="Point View",
-        )
-    )
-
-    set_layout(fig2, axes)
-    return fig2
-
-
-def make_layer_fig(
-    axes,
-    value_ranges,
-    df,
-    colorscheme="haline",
-    value="",
-    layer="All",
-):
-    """Create figure for layer view of volumetric map data"""
-    data = []
-
-    if layer == "All":
-        for k in range(len(axes["Z"]) - 1):
-            this_layer = select_layer(f"Layer {k + 1}", df, axes["Z"])
-            color_set = get_colors(this_layer, value, axes["Y"])
-            X = this_layer.loc[:, "X Center"].unique()
-            Y = this_layer.loc[:, "Y Center"].unique()
-            z_val = this_layer.loc[:, "Z Center"].unique()[0]
-            Z = [[z_val for i in X] for j in Y]
-            if k == 0:
-                data.append(
-                    go.Surface(
-                        x=X,
-                        y=Y,
-                        z=Z,
-                        colorscale=colorscheme,
-                        surfacecolor=color_set,
-                        name=f"Layer {k + 1}",
-                        cmin=value_ranges[0],
-                        cmax=value_ranges[1],
-                    ),
-                )
-            else:
-                data.append(
-                    go.Surface(
-                        x=X,
-                        y=Y,
-                        z=Z,
-                        colorscale=colorscheme,
-                        surfacecolor=color_set,
-                        name=f"Layer {k + 1}",
-                        cmin=value_ranges[0],
-                        cmax=value_ranges[1],
-                        showscale=False,
-                    ),
-                )
-    else:
-        this_layer = select_layer(layer, df, axes["Z"])
-        color_set = get_colors(this_layer, value, axes["Y"])
-        X = this_layer.loc[:, "X Center"].unique()
-        Y = this_layer.loc[:, "Y Center"].unique()
-        z_val = this_layer.loc[:, "Z Center"].unique()[0]
-        Z = [[z_val for i in X] for j in Y]
-        data.append(
-            go.Surface(
-                x=X,
-                y=Y,
-                z=Z,
-                colorscale=colorscheme,
-                surfacecolor=color_set,
-                name=layer,
-                cmin=value_ranges[0],
-                cmax=value_ranges[1],
-            ),
+def make_slice_browser(
+    value: str, images: dict, aspect_ratio: float, layer: int
+) -> list:
+    """Returns the slice view of a layer: the image of the selected protein and, below it,
+    a grid of small images of every protein in images (a dict of data URIs by protein).
+    aspect_ratio is the width of the block over its height."""
+    style = {"aspectRatio": f"{aspect_ratio:.4g}"}
+    thumbnails = [
+        dbc.Col(
+            [
+                html.Img(src=src, alt=name, className="slice-img", style=style),
+                html.B(name) if name == value else html.Span(name),
+            ],
+            className="slice-thumbnail",
+            width=4,
+            md=3,
+            lg=2,
         )
-
-    fig = go.Figure(data=data)
-    set_layout(fig, axes)
-    return fig
-
-
-def make_sphere(x, y, z, radius, resolution=5):
-    """Calculate the coordinates to plot a sphere with center at (x, y, z). Returns three Numpy ndarrays."""
-    u, v = np.mgrid[0 : 2 * np.pi : resolution * 2j, 0 : np.pi : resolution * 1j]
-    X = radius * np.cos(u) * np.sin(v) + x
-    Y = radius * np.sin(u) * np.sin(v) + y
-    Z = radius * np.cos(v) + z
-    return (X, Y, Z)
-
-
-def make_sphere_fig(
-    axes,
-    value_ranges,
-    category_labels,
-    df,
-    opacity=1,
-    colorscheme="haline",
-    value="",
-    layer="All",
-    category_opt="All",
-):
-    """Create figure for sphere view of volumetric map data"""
-    res = 5
-    data = []
-
-    layer_df = select_layer(layer, df, axes["Z"])
-    layer_df = select_category(category_opt, category_labels, layer_df)
-
-    scalebar = False
-    for k in layer_df.index:
-        s_color = layer_df.loc[k, value]
-        if not np.isnan(s_color):
-            (X, Y, Z) = make_sphere(
-                x=layer_df.loc[k, "X Center"],
-                y=layer_df.loc[k, "Y Center"],
-                z=layer_df.loc[k, "Z Center"],
-                radius=14,
-                resolution=res,
-            )
-            c = [[s_color.item() for i in range(res)] for j in range(res * 2)]
-            if not scalebar:
-                data.append(
-                    go.Surface(
-                        x=X,
-                        y=Y,
-                        z=Z,
-                        surfacecolor=c,
-                        colorscale=colorscheme,
-                        cmin=value_ranges[0],
-                        cmax=value_ranges[1],
-                        opacity=opacity,
-                        name=f"val:\n{s_color.item()}",
-                    )
-                )
-                scalebar = True
-            else:
-                data.append(
-                    go.Surface(
-                        x=X,
-                        y=Y,
-                        z=Z,
-                        surfacecolor=c,
-                        colorscale=colorscheme,
-                        cmin=value_ranges[0],
-                        cmax=value_ranges[1],
-                        showscale=False,
-                        opacity=opacity,
-                        name=f"val:\n{s_color.item()}",
-                    )
-                )
-
-    fig4 = go.Figure(data=data)
-    set_layout(fig4, axes)
-    return fig4
-
-
-def make_cube_fig(
-    axes,
-    value_ranges,
-    category_labels,
-    df,
-    opacity=0.4,
-    colorscheme="haline",
-    value="",
-    layer="All",
-    category_opt="All",
-):
-    """Create figure for cube view of volumetric map data"""
-    df2 = select_layer(layer, df, axes["Z"])
-    df3 = select_category(category_opt, category_labels, df2)
-
-    X = df3.loc[:, "X Center"]
-    Y = df3.loc[:, "Y Center"]
-    Z = df3.loc[:, "Z Center"]
-    values = df3.loc[:, value]
-
-    # In the dataset, within each set of points representing a cube, the points are ordered as follows:
-    # [
-    #     [x, y, z],
-    #     [x + x_dist, y, z],
-    #     [x, y + y_dist, z],
-    #     [x + x_dist, y + y_dist, z],
-    #     [x, y, z + z_dist],
-    #     [x + x_dist, y, z + z_dist],
-    #     [x, y + y_dist, z + z_dist],
-    #     [x + x_dist, y + y_dist, z + z_dist],
-    # ]
-
-    triangle_pattern = [
-        [0, 1, 2],
-        [0, 1, 4],
-        [0, 2, 4],
-        [4, 5, 1],
-        [4, 2, 6],
-        [4, 5, 6],
-        [3, 2, 6],
-        [3, 5, 1],
-        [3, 2, 1],
-        [7, 6, 5],
-        [7, 6, 3],
-        [7, 3, 5],
+        for name, src in images.items()
+    ]
+    return [
+        html.H5(f"{value}, layer {layer}"),
+        html.Img(
+            src=images[value],
+            alt=f"{value}, layer {layer}",
+            className="slice-img",
+            style=style,
+        ),
+        html.H6("All proteins", className="mt-3"),
+        dbc.Row(thumbnails, className="g-2"),
     ]
 
-    all_triangles = []
-
-    for m in range(0, df3.shape[0], 8):
-        all_triangles.extend([[m + x[0], m + x[1], m + x[2]] for x in triangle_pattern])
-
-    faces1 = np.array(all_triangles)
-    faces2 = np.transpose(faces1)
-
-    fig1 = go.Figure(
-        data=go.Mesh3d(
-            x=X,
-            y=Y,
-            z=Z,
-            i=faces2[0],
-            j=faces2[1],
-            k=faces2[2],
-            intensity=values,
-            opacity=opacity,
-            colorscale=colorscheme,
-            cmin=value_ranges[0],
-            cmax=value_ranges[1],
-        )
-    )
 
-    set_layout(fig1, axes)
-    return fig1
+# Graph functions
+# The trace property that holds the protein values in each view
+VALUE_PROPS = {"mesh3d": "intensity", "volume": "value", "surface": "surfacecolor"}
+# The trace properties that hold the range the values are colored over in each view
+RANGE_PROPS = {
+    "mesh3d": ["cmin", "cmax"],
+    "volume": ["isomin", "isomax"],
+    "surface": ["cmin", "cmax"],
+}
+
+
+def make_value_patch(fig: dict) -> Patch:
+    """Returns a partial update that replaces only the protein values of the traces of a
+    figure from figures.encode_figure, and the range they are colored over, which depends
+    on the protein unless the color range is global. For when the browser already shows a
+    figure with the same geometry."""
+    patch = Patch()
+    for i, trace in enumerate(fig["data"]):
+        for prop in [VALUE_PROPS[trace["type"]], *RANGE_PROPS[trace["type"]]]:
+            patch["data"][i][prop] = trace[prop]
+    return patch
+
+
+def make_data_patch(fig: dict) -> Patch:
+    """Returns a partial update that replaces the traces and title of a figure from
+    figures.encode_figure and keeps the rest of the layout."""
+    patch = Patch()
+    patch["data"] = fig["data"]
+    patch["layout"]["title"] = fig["layout"].get("title", {})
+    return patch
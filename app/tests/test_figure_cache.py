@@ -0,0 +1,229 @@
+import errno
+import os
+import shutil
+import sys
+import threading
+import time
+
+import numpy as np
+import plotly.graph_objects as go
+import pytest
+
+if os.getcwd() not in sys.path:
+    sys.path.append(os.getcwd())
+from components import figure_cache
+from components.figure_cache import FigureCache, data_version
+
+
+def make_fig(n=4):
+    fig = go.Figure(
+        data=go.Mesh3d(
+            x=np.arange(n, dtype=float),
+            y=np.zeros(n),
+            z=np.ones(n),
+            i=[0, 1],
+            j=[1, 2],
+            k=[2, 3],
+            intensity=np.array([0.5, np.nan] + [1.0] * (n - 2)),
+            colorscale="haline",
+        )
+    )
+    return {"data": [trace.to_plotly_json() for trace in fig.data], "layout": {}}
+
+
+def test_figure_cache_round_trip(tmp_path):
+    cache = FigureCache(tmp_path)
+    key = cache.key(block="P1-20C", tab="cube-tab", value="CYB5A")
+    assert cache.get(key) is None
+    cache.put(key, make_fig())
+    fig = cache.get(key)
+    assert isinstance(fig, dict)
+    np.testing.assert_array_equal(fig["data"][0]["intensity"], [0.5, np.nan, 1, 1])
+    assert fig["data"][0]["i"].dtype == np.int64
+    assert fig["data"][0]["colorscale"] == make_fig()["data"][0]["colorscale"]
+    assert cache.stats() == {"hits": 1, "misses": 1}
+
+
+def test_figure_cache_keys():
+    key = FigureCache.key(block="P1-20C", tab="cube-tab")
+    assert key == FigureCache.key(tab="cube-tab", block="P1-20C")
+    assert key != FigureCache.key(block="P1-20C", tab="point-tab")
+
+
+def test_figure_cache_evicts_least_recently_used(tmp_path):
+    cache = FigureCache(tmp_path)
+    for key in ["a", "b", "c"]:
+        cache.put(key, make_fig())
+        # give every entry a distinct modification time
+        os.utime(tmp_path / f"{key}.json", ns=(0, ord(key)))
+    cache.get("a")
+    cache.max_bytes = 2 * os.path.getsize(tmp_path / "a.json")
+    cache.evict()
+    assert sorted(os.listdir(tmp_path)) == ["a.json", "c.json"]
+
+
+def test_figure_cache_fits_filesystem(tmp_path, monkeypatch):
+    cache = FigureCache(tmp_path, max_bytes=2**30)
+    assert cache.limit() < shutil.disk_usage(tmp_path).total
+    usage = shutil.disk_usage(tmp_path)._replace(total=4 * 2**20)
+    monkeypatch.setattr(figure_cache.shutil, "disk_usage", lambda path: usage)
+    assert cache.limit() == 2 * 2**20
+
+
+def test_figure_cache_evicts_before_writing(tmp_path):
+    cache = FigureCache(tmp_path)
+    cache.put("a", make_fig())
+    size = os.path.getsize(tmp_path / "a.json")
+    os.utime(tmp_path / "a.json", ns=(0, 0))
+    cache.put("b", make_fig())
+    # room for the new entry is made before it is written, so the cache never holds
+    # more than its limit
+    cache.max_bytes = 2 * size
+    cache.put("c", make_fig())
+    assert sorted(os.listdir(tmp_path)) == ["b.json", "c.json"]
+
+    # figures bigger than the whole cache are not stored
+    cache.max_bytes = size - 1
+    cache.put("d", make_fig())
+    assert not (tmp_path / "d.json").exists()
+
+
+def test_figure_cache_full_filesystem(tmp_path, monkeypatch):
+    cache = FigureCache(tmp_path)
+    for key in ["a", "b"]:
+        cache.put(key, make_fig())
+    write_text = figure_cache.write_text
+    writes = []
+
+    def fill_up(path, text):
+        writes.append(path)
+        if len(writes) == 1:
+            raise OSError(errno.ENOSPC, "No space left on device")
+        write_text(path, text)
+
+    monkeypatch.setattr(figure_cache, "write_text", fill_up)
+    cache.put("c", make_fig())
+    assert len(writes) == 2
+    assert sorted(os.listdir(tmp_path)) == ["c.json"]
+
+
+def test_figure_cache_unwritable_directory(tmp_path):
+    (tmp_path / "file").write_text("")
+    cache = FigureCache(tmp_path / "file" / "figures")
+    cache.put("a", make_fig())
+    assert cache.get("a") is None
+
+
+def test_data_version(tmp_path):
+    (tmp_path / "points_data.csv").write_text("1")
+    version = data_version(tmp_path)
+    assert data_version(tmp_path) == version
+    (tmp_path / "points_data.csv").write_text("22")
+    assert data_version(tmp_path) != version
+
+
+@pytest.mark.parametrize("shared_instance", [True, False])
+def test_figure_cache_coalesces_concurrent_builds(tmp_path, shared_instance):
+    # separate instances stand in for gunicorn workers, which only share the lock file
+    if shared_instance:
+        caches = [FigureCache(tmp_path)] * 4
+    else:
+        caches = [FigureCache(tmp_path) for _ in range(4)]
+    builds = []
+
+    def build():
+        builds.append(1)
+        time.sleep(0.2)
+        return make_fig()
+
+    results = [None] * len(caches)
+
+    def request(n):
+        results[n] = caches[n].get_or_build("a", build)
+
+    threads = [threading.Thread(target=request, args=(n,)) for n in range(len(caches))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(builds) == 1
+    assert all(fig["data"][0]["type"] == "mesh3d" for fig in results)
+    assert sum(cache.misses for cache in set(caches)) == 1
+    assert sum(cache.hits for cache in set(caches)) == 3
+
+
+def test_figure_cache_shares_uncached_builds(tmp_path):
+    # a figure too big to cache still reaches the callers that waited for its build
+    cache = FigureCache(tmp_path, max_bytes=0)
+    builds = []
+
+    def build():
+        builds.append(1)
+        time.sleep(0.2)
+        return make_fig()
+
+    threads = [
+        threading.Thread(target=cache.get_or_build, args=("a", build)) for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(builds) == 1
+    assert cache.stats() == {"hits": 3, "misses": 1}
+    assert cache.get("a") is None
+    # the built figure is not kept once nobody waits for it
+    assert cache._build_locks == {}
+
+
+def test_figure_cache_evict_keeps_held_locks(tmp_path):
+    cache = FigureCache(tmp_path)
+    for key in ["a", "b"]:
+        cache.put(key, make_fig())
+        (tmp_path / f"{key}.lock").touch()
+    cache.max_bytes = 0
+    with cache._file_lock("a"):
+        cache.evict()
+        # the lock of a build in progress stays, unused locks go with their entry
+        assert sorted(os.listdir(tmp_path)) == ["a.lock"]
+
+
+def test_figure_cache_lock_survives_deletion(tmp_path):
+    # a worker waiting for a lock file that is deleted locks the file that replaces it
+    fcntl = pytest.importorskip("fcntl")
+    cache = FigureCache(tmp_path)
+    path = tmp_path / "a.lock"
+    held = os.open(path, os.O_RDWR | os.O_CREAT)
+    fcntl.flock(held, fcntl.LOCK_EX)
+    locked = threading.Event()
+    release = threading.Event()
+
+    def build():
+        with cache._file_lock("a"):
+            locked.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=build)
+    thread.start()
+    time.sleep(0.1)
+    os.remove(path)
+    os.close(held)
+    assert locked.wait(5)
+    probe = os.open(path, os.O_RDWR)
+    with pytest.raises(BlockingIOError):
+        fcntl.flock(probe, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    os.close(probe)
+    release.set()
+    thread.join()
+
+
+def test_figure_cache_failed_build(tmp_path):
+    cache = FigureCache(tmp_path)
+
+    def build():
+        raise FileNotFoundError("points_data.csv")
+
+    with pytest.raises(FileNotFoundError):
+        cache.get_or_build("a", build)
+    # the lock is released, so the next request builds the figure
+    assert cache.get_or_build("a", make_fig)["data"][0]["type"] == "mesh3d"
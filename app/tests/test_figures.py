@@ -0,0 +1,61 @@
+import base64
+import os
+import sys
+
+import numpy as np
+import plotly.graph_objects as go
+
+if os.getcwd() not in sys.path:
+    sys.path.append(os.getcwd())
+from components.figures import BINARY_MIN_SIZE, encode_array, encode_figure
+
+
+def decode(spec):
+    values = np.frombuffer(base64.b64decode(spec["bdata"]), dtype=spec["dtype"])
+    if "shape" in spec:
+        values = values.reshape([int(n) for n in spec["shape"].split(",")])
+    return values
+
+
+def test_encode_array():
+    values = np.linspace(0, 1, BINARY_MIN_SIZE)
+    values[3] = np.nan
+    spec = encode_array("intensity", values)
+    assert spec["dtype"] == "f4"
+    np.testing.assert_array_equal(decode(spec), values.astype(np.float32))
+
+    # face indices use the smallest type that holds them
+    assert encode_array("i", np.arange(BINARY_MIN_SIZE))["dtype"] == "u2"
+    spec = encode_array("i", np.arange(BINARY_MIN_SIZE) * 1000)
+    assert spec["dtype"] == "i4"
+    np.testing.assert_array_equal(decode(spec), np.arange(BINARY_MIN_SIZE) * 1000)
+
+    surfacecolor = np.arange(2 * BINARY_MIN_SIZE, dtype=float).reshape(2, -1)
+    spec = encode_array("surfacecolor", surfacecolor)
+    assert spec["shape"] == f"2,{BINARY_MIN_SIZE}"
+    np.testing.assert_array_equal(decode(spec), surfacecolor)
+
+
+def test_encode_array_leaves_small_and_other_values():
+    assert encode_array("x", [1.0, 2.0]) == [1.0, 2.0]
+    colorscale = [[0, "#000000"], [1, "#ffffff"]] * BINARY_MIN_SIZE
+    assert encode_array("colorscale", colorscale) is colorscale
+
+
+def test_encode_figure(monkeypatch):
+    fig = go.Figure(
+        data=go.Mesh3d(
+            x=np.arange(BINARY_MIN_SIZE, dtype=float),
+            y=[0, 1, 2],
+            opacity=0.4,
+        )
+    )
+    encoded = encode_figure(fig)
+    assert encoded["data"][0]["x"]["dtype"] == "f4"
+    assert list(encoded["data"][0]["y"]) == [0, 1, 2]
+    assert encoded["data"][0]["opacity"] == 0.4
+    # the figure itself is not modified
+    assert isinstance(fig["data"][0]["x"], np.ndarray)
+
+    monkeypatch.setattr("components.figures.BINARY_ARRAYS", False)
+    assert isinstance(encode_figure(fig)["data"][0]["x"], np.ndarray)
@@ -0,0 +1,116 @@
+import base64
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image
+from plotly.colors import get_colorscale
+
+if os.getcwd() not in sys.path:
+    sys.path.append(os.getcwd())
+from components.slices import (
+    LUT_SIZE,
+    colorize,
+    encode_image,
+    layer_grids,
+    make_lut,
+    render_layer,
+)
+from components.volumetric import VolumetricBlock, make_axes
+
+AXES = {"X": [0, 10, 20, 30], "Y": [0, 10, 20], "Z": [0, 5, 10]}
+
+
+def decode(uri):
+    header, data = uri.split(",")
+    assert header.startswith("data:image/")
+    return np.asarray(Image.open(io.BytesIO(base64.b64decode(data))))
+
+
+@pytest.fixture
+def voxels():
+    # a 3 x 2 x 2 block with one voxel missing in the second layer
+    cells = [(x, y, z) for z in range(2) for y in range(2) for x in range(3)][:-1]
+    return VolumetricBlock.from_dataframe(
+        pd.DataFrame(
+            {
+                "X Center": [5 + 10 * x for x, _, _ in cells],
+                "Y Center": [5 + 10 * y for _, y, _ in cells],
+                "Z Center": [2.5 + 5 * z for _, _, z in cells],
+                "A": [float(x) for x, _, _ in cells],
+                "B": [float(y + 10 * z) for _, y, z in cells],
+            }
+        )
+    )
+
+
+def test_make_lut():
+    lut = make_lut(get_colorscale("greys"))
+    assert lut.shape == (LUT_SIZE, 4)
+    assert lut.dtype == np.uint8
+    np.testing.assert_array_equal(lut[0], [255, 255, 255, 255])
+    np.testing.assert_array_equal(lut[-1], [0, 0, 0, 255])
+
+
+def test_layer_grids(voxels):
+    grids = layer_grids(voxels, ["A", "B"], AXES, 1)
+    assert grids.shape == (2, 3, 2)
+    np.testing.assert_array_equal(grids[0, :, 0], [0, 1, 2])
+    np.testing.assert_array_equal(grids[1, :, 0], [10, 10, 10])
+    assert np.isnan(grids[1, 2, 1])
+
+    cropped = layer_grids(
+        voxels, ["A"], AXES, 0, roi={"X": [0, 20], "Y": [0, 20], "Z": [0, 10]}
+    )
+    assert np.isnan(cropped[0, 2]).all()
+    assert not np.isnan(cropped[0, :2]).any()
+
+    for layer in [-1, 2]:
+        with pytest.raises(ValueError):
+            layer_grids(voxels, ["A"], AXES, layer)
+
+
+def test_colorize():
+    lut = make_lut(get_colorscale("greys"))
+    grids = np.array([[[0, 1], [2, np.nan]], [[0, 1], [2, 3]]], dtype=np.float32)
+    images = colorize(grids, lut, [(0, 2), (5, 5)])
+    assert images.shape == (2, 2, 2, 4)
+    # rows run from the top of the block down, columns along X
+    np.testing.assert_array_equal(images[0, 1, :, 0], [255, 0])
+    np.testing.assert_array_equal(images[0, 0, 0], lut[LUT_SIZE // 2])
+    assert images[0, 0, 1, 3] == 0
+    # a range with no width draws everything with the bottom color
+    assert (images[1] == lut[0]).all()
+
+
+@pytest.mark.parametrize("image_format", ["png", "webp"])
+def test_encode_image(image_format):
+    image = np.zeros((2, 3, 4), dtype=np.uint8)
+    image[0, 1] = [10, 20, 30, 255]
+    uri = encode_image(image, image_format)
+    assert uri.startswith(f"data:image/{image_format};base64,")
+    np.testing.assert_array_equal(decode(uri), image)
+
+
+def test_render_layer(voxels):
+    lut = make_lut(get_colorscale("jet"))
+    images = render_layer(voxels, ["A", "B"], AXES, 1, lut, [(0, 2), (0, 20)])
+    assert len(images) == 2
+    first = decode(images[0])
+    assert first.shape == (2, 3, 4)
+    np.testing.assert_array_equal(first[1, :, :3], lut[[0, 128, 255], :3])
+    assert first[0, 2, 3] == 0
+
+
+def test_render_layer_published_block():
+    from pages.constants import FILE_DESTINATION as FD
+
+    loc = f"{FD["volumetric-map"]}/P1-20C"
+    voxels = VolumetricBlock.from_csv(f"{loc}/points_data.csv")
+    axes = make_axes(pd.read_csv(f"{loc}/vol_measurements.csv"))
+    lut = make_lut(get_colorscale("viridis"))
+    (image,) = render_layer(voxels, ["ALB"], axes, 0, lut, [(-3, 5)])
+    assert decode(image).shape == (len(axes["Y"]) - 1, len(axes["X"]) - 1, 4)
@@ -1,7 +1,17 @@
+import json
+import shutil
+import numpy as np
 import pandas as pd
 import pytest
 import os
 import sys
+import time
+from contextvars import copy_context
+from dash import Patch, no_update
+from dash._utils import to_json
+from dash._callback import GLOBAL_CALLBACK_LIST, GLOBAL_CALLBACK_MAP
+from dash._callback_context import context_value
+from dash._utils import AttributeDict
 
 if os.getcwd() not in sys.path:
     sys.path.append(os.getcwd())
@@ -14,6 +24,12 @@ from pages.spatialmap import (
     find_global_value_bounds,
     update_fig,
 )
+import pages.spatialmap as spatialmap
+from components.figure_cache import FigureCache
+from components import figures, volumetric
+from components.figures import SPHERE_VERTICES, prerender_default_views
+from pages.constants import FILE_DESTINATION as FD
+from pages.ui import C_SCHEMES, COLORSCALES
 
 D_PROTEIN = "CYB5A"
 D_SCHEME = "jet"
@@ -24,6 +40,16 @@ page_info, defaults, layers, cat_opts, value_info, axes, downloads = load_data("
 ranges = find_global_value_bounds(value_info)
 
 
+@pytest.fixture(autouse=True)
+def figure_cache(tmp_path, monkeypatch):
+    # keep figures built by one test out of the others
+    cache = FigureCache(tmp_path / "figures")
+    monkeypatch.setattr(spatialmap, "figure_cache", cache)
+    # send arrays as plain lists, so figures hold NumPy arrays that can be checked directly
+    monkeypatch.setattr(figures, "BINARY_ARRAYS", False)
+    return cache
+
+
 def test_make_defaults():
     range_data = {
         "CYB5A": [0, 1, True],
@@ -119,6 +145,15 @@ def test_load_data():
     assert downloads.equals(expected_downloads)
 
 
+def test_read_csv_keyword_arguments():
+    path = f"{FD["volumetric-map"]}/P1-20C/value_ranges.csv"
+    indexed = spatialmap.read_csv(path, index_col="Row Label")
+    plain = spatialmap.read_csv(path)
+    assert indexed.index.name == "Row Label"
+    assert "Row Label" in plain.columns
+    assert spatialmap.read_csv(path, index_col="Row Label") is indexed
+
+
 def test_find_global_value_bounds():
     test_dict = {"A": {"Min": 0, "Max": 0}, "B": {"Min": 0, "Max": 1}}
     expected_bounds = (0, 1)
@@ -135,9 +170,6 @@ def test_uf_cube_opacity():
         0.4,
         "All",
         "All",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
     fig2 = update_fig(
@@ -148,9 +180,6 @@ def test_uf_cube_opacity():
         0.4,
         "All",
         "All",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
 
@@ -165,9 +194,6 @@ def test_uf_cube_opacity():
             1,
             "All",
             "All",
-            category_data=cat_opts,
-            value_ranges=ranges,
-            axes=axes,
             block="P1-20C",
         )
 
@@ -182,24 +208,40 @@ def test_uf_cube_cscheme():
         D_OPACITY,
         "All",
         "All",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
 
-    assert fig1["data"][0]["colorscale"] == (
-        (0.0, "#000004"),
-        (0.1111111111111111, "#1b0c41"),
-        (0.2222222222222222, "#4a0c6b"),
-        (0.3333333333333333, "#781c6d"),
-        (0.4444444444444444, "#a52c60"),
-        (0.5555555555555556, "#cf4446"),
-        (0.6666666666666666, "#ed6925"),
-        (0.7777777777777778, "#fb9b06"),
-        (0.8888888888888888, "#f7d13d"),
-        (1.0, "#fcffa4"),
+    assert fig1["data"][0]["colorscale"] == [
+        [0.0, "#000004"],
+        [0.1111111111111111, "#1b0c41"],
+        [0.2222222222222222, "#4a0c6b"],
+        [0.3333333333333333, "#781c6d"],
+        [0.4444444444444444, "#a52c60"],
+        [0.5555555555555556, "#cf4446"],
+        [0.6666666666666666, "#ed6925"],
+        [0.7777777777777778, "#fb9b06"],
+        [0.8888888888888888, "#f7d13d"],
+        [1.0, "#fcffa4"],
+    ]
+
+
+@pytest.mark.parametrize("scheme", C_SCHEMES)
+def test_colorscales_match_server_figures(scheme):
+    # the scales used to restyle figures in the browser are the ones Plotly resolves
+    fig1 = update_fig(
+        "layer-tab",
+        scheme,
+        D_PROTEIN,
+        D_OPACITY,
+        D_OPACITY,
+        "Layer 1",
+        "All",
+        block="P1-20C",
     )
+    positions, colors = zip(*fig1["data"][0]["colorscale"])
+    expected_positions, expected_colors = zip(*COLORSCALES[scheme])
+    assert positions == pytest.approx(expected_positions)
+    assert colors == expected_colors
 
 
 def test_uf_cube_layer():
@@ -211,9 +253,6 @@ def test_uf_cube_layer():
         D_OPACITY,
         "All",
         "All",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
     fig2 = update_fig(
@@ -224,9 +263,6 @@ def test_uf_cube_layer():
         D_OPACITY,
         "Layer 2",
         "All",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
     assert fig1["data"][0]["z"].min() == 0.0
@@ -244,9 +280,6 @@ def test_uf_cube_islet():
         D_OPACITY,
         "All",
         "All",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
     fig2 = update_fig(
@@ -257,9 +290,6 @@ def test_uf_cube_islet():
         D_OPACITY,
         "All",
         "Pixels with islet tissue",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
     fig3 = update_fig(
@@ -270,9 +300,6 @@ def test_uf_cube_islet():
         D_OPACITY,
         "All",
         "Pixels without islet tissue",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
     assert len(fig1["data"][0]["z"]) == 1440
@@ -280,6 +307,26 @@ def test_uf_cube_islet():
     assert len(fig3["data"][0]["z"]) == 712
 
 
+def test_uf_cube_culled():
+    fig1 = update_fig(
+        "cube-tab",
+        D_SCHEME,
+        D_PROTEIN,
+        D_OPACITY,
+        D_OPACITY,
+        "All",
+        "All",
+        block="P1-20C",
+        cube_mesh=True,
+    )
+    # P1-20C fills a 9 x 5 x 4 grid, so only the 202 faces on its outside are drawn
+    assert len(fig1["data"][0]["i"]) == 404
+    assert len(fig1["data"][0]["intensity"]) == 404
+    assert fig1["data"][0]["intensitymode"] == "cell"
+    assert fig1["data"][0]["z"].min() == 0
+    assert fig1["data"][0]["z"].max() == 140
+
+
 def test_uf_point_opacity():
     # test that fig2's opacity value is updated as expected
     fig1 = update_fig(
@@ -290,9 +337,6 @@ def test_uf_point_opacity():
         0.5,
         "All",
         "All",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
     fig2 = update_fig(
@@ -303,9 +347,6 @@ def test_uf_point_opacity():
         0,
         "All",
         "All",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
 
@@ -320,9 +361,6 @@ def test_uf_point_opacity():
             11,
             "All",
             "All",
-            category_data=cat_opts,
-            value_ranges=ranges,
-            axes=axes,
             block="P1-20C",
         )
 
@@ -337,24 +375,21 @@ def test_uf_point_cscheme():
         D_OPACITY,
         "All",
         "All",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
 
-    assert fig1["data"][0]["colorscale"] == (
-        (0.0, "#000004"),
-        (0.1111111111111111, "#1b0c41"),
-        (0.2222222222222222, "#4a0c6b"),
-        (0.3333333333333333, "#781c6d"),
-        (0.4444444444444444, "#a52c60"),
-        (0.5555555555555556, "#cf4446"),
-        (0.6666666666666666, "#ed6925"),
-        (0.7777777777777778, "#fb9b06"),
-        (0.8888888888888888, "#f7d13d"),
-        (1.0, "#fcffa4"),
-    )
+    assert fig1["data"][0]["colorscale"] == [
+        [0.0, "#000004"],
+        [0.1111111111111111, "#1b0c41"],
+        [0.2222222222222222, "#4a0c6b"],
+        [0.3333333333333333, "#781c6d"],
+        [0.4444444444444444, "#a52c60"],
+        [0.5555555555555556, "#cf4446"],
+        [0.6666666666666666, "#ed6925"],
+        [0.7777777777777778, "#fb9b06"],
+        [0.8888888888888888, "#f7d13d"],
+        [1.0, "#fcffa4"],
+    ]
 
 
 def test_uf_point_layer():
@@ -366,9 +401,6 @@ def test_uf_point_layer():
         D_OPACITY,
         "All",
         "All",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
     fig2 = update_fig(
@@ -379,9 +411,6 @@ def test_uf_point_layer():
         D_OPACITY,
         "Layer 3",
         "All",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
     assert fig1["data"][0]["z"].min() == 17.5
@@ -400,24 +429,21 @@ def test_uf_layer_cscheme():
         D_OPACITY,
         "All",
         "All",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
 
-    assert fig1["data"][0]["colorscale"] == (
-        (0.0, "#000004"),
-        (0.1111111111111111, "#1b0c41"),
-        (0.2222222222222222, "#4a0c6b"),
-        (0.3333333333333333, "#781c6d"),
-        (0.4444444444444444, "#a52c60"),
-        (0.5555555555555556, "#cf4446"),
-        (0.6666666666666666, "#ed6925"),
-        (0.7777777777777778, "#fb9b06"),
-        (0.8888888888888888, "#f7d13d"),
-        (1.0, "#fcffa4"),
-    )
+    assert fig1["data"][0]["colorscale"] == [
+        [0.0, "#000004"],
+        [0.1111111111111111, "#1b0c41"],
+        [0.2222222222222222, "#4a0c6b"],
+        [0.3333333333333333, "#781c6d"],
+        [0.4444444444444444, "#a52c60"],
+        [0.5555555555555556, "#cf4446"],
+        [0.6666666666666666, "#ed6925"],
+        [0.7777777777777778, "#fb9b06"],
+        [0.8888888888888888, "#f7d13d"],
+        [1.0, "#fcffa4"],
+    ]
 
 
 def test_uf_layer_layer():
@@ -429,9 +455,6 @@ def test_uf_layer_layer():
         D_OPACITY,
         "All",
         "All",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
     fig2 = update_fig(
@@ -442,9 +465,6 @@ def test_uf_layer_layer():
         D_OPACITY,
         "Layer 2",
         "All",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
     f1l1maxes = []
@@ -484,24 +504,24 @@ def test_uf_sphere_cscheme():
         D_OPACITY,
         "All",
         "All",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
 
-    assert fig1["data"][0]["colorscale"] == (
-        (0.0, "#000004"),
-        (0.1111111111111111, "#1b0c41"),
-        (0.2222222222222222, "#4a0c6b"),
-        (0.3333333333333333, "#781c6d"),
-        (0.4444444444444444, "#a52c60"),
-        (0.5555555555555556, "#cf4446"),
-        (0.6666666666666666, "#ed6925"),
-        (0.7777777777777778, "#fb9b06"),
-        (0.8888888888888888, "#f7d13d"),
-        (1.0, "#fcffa4"),
-    )
+    assert fig1["data"][0]["colorscale"] == [
+        [0.0, "#000004"],
+        [0.1111111111111111, "#1b0c41"],
+        [0.2222222222222222, "#4a0c6b"],
+        [0.3333333333333333, "#781c6d"],
+        [0.4444444444444444, "#a52c60"],
+        [0.5555555555555556, "#cf4446"],
+        [0.6666666666666666, "#ed6925"],
+        [0.7777777777777778, "#fb9b06"],
+        [0.8888888888888888, "#f7d13d"],
+        [1.0, "#fcffa4"],
+    ]
+    # hover labels read the values from the intensity array rather than a copy of it
+    assert "customdata" not in fig1["data"][0]
+    assert "%{intensity" in fig1["data"][0]["hovertemplate"]
 
 
 def test_uf_sphere_layer():
@@ -513,9 +533,6 @@ def test_uf_sphere_layer():
         D_OPACITY,
         "All",
         "All",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
     fig2 = update_fig(
@@ -526,13 +543,10 @@ def test_uf_sphere_layer():
         D_OPACITY,
         "Layer 4",
         "All",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
     assert fig1["data"][0]["z"].min() == 3.5
-    assert fig1["data"][0]["z"].max() == 31.5
+    assert fig1["data"][0]["z"].max() == 136.5
     assert fig2["data"][0]["z"].min() == 108.5
     assert fig2["data"][0]["z"].max() == 136.5
 
@@ -546,9 +560,6 @@ def test_uf_sphere_islet():
         D_OPACITY,
         "All",
         "All",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
     fig2 = update_fig(
@@ -559,9 +570,6 @@ def test_uf_sphere_islet():
         D_OPACITY,
         "All",
         "Pixels with islet tissue",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
     fig3 = update_fig(
@@ -572,15 +580,15 @@ def test_uf_sphere_islet():
         D_OPACITY,
         "All",
         "Pixels without islet tissue",
-        category_data=cat_opts,
-        value_ranges=ranges,
-        axes=axes,
         block="P1-20C",
     )
 
-    assert len(fig1["data"]) == 177
-    assert len(fig2["data"]) == 91
-    assert len(fig3["data"]) == 86
+    # all spheres are drawn in one trace
+    vertices_per_sphere = SPHERE_VERTICES.shape[0]
+    assert len(fig1["data"]) == 1
+    assert len(fig1["data"][0]["x"]) == 177 * vertices_per_sphere
+    assert len(fig2["data"][0]["x"]) == 91 * vertices_per_sphere
+    assert len(fig3["data"][0]["x"]) == 86 * vertices_per_sphere
 
 
 def test_uo_protein():
@@ -593,11 +601,493 @@ def test_uo_protein():
         D_OPACITY,
         "All",
         "All",
-        category_data=cat_opts,
-        value_ranges=(0, 1),
-        axes=axes,
         block="P1-20C",
     )
 
     assert min(fig1["data"][0]["intensity"]) == value_info["ALB"]["Min"]
     assert max(fig1["data"][0]["intensity"]) == value_info["ALB"]["Max"]
+
+
+def update_fig_triggered_by(prop_ids, *args, **kwargs):
+    # run update_fig as if Dash had called it after prop_ids changed
+    def run():
+        context_value.set(
+            AttributeDict(
+                triggered_inputs=[{"prop_id": p, "value": None} for p in prop_ids]
+            )
+        )
+        return update_fig(*args, **kwargs)
+
+    return copy_context().run(run)
+
+
+@pytest.mark.parametrize(
+    "tab,prop", [("cube-tab", "intensity"), ("layer-tab", "surfacecolor")]
+)
+def test_uf_protein_patch(tab, prop):
+    args = [tab, D_SCHEME, "ALB", D_OPACITY, D_OPACITY, "All", "All"]
+    kwargs = dict(block="P1-20C")
+    fig = update_fig(*args, **kwargs)
+    patch = update_fig_triggered_by(["value-store.data"], *args, **kwargs)
+
+    assert isinstance(patch, Patch)
+    operations = patch.to_plotly_json()["operations"]
+    assert len(operations) == 3 * len(fig["data"])
+    values = [op for op in operations if op["location"][-1] == prop]
+    assert len(values) == len(fig["data"])
+    for i, operation in enumerate(values):
+        assert operation["location"] == ["data", i, prop]
+        np.testing.assert_array_equal(
+            operation["params"]["value"], fig["data"][i][prop]
+        )
+
+
+@pytest.mark.parametrize(
+    "tab,props",
+    [("cube-tab", ["cmin", "cmax"]), ("point-tab", ["isomin", "isomax"])],
+)
+@pytest.mark.parametrize("color_range", ["protein", "robust"])
+def test_uf_protein_patch_color_range(block_with_stats, tab, props, color_range):
+    # proteins have their own ranges, so a protein change also moves the color range
+    stats = block_with_stats
+    kwargs = dict(block="P1-20C", color_range=color_range)
+    args = [tab, D_SCHEME, "CYB5A", D_OPACITY, D_OPACITY, "All", "All"]
+    update_fig(*args, **kwargs)
+    args[2] = "ALB"
+    patch = update_fig_triggered_by(["value-store.data"], *args, **kwargs)
+
+    patched = {
+        op["location"][-1]: op["params"]["value"]
+        for op in patch.to_plotly_json()["operations"]
+        if op["location"][-1] in props
+    }
+    expected = volumetric.stats_value_range(stats, "ALB", color_range, ranges)
+    assert [patched[p] for p in props] == pytest.approx(list(expected))
+    assert patched[props[1]] > stats.loc["Max", "CYB5A"]
+
+
+def test_uf_layer_patch():
+    args = ["point-tab", D_SCHEME, D_PROTEIN, D_OPACITY, D_OPACITY, "Layer 2", "All"]
+    kwargs = dict(block="P1-20C")
+    patch = update_fig_triggered_by(["layer-store-sm.data"], *args, **kwargs)
+    operation, title = patch.to_plotly_json()["operations"]
+    assert operation["location"] == ["data"]
+    assert operation["params"]["value"][0]["z"].min() == 52.5
+    assert title["location"] == ["layout", "title"]
+
+    # the first load is triggered by several stores at once and sends the whole figure
+    fig = update_fig_triggered_by(
+        ["value-store.data", "layer-store-sm.data", "category-selected.data"],
+        *args,
+        **kwargs,
+    )
+    assert fig["layout"]["scene"]["zaxis"]["range"] == [0, 140]
+
+
+@pytest.mark.parametrize(
+    "output",
+    [
+        "category-selected.data",
+        "value-store.data",
+        "color-store-sm.data",
+        "layer-store-sm.data",
+        "cube-opacity-store-sm.data",
+        "point-opacity-store-sm.data",
+        "cube-mesh-store-sm.data",
+        "color-range-store-sm.data",
+        "roi-store-sm.data",
+        "threshold-store-sm.data",
+        "slice-store-sm.data",
+        "graph-view.hidden",
+        "navbar-collapse.is_open",
+        "breadcrumb.children",
+    ],
+)
+def test_ui_only_callbacks_are_clientside(output):
+    callbacks = [cb for key, cb in GLOBAL_CALLBACK_MAP.items() if output in key]
+    assert len(callbacks) == 1
+    # server callbacks keep a reference to their Python function
+    assert "callback" not in callbacks[0]
+
+
+def test_uf_figure_cache(figure_cache):
+    args = ["cube-tab", D_SCHEME, D_PROTEIN, D_OPACITY, D_OPACITY, "Layer 2", "All"]
+    kwargs = dict(block="P1-20C")
+    fig1 = update_fig(*args, **kwargs)
+    assert figure_cache.stats() == {"hits": 0, "misses": 1}
+    fig2 = update_fig(*args, **kwargs)
+    assert figure_cache.stats() == {"hits": 1, "misses": 1}
+    assert json.loads(to_json(fig2)) == json.loads(to_json(fig1))
+    np.testing.assert_array_equal(fig2["data"][0]["i"], fig1["data"][0]["i"])
+
+    # the point opacity does not change the cube view
+    update_fig(*args[:4], 0.9, *args[5:], **kwargs)
+    assert figure_cache.stats() == {"hits": 2, "misses": 1}
+    update_fig(*args[:3], 0.9, *args[4:], **kwargs)
+    assert figure_cache.stats() == {"hits": 2, "misses": 2}
+
+
+def test_uf_figure_cache_hit_is_cheaper_than_build(monkeypatch, figure_cache):
+    monkeypatch.setattr(figures, "BINARY_ARRAYS", True)
+    args = ["sphere-tab", D_SCHEME, D_PROTEIN, D_OPACITY, D_OPACITY, "All", "All"]
+    # load the block's data, so that only building the figure is timed
+    update_fig(*args, block="P1-20C", color_range="protein")
+
+    start = time.perf_counter()
+    built = update_fig(*args, block="P1-20C")
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    cached = update_fig(*args, block="P1-20C")
+    hit_time = time.perf_counter() - start
+    assert figure_cache.stats() == {"hits": 1, "misses": 2}
+    assert cached == json.loads(to_json(built))
+    assert hit_time < build_time
+
+
+def test_uf_reads_block_data_on_server():
+    # figures are shared by every session, so none of their inputs may come from stores
+    # that the browser could change
+    callback = GLOBAL_CALLBACK_MAP["volumetric-map-graph.figure"]
+    states = {state["id"] for state in callback["state"]}
+    assert states.isdisjoint({"category-store", "value-range-store", "axes-store"})
+
+    fig = update_fig("cube-tab", D_SCHEME, D_PROTEIN, 0.4, 0.1, "All", "All", "P1-20C")
+    assert (fig["data"][0]["cmin"], fig["data"][0]["cmax"]) == ranges
+
+
+def test_uf_prerendered_default_views(tmp_path, monkeypatch, figure_cache):
+    shutil.copytree(f"{FD['volumetric-map']}/P1-20C", tmp_path / "P1-20C")
+    monkeypatch.setitem(FD, "volumetric-map", str(tmp_path))
+    paths = prerender_default_views(tmp_path / "P1-20C")
+    assert len(paths) == len(figures.VIEW_PARAMS)
+
+    kwargs = dict(block="P1-20C")
+    fig = update_fig("cube-tab", "haline", D_PROTEIN, 0.4, 0.1, "All", "All", **kwargs)
+    assert figure_cache.stats() == {"hits": 0, "misses": 0}
+    np.testing.assert_array_equal(
+        fig["data"][0]["intensity"],
+        update_fig("cube-tab", "haline", D_PROTEIN, 0.4, 0.1, "All", "All", **kwargs)[
+            "data"
+        ][0]["intensity"],
+    )
+
+    # figures prerendered by a release that drew them differently are not served
+    monkeypatch.setattr(figures, "RENDER_VERSION", figures.RENDER_VERSION + 1)
+    update_fig("cube-tab", "haline", D_PROTEIN, 0.4, 0.1, "All", "All", **kwargs)
+    assert figure_cache.stats() == {"hits": 0, "misses": 1}
+    monkeypatch.setattr(figures, "RENDER_VERSION", figures.RENDER_VERSION - 1)
+
+    # other settings and republished data are built as usual
+    update_fig("cube-tab", "jet", D_PROTEIN, 0.4, 0.1, "All", "All", **kwargs)
+    assert figure_cache.stats() == {"hits": 0, "misses": 2}
+    os.utime(tmp_path / "P1-20C" / "points_data.csv", ns=(0, 0))
+    update_fig("cube-tab", "haline", D_PROTEIN, 0.4, 0.1, "All", "All", **kwargs)
+    assert figure_cache.stats() == {"hits": 0, "misses": 3}
+
+
+def test_uf_binary_arrays(monkeypatch):
+    monkeypatch.setattr(figures, "BINARY_ARRAYS", True)
+    args = ["cube-tab", D_SCHEME, D_PROTEIN, D_OPACITY, D_OPACITY, "All", "All"]
+    kwargs = dict(block="P1-20C")
+    encoded = update_fig(*args, **kwargs)
+    assert encoded["data"][0]["x"]["dtype"] == "f4"
+    assert encoded["data"][0]["i"]["dtype"] == "u2"
+
+    monkeypatch.setattr(figures, "BINARY_ARRAYS", False)
+    fig = update_fig(*args, **kwargs)
+    assert len(to_json(encoded)) < len(to_json(fig))
+
+
+def test_uf_level_of_detail(monkeypatch):
+    monkeypatch.setattr(figures, "VOXEL_BUDGET", 100)
+    kwargs = dict(block="P1-20C")
+    # 180 voxels are drawn as the averages of 2 x 2 x 2 blocks
+    fig1 = update_fig("cube-tab", D_SCHEME, D_PROTEIN, 0.4, 0.1, "All", "All", **kwargs)
+    fig2 = update_fig(
+        "point-tab", D_SCHEME, D_PROTEIN, 0.4, 0.1, "All", "All", **kwargs
+    )
+    assert len(fig1["data"][0]["x"]) == 30 * 8
+    assert len(fig2["data"][0]["x"]) == 30
+    assert "Averaged over 2" in fig1["layout"]["title"]["text"]
+    assert fig1["data"][0]["z"].min() == 0
+    assert fig1["data"][0]["z"].max() == pytest.approx(140, abs=0.01)
+
+    # a single layer is drawn at full resolution
+    fig3 = update_fig(
+        "cube-tab", D_SCHEME, D_PROTEIN, 0.4, 0.1, "Layer 2", "All", **kwargs
+    )
+    assert len(fig3["data"][0]["x"]) == 45 * 8
+    assert "title" not in fig3["layout"]
+
+
+@pytest.fixture
+def block_with_stats(tmp_path, monkeypatch):
+    block_dir = tmp_path / "P1-20C"
+    shutil.copytree(f"{FD['volumetric-map']}/P1-20C", block_dir)
+    monkeypatch.setitem(FD, "volumetric-map", str(tmp_path))
+    points = pd.read_csv(block_dir / "points_data.csv")
+    stats = volumetric.value_stats(points, list(value_info))
+    stats.to_csv(block_dir / "value_stats.csv")
+    return stats
+
+
+def test_uf_color_range(block_with_stats):
+    stats = block_with_stats
+    kwargs = dict(block="P1-20C")
+    args = ["cube-tab", D_SCHEME, "ALB", D_OPACITY, D_OPACITY, "All", "All"]
+    fig = update_fig(*args, **kwargs)
+    assert (fig["data"][0]["cmin"], fig["data"][0]["cmax"]) == ranges
+
+    fig = update_fig(*args, **kwargs, color_range="protein")
+    assert fig["data"][0]["cmin"] == pytest.approx(stats.loc["Min", "ALB"])
+    assert fig["data"][0]["cmax"] == pytest.approx(stats.loc["Max", "ALB"])
+
+    args[0] = "point-tab"
+    fig = update_fig(*args, **kwargs, color_range="robust")
+    assert fig["data"][0]["isomin"] == pytest.approx(stats.loc["Q01", "ALB"])
+    assert fig["data"][0]["isomax"] == pytest.approx(stats.loc["Q99", "ALB"])
+
+
+def test_color_range_without_stats():
+    kwargs = dict(block="P1-20C")
+    fig = update_fig(
+        "cube-tab",
+        D_SCHEME,
+        "ALB",
+        0.4,
+        0.1,
+        "All",
+        "All",
+        **kwargs,
+        color_range="robust",
+    )
+    assert (fig["data"][0]["cmin"], fig["data"][0]["cmax"]) == ranges
+    assert spatialmap.update_histogram("ALB", "robust", ranges, "P1-20C") == {}
+
+
+def test_update_histogram(block_with_stats):
+    fig = spatialmap.update_histogram("TF", "protein", ranges, "P1-20C")
+    points = pd.read_csv(f"{FD['volumetric-map']}/P1-20C/points_data.csv")
+    assert fig["data"][0]["y"].sum() == points["TF"].count()
+    (shape,) = fig["layout"]["shapes"]
+    assert (shape["x0"], shape["x1"]) == pytest.approx(
+        (points["TF"].min(), points["TF"].max())
+    )
+
+
+def test_display_voxel_details():
+    blank = spatialmap.display_voxel_details(None, D_PROTEIN, "P1-20C")
+    assert "Click on a voxel" in str(blank)
+
+    # a vertex of the first voxel's cube, as sent by a click on the cube view
+    fig = update_fig(
+        "cube-tab",
+        D_SCHEME,
+        D_PROTEIN,
+        D_OPACITY,
+        D_OPACITY,
+        "All",
+        "All",
+        block="P1-20C",
+    )
+    point = {a: float(fig["data"][0][a][7]) for a in "xyz"}
+    card = spatialmap.display_voxel_details(
+        {"points": [{**point, "pointNumber": 7}]}, "TF", "P1-20C"
+    )
+    text = str(card)
+    assert "Voxel 1" in text
+    assert "246, 274.5, 17.5" in text
+    assert "Pixels without islet tissue" in text
+    assert "0.899453" in text
+    # the selected protein comes first
+    assert text.index("TF") < text.index("CYB5A")
+
+    # the grid is sized by the block's files rather than by axes sent from the browser
+    states = GLOBAL_CALLBACK_MAP["voxel-details.children"]["state"]
+    assert {state["id"] for state in states}.isdisjoint(
+        {"axes-store", "category-store"}
+    )
+
+
+def test_display_voxel_details_in_selection():
+    # the top face of a voxel in layer 2 is also the bottom face of the voxel above it,
+    # which is hidden while layer 2 is selected
+    voxels = spatialmap.read_voxels("P1-20C", "points_data")
+    rows = voxels.select("Layer 2", axes["Z"])
+    above = voxels.row_grid(axes)[
+        tuple(voxels.grid_cells(axes)[rows].T + [[0], [0], [1]])
+    ]
+    row, hidden = rows[above >= 0][0], above[above >= 0][0]
+    click = {"points": [{"x": voxels.x[row], "y": voxels.y[row], "z": axes["Z"][2]}]}
+    args = [click, D_PROTEIN, "P1-20C"]
+
+    def center(r):
+        return f"{voxels.x[r]:g}, {voxels.y[r]:g}, {voxels.z[r]:g}"
+
+    text = str(spatialmap.display_voxel_details(*args, "cube-tab", "Layer 2", "All"))
+    assert center(row) in text
+    text = str(spatialmap.display_voxel_details(*args, "cube-tab", "All", "All"))
+    assert center(hidden) in text
+
+
+@pytest.mark.parametrize(
+    "tab,prop",
+    [
+        ("cube-tab", "intensity"),
+        ("point-tab", "value"),
+        ("layer-tab", "surfacecolor"),
+        ("sphere-tab", "intensity"),
+    ],
+)
+def test_uf_roi(tab, prop):
+    kwargs = dict(block="P1-20C")
+    args = [tab, D_SCHEME, "ALB", D_OPACITY, D_OPACITY, "All", "All"]
+    full = update_fig(*args, **kwargs)
+    roi = {"X": [221, 371], "Y": [248, 513], "Z": [35, 140]}
+    cropped = update_fig(*args, **kwargs, roi=roi)
+
+    values = np.concatenate([np.ravel(trace[prop]) for trace in cropped["data"]])
+    full_values = np.concatenate([np.ravel(trace[prop]) for trace in full["data"]])
+    assert np.count_nonzero(~np.isnan(values)) < np.count_nonzero(
+        ~np.isnan(full_values)
+    )
+    if tab != "layer-tab":
+        assert cropped["data"][0]["x"].max() <= 371
+        assert cropped["data"][0]["z"].min() >= 35 - 17.5
+
+
+def test_uf_isosurface():
+    kwargs = dict(block="P1-20C")
+    args = ["iso-tab", D_SCHEME, "ALB", D_OPACITY, D_OPACITY, "All", "All"]
+    fig = update_fig(*args, **kwargs, threshold=1.0)
+    (trace,) = fig["data"]
+    assert trace["type"] == "mesh3d"
+    assert 0 < len(trace["i"]) < 5000
+    assert (trace["intensity"] == 1.0).all()
+    # the surface stays within half a voxel of the block
+    assert trace["x"].min() >= axes["X"][0] - 25
+    assert trace["z"].max() <= axes["Z"][-1] + 17.5
+
+    # a protein change rebuilds the surface instead of patching its values
+    patch = update_fig_triggered_by(
+        ["value-store.data"], *args, **kwargs, threshold=1.0
+    )
+    assert patch.to_plotly_json()["operations"][0]["location"] == ["data"]
+
+    empty = update_fig(*args, **kwargs, threshold=100)
+    assert len(empty["data"][0]["x"]) == 0
+    assert "No voxels" in empty["layout"]["title"]["text"]
+
+
+def prevents_initial_call(output):
+    (callback,) = [c for c in GLOBAL_CALLBACK_LIST if c["output"] == output]
+    return callback["prevent_initial_call"]
+
+
+def test_update_controls_isosurface(tmp_path, monkeypatch):
+    args = ["iso-tab", "All", cat_opts, 0.1, 0.4, False, None, "ALB"]
+    controls = spatialmap.update_controls(*args, "global", None, axes, "P1-20C")
+    assert f"value={(ranges[0] + ranges[1]) / 2}" in str(controls)
+
+    # the slider spans the protein's own range, as the figure does
+    shutil.copytree(f"{FD['volumetric-map']}/P1-20C", tmp_path / "P1-20C")
+    monkeypatch.setitem(FD, "volumetric-map", str(tmp_path))
+    points = pd.read_csv(tmp_path / "P1-20C" / "points_data.csv")
+    stats = volumetric.value_stats(points, ["ALB"])
+    stats.to_csv(tmp_path / "P1-20C" / "value_stats.csv")
+    controls = spatialmap.update_controls(*args, "protein", None, axes, "P1-20C")
+    low, high = stats.loc["Min", "ALB"], stats.loc["Max", "ALB"]
+    assert f"min={low}" in str(controls) and f"max={high}" in str(controls)
+    assert f"value={(low + high) / 2}" in str(controls)
+
+    # the threshold is stored once the slider is moved, not when it is created
+    assert prevents_initial_call("threshold-store-sm.data")
+
+
+def test_update_slices():
+    spatialmap.render_slices.cache_clear()
+    args = ["slice-tab", "ALB", D_SCHEME, 2, "global", None, ranges, axes, "P1-20C"]
+    browser = spatialmap.update_slices(*args)
+    text = str(browser)
+    assert "ALB, layer 2" in text
+    # one image of the selected protein and one of every protein
+    assert text.count("data:image/png;base64,") == len(value_info) + 1
+
+    spatialmap.update_slices(*args)
+    assert spatialmap.render_slices.cache_info().hits == 1
+
+    # the 3D views are left alone while the slice view is open
+    assert update_fig("slice-tab", block="P1-20C") is no_update
+    assert spatialmap.update_slices("cube-tab", *args[1:]) is no_update
+
+
+@pytest.mark.parametrize(
+    "color, layer", [("no-such-scheme", 2), (D_SCHEME, -1), (D_SCHEME, 99)]
+)
+def test_update_slices_invalid(color, layer):
+    args = ["slice-tab", "ALB", color, layer, "global", None, ranges, axes, "P1-20C"]
+    assert spatialmap.update_slices(*args) is no_update
+
+
+def test_control_stores_skip_initial_call():
+    # controls are created from their stores' values, which do not need storing again
+    for output in ["category-selected.data", "cube-mesh-store-sm.data"]:
+        assert prevents_initial_call(output)
+
+
+def test_update_controls_slices():
+    controls = spatialmap.update_controls(
+        "slice-tab", "All", cat_opts, 0.1, 0.4, False, None, "ALB", "global", 3, axes
+    )
+    assert "value=3" in str(controls)
+    assert f"max={len(axes['Z']) - 1}" in str(controls)
+
+
+def test_read_voxels_from_vti(tmp_path, monkeypatch):
+    block_dir = tmp_path / "P1-20C"
+    shutil.copytree(f"{FD['volumetric-map']}/P1-20C", block_dir)
+    monkeypatch.setitem(FD, "volumetric-map", str(tmp_path))
+    (block_dir / "HubMAP_TMC_p1_20C_3D_protINT_May8_sorted.vti").rename(
+        block_dir / "points_data.vti"
+    )
+    voxels = spatialmap.read_voxels("P1-20C", "points_data")
+    assert "ABCC3" in voxels.columns
+
+    kwargs = dict(block="P1-20C")
+    fig = update_fig("layer-tab", D_SCHEME, "ALB", 0.4, 0.1, "Layer 2", "All", **kwargs)
+    expected = volumetric.VolumetricBlock.from_csv(block_dir / "points_data.csv")
+    np.testing.assert_allclose(
+        fig["data"][0]["surfacecolor"],
+        expected.grid("ALB", axes)[:, :, 1].T,
+        rtol=1e-6,
+    )
+
+    # the image has no Category array, so no voxel is in either category
+    islet = "Pixels with islet tissue"
+    for tab in ["cube-tab", "sphere-tab"]:
+        fig = update_fig(tab, D_SCHEME, "ALB", 0.4, 0.1, "All", islet, **kwargs)
+        assert len(fig["data"][0]["x"]) == 0
+
+
+def test_read_voxels_latest_upload(tmp_path, monkeypatch):
+    # the portal writes a column archive for every spreadsheet it ingests, next to which
+    # an image of the block can be uploaded later, or the other way around
+    block_dir = tmp_path / "P1-20C"
+    shutil.copytree(f"{FD['volumetric-map']}/P1-20C", block_dir)
+    monkeypatch.setitem(FD, "volumetric-map", str(tmp_path))
+    points = pd.read_csv(block_dir / "points_data.csv")
+    volumetric.write_columns(points.assign(ALB=0.0), block_dir / "points_data.npz")
+    (block_dir / "HubMAP_TMC_p1_20C_3D_protINT_May8_sorted.vti").rename(
+        block_dir / "points_data.vti"
+    )
+    os.utime(block_dir / "points_data.npz", ns=(10**18, 10**18))
+    os.utime(block_dir / "points_data.vti", ns=(2 * 10**18, 2 * 10**18))
+
+    voxels = spatialmap.read_voxels("P1-20C", "points_data")
+    assert voxels.column("ALB").any()
+    first = [open(path).read() for path in prerender_default_views(block_dir)]
+
+    os.utime(block_dir / "points_data.npz", ns=(3 * 10**18, 3 * 10**18))
+    voxels = spatialmap.read_voxels("P1-20C", "points_data")
+    assert not voxels.column("ALB").any()
+    assert first != [open(path).read() for path in prerender_default_views(block_dir)]
@@ -0,0 +1,479 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+if os.getcwd() not in sys.path:
+    sys.path.append(os.getcwd())
+from components.volumetric import (
+    BlockCache,
+    Memo,
+    SparseColumn,
+    VolumetricBlock,
+    block_average,
+    cell_cube_vertices,
+    coarse_axes,
+    compact_column,
+    culled_cube_mesh,
+    expand_cube_vertices,
+    isosurface_mesh,
+    make_axes,
+    map_member,
+    read_columns,
+    stats_value_range,
+    value_stats,
+    write_columns,
+)
+
+POINTS = pd.DataFrame(
+    {
+        "Block ID": [1, 2, 3, 4],
+        "X Center": [25, 75, 25, 75],
+        "Y Center": [25, 25, 25, 25],
+        "Z Center": [5, 5, 15, 15],
+        "Category": [True, False, False, True],
+        "CYB5A": [0.5, np.nan, 1.5, 2.5],
+        "ALB": [1.0, 2.0, 3.0, 4.0],
+    }
+)
+Z_AXIS = [0, 10, 20]
+LABELS = {
+    "Category": "Islet",
+    "Label (Only True)": "Pixels with islet tissue",
+    "Label (Only False)": "Pixels without islet tissue",
+}
+
+
+def test_block_cache_reuses_entry(tmp_path):
+    path = tmp_path / "a.csv"
+    path.write_text("1")
+    loads = []
+    cache = BlockCache(max_entries=2)
+    first = cache.get(path, lambda p: loads.append(p) or object())
+    second = cache.get(path, lambda p: loads.append(p) or object())
+    assert first is second
+    assert len(loads) == 1
+
+
+def test_block_cache_invalidates_on_change(tmp_path):
+    path = tmp_path / "a.csv"
+    path.write_text("1")
+    cache = BlockCache()
+    assert cache.get(path, lambda p: p.read_text()) == "1"
+    path.write_text("22")
+    os.utime(path, ns=(0, 0))
+    assert cache.get(path, lambda p: p.read_text()) == "22"
+
+
+def test_block_cache_evicts_least_recently_used(tmp_path):
+    paths = []
+    for name in ["a", "b", "c"]:
+        paths.append(tmp_path / name)
+        paths[-1].write_text(name)
+    cache = BlockCache(max_entries=2)
+    cache.get(paths[0], lambda p: p.read_text())
+    cache.get(paths[1], lambda p: p.read_text())
+    # touch a so that b becomes the oldest entry
+    cache.get(paths[0], lambda p: pytest.fail("a should be cached"))
+    cache.get(paths[2], lambda p: p.read_text())
+    assert len(cache) == 2
+    assert cache.get(paths[0], lambda p: "reloaded") == "a"
+    assert cache.get(paths[1], lambda p: "reloaded") == "reloaded"
+
+
+def test_block_cache_missing_file(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        BlockCache().get(tmp_path / "missing.csv", lambda p: p.read_text())
+
+
+def test_memo_evicts_least_recently_used():
+    memo = Memo(max_entries=2)
+    a = memo.get("a", lambda: np.zeros(4))
+    memo.get("b", lambda: [np.zeros(2), {"c": np.zeros(1)}])
+    # touch a so that b becomes the oldest entry
+    assert memo.get("a", lambda: pytest.fail("a should be cached")) is a
+    assert memo.nbytes == 4 * 8 + 2 * 8 + 8
+    memo.get("c", lambda: np.zeros(1))
+    assert len(memo) == 2
+    assert memo.get("b", lambda: "rebuilt") == "rebuilt"
+
+
+def test_volumetric_block_bounds_derived_arrays(monkeypatch):
+    monkeypatch.setattr(VolumetricBlock, "MAX_GRIDS", 2)
+    voxels = VolumetricBlock.from_dataframe(POINTS)
+    axes = {"X": [0, 50, 100], "Y": [0, 50], "Z": Z_AXIS}
+    for name in ["CYB5A", "ALB", "Category"]:
+        voxels.grid(name, axes)
+    assert len(voxels._grids) == 2
+    # float32 grids of the last two columns, and the cells they were scattered to
+    assert voxels.cache_nbytes == 2 * 4 * 4 + voxels.grid_cells(axes).nbytes
+
+
+def test_column_archive_round_trip(tmp_path):
+    df = pd.DataFrame(
+        {
+            "Block ID": [1, 2],
+            "X Center": [246, 296],
+            "Z Center": [17.5, 52.5],
+            "Category": [True, False],
+            "CYB5A": [0.899453, np.nan],
+            "Note/label": ["a", "b"],
+        }
+    )
+    write_columns(df, tmp_path / "points_data.npz")
+    result = read_columns(tmp_path / "points_data.npz")
+    pd.testing.assert_frame_equal(result, df, check_dtype=False, rtol=1e-6)
+    assert result["Category"].dtype == bool
+    assert result["Z Center"].dtype == np.float64
+    assert result["CYB5A"].dtype == np.float32
+
+
+def test_sparse_column():
+    array = np.full(20, np.nan)
+    array[[3, 17]] = [0.25, 1.5]
+    assert isinstance(compact_column("Z Center", array), np.ndarray)
+    sparse = compact_column("CYB5A", array)
+    assert isinstance(sparse, SparseColumn)
+    assert sparse.nbytes == 3 + 2 * 4
+    np.testing.assert_array_equal(sparse.dense(), array)
+    assert compact_column("ALB", np.arange(4.0)).dtype == np.float32
+
+
+def test_volumetric_block_sparse_columns(tmp_path):
+    points = POINTS.assign(TF=[np.nan, np.nan, 0.75, np.nan])
+    write_columns(points, tmp_path / "points_data.npz")
+    with np.load(tmp_path / "points_data.npz") as npz:
+        assert {"c7_valid", "c7_values"} <= set(npz.files)
+        assert "c7" not in npz.files
+    voxels = VolumetricBlock.from_archive(tmp_path / "points_data.npz")
+    assert isinstance(voxels._read_column("TF"), SparseColumn)
+    np.testing.assert_array_equal(voxels.column("TF"), points["TF"].to_numpy())
+    # only one sparse column is kept dense at a time
+    assert voxels.column("TF") is voxels.column("TF")
+    assert voxels.nbytes == 3 * 4 * 8 + 1 + 4
+
+
+@pytest.mark.parametrize("source", ["archive", "csv"])
+def test_volumetric_block_loads_columns_on_demand(tmp_path, source):
+    if source == "archive":
+        write_columns(POINTS, tmp_path / "points_data.npz")
+        voxels = VolumetricBlock.from_archive(tmp_path / "points_data.npz")
+    else:
+        POINTS.to_csv(tmp_path / "points_data.csv", index=False)
+        voxels = VolumetricBlock.from_csv(tmp_path / "points_data.csv")
+    assert len(voxels) == 4
+    assert list(voxels._loaded) == ["X Center", "Y Center", "Z Center"]
+    np.testing.assert_array_equal(voxels.column("ALB"), POINTS["ALB"].to_numpy())
+    assert "CYB5A" not in voxels._loaded
+    with pytest.raises(KeyError):
+        voxels.column("TF")
+
+
+def test_volumetric_block_parses_csv_once(tmp_path, monkeypatch):
+    POINTS.to_csv(tmp_path / "points_data.csv", index=False)
+    parses = []
+    read_csv = pd.read_csv
+
+    def counting_read_csv(*args, **kwargs):
+        if kwargs.get("nrows") != 0:
+            parses.append(kwargs)
+        return read_csv(*args, **kwargs)
+
+    monkeypatch.setattr(pd, "read_csv", counting_read_csv)
+    voxels = VolumetricBlock.from_csv(tmp_path / "points_data.csv")
+    for name in POINTS.columns:
+        np.testing.assert_array_equal(voxels.column(name), POINTS[name].to_numpy())
+    assert len(parses) == 1
+
+
+def test_volumetric_block_select():
+    voxels = VolumetricBlock.from_dataframe(POINTS)
+    np.testing.assert_array_equal(voxels.select("All", Z_AXIS), [0, 1, 2, 3])
+    np.testing.assert_array_equal(voxels.select("Layer 2", Z_AXIS), [2, 3])
+    np.testing.assert_array_equal(
+        voxels.select("All", Z_AXIS, "Pixels with islet tissue", LABELS), [0, 3]
+    )
+    np.testing.assert_array_equal(
+        voxels.select("Layer 1", Z_AXIS, "Pixels without islet tissue", LABELS), [1]
+    )
+
+
+def test_map_member(tmp_path):
+    write_columns(POINTS, tmp_path / "points_data.npz")
+    mapped = map_member(tmp_path / "points_data.npz", "c5")
+    assert isinstance(mapped, np.memmap)
+    assert not mapped.flags.writeable
+    np.testing.assert_array_equal(mapped, POINTS["CYB5A"].to_numpy())
+
+    np.savez_compressed(tmp_path / "compressed.npz", c0=np.arange(3))
+    assert map_member(tmp_path / "compressed.npz", "c0") is None
+
+
+def test_expand_cube_vertices_matches_row_by_row_order():
+    points = POINTS.sort_values(by=["X Center", "Y Center", "Z Center"])
+    sizes = (50, 53, 35)
+    # vertex order produced by the original row-by-row implementation of make_cubes_df
+    transform = {
+        "x": [-25, 24.999, -25, 24.999, -25, 24.999, -25, 24.999],
+        "y": [-26.5, -26.5, 26.499, 26.499, -26.5, -26.5, 26.499, 26.499],
+        "z": [-17.5, -17.5, -17.5, -17.5, 17.499, 17.499, 17.499, 17.499],
+    }
+    expected = pd.DataFrame().reindex(columns=points.columns)
+    for i in points.index:
+        for j in range(8):
+            idx = j + (i * 8)
+            expected.loc[idx] = points.loc[i]
+            expected.loc[idx, "X Center"] = (
+                points.loc[i, "X Center"] + transform["x"][j]
+            )
+            expected.loc[idx, "Y Center"] = (
+                points.loc[i, "Y Center"] + transform["y"][j]
+            )
+            expected.loc[idx, "Z Center"] = (
+                points.loc[i, "Z Center"] + transform["z"][j]
+            )
+
+    result = expand_cube_vertices(points, sizes)
+    pd.testing.assert_frame_equal(
+        result, expected.infer_objects(), check_dtype=False, atol=1e-9
+    )
+
+
+def test_cube_vertices_match_expanded_table():
+    sizes = (50, 53, 35)
+    voxels = VolumetricBlock.from_dataframe(POINTS)
+    expanded = expand_cube_vertices(POINTS, sizes)
+    np.testing.assert_array_equal(
+        voxels.cube_vertices(sizes).reshape(-1, 3),
+        expanded[["X Center", "Y Center", "Z Center"]].to_numpy(),
+    )
+
+
+def test_culled_cube_mesh():
+    axes = {"X": [0, 50, 100], "Y": [0, 50], "Z": [0, 10, 20]}
+    voxels = VolumetricBlock.from_dataframe(POINTS)
+    np.testing.assert_array_equal(
+        voxels.grid_cells(axes), [[0, 0, 0], [1, 0, 0], [0, 0, 1], [1, 0, 1]]
+    )
+
+    # two neighboring voxels share one face and four vertices
+    vertices, triangles, cells = culled_cube_mesh(voxels.grid_cells(axes)[:2], axes)
+    assert vertices.shape == (12, 3)
+    assert triangles.shape == (20, 3)
+    assert (cells == 0).sum() == (cells == 1).sum() == 10
+    assert vertices.min(axis=0).tolist() == [0, 0, 0]
+    assert vertices.max(axis=0).tolist() == [100, 50, 10]
+
+    # a 2 x 1 x 2 block has no hidden vertices but eight faces fewer than separate cubes
+    vertices, triangles, cells = culled_cube_mesh(voxels.grid_cells(axes), axes)
+    assert vertices.shape == (18, 3)
+    assert triangles.shape == ((4 * 6 - 8) * 2, 3)
+
+
+def test_volumetric_block_grid():
+    axes = {"X": [0, 50, 100, 150], "Y": [0, 50], "Z": [0, 10, 20]}
+    voxels = VolumetricBlock.from_dataframe(POINTS)
+    grid = voxels.grid("CYB5A", axes)
+    assert grid.shape == (3, 1, 2)
+    np.testing.assert_array_equal(
+        grid[:, 0, :], [[0.5, 1.5], [np.nan, 2.5], [np.nan, np.nan]]
+    )
+    assert voxels.grid("CYB5A", axes) is grid
+
+
+def test_block_average():
+    axes = {"X": [0, 50, 100, 150], "Y": [0, 50], "Z": [0, 10, 20]}
+    assert coarse_axes(axes, 2) == {"X": [0, 100, 150], "Y": [0, 50], "Z": [0, 20]}
+
+    voxels = VolumetricBlock.from_dataframe(POINTS)
+    coarse = voxels.grid("CYB5A", axes, 2)
+    assert coarse.shape == (2, 1, 1)
+    # the mean of 0.5, 1.5 and 2.5, skipping the missing value; the last block is empty
+    np.testing.assert_array_equal(coarse[:, 0, 0], [1.5, np.nan])
+    assert voxels.grid("CYB5A", axes, 2) is coarse
+    np.testing.assert_array_equal(
+        block_average(voxels.grid("ALB", axes), 1)[:2], [[[1, 3]], [[2, 4]]]
+    )
+
+
+def test_cell_cube_vertices():
+    axes = {"X": [0, 100, 150], "Y": [0, 50], "Z": [0, 20]}
+    corners = cell_cube_vertices(np.array([[1, 0, 0]]), axes)
+    assert corners.shape == (1, 8, 3)
+    np.testing.assert_allclose(corners[0, 0], [100, 0, 0])
+    np.testing.assert_allclose(corners[0, 7], [149.999, 49.999, 19.999])
+
+
+def test_value_stats():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({"A": rng.normal(size=200), "B": np.nan, "C": 1.0})
+    df.loc[::4, "A"] = np.nan
+    stats = value_stats(df, ["A", "B", "C"], bins=10)
+    assert stats.index.name == "Row Label"
+
+    a = df["A"].dropna()
+    assert stats.loc["Min", "A"] == a.min()
+    assert stats.loc["NaN Count", "A"] == 50
+    assert stats.loc["Q95", "A"] == pytest.approx(np.quantile(a, 0.95))
+    np.testing.assert_array_equal(
+        stats.loc["Bin 1":"Bin 10", "A"], np.histogram(a, bins=10)[0]
+    )
+    # a protein with no values, and one with a single value
+    assert stats["B"].loc["Min":"Max"].isna().all()
+    assert stats.loc["Bin 1":"Bin 10", "B"].sum() == 0
+    assert stats.loc["Bin 1", "C"] == 200
+
+    assert stats_value_range(stats, "A", "global", (-3, 3)) == (-3, 3)
+    assert stats_value_range(stats, "A", "protein", (-3, 3)) == (a.min(), a.max())
+    assert stats_value_range(stats, "A", "robust", (-3, 3)) == tuple(
+        stats.loc[["Q01", "Q99"], "A"]
+    )
+    assert stats_value_range(stats, "B", "protein", (-3, 3)) == (-3, 3)
+    assert stats_value_range(None, "A", "protein", (-3, 3)) == (-3, 3)
+
+
+def test_find_row():
+    axes = {"X": [0, 50, 100, 150], "Y": [0, 50], "Z": [0, 10, 20]}
+    voxels = VolumetricBlock.from_dataframe(POINTS)
+    assert voxels.row_grid(axes)[:, 0, :].tolist() == [[0, 2], [1, 3], [-1, -1]]
+    assert voxels.find_row((75, 25, 15), axes) == 3
+    # a cube vertex pulled 0.001 inside its voxel
+    assert voxels.find_row((49.999, 49.999, 9.999), axes) == 0
+    # a vertex on the boundary of the block, shared with an empty cell
+    assert voxels.find_row((100, 0, 20), axes) == 3
+    assert voxels.find_row((125, 25, 5), axes) is None
+    # the top face of a voxel in layer 1 is the bottom face of the one above it
+    assert voxels.find_row((25, 25, 10), axes) == 2
+    layer_1 = voxels.select("Layer 1", Z_AXIS)
+    assert voxels.find_row((25, 25, 10), axes, selected=layer_1) == 0
+    assert voxels.find_row((25, 25, 15), axes, selected=layer_1) is None
+
+
+def test_row_values(tmp_path):
+    points = POINTS.assign(TF=[np.nan, np.nan, 0.75, np.nan])
+    write_columns(points, tmp_path / "points_data.npz")
+    voxels = VolumetricBlock.from_archive(tmp_path / "points_data.npz")
+    assert voxels.row_values(2, ["Block ID", "TF", "ALB"]) == {
+        "Block ID": 3,
+        "TF": 0.75,
+        "ALB": 3.0,
+    }
+    assert np.isnan(voxels.row_values(3, ["TF"])["TF"])
+    # the sparse column was not densified
+    assert voxels._dense == (None, None)
+
+
+def test_box_and_radius_rows():
+    axes = {"X": [0, 50, 100, 150], "Y": [0, 50], "Z": [0, 10, 20]}
+    voxels = VolumetricBlock.from_dataframe(POINTS)
+    np.testing.assert_array_equal(
+        voxels.box_rows(axes, (0, 0, 0), (150, 50, 20)), [0, 1, 2, 3]
+    )
+    np.testing.assert_array_equal(
+        voxels.box_rows(axes, (50, 0, 0), (150, 50, 20)), [1, 3]
+    )
+    # the box must hold the voxel's center, not just overlap its cell
+    np.testing.assert_array_equal(voxels.box_rows(axes, (0, 0, 0), (70, 50, 12)), [0])
+    assert voxels.box_rows(axes, (100, 0, 0), (150, 50, 20)).shape == (0,)
+    assert voxels.box_rows(axes, (-50, -50, -50), (-10, -10, -10)).shape == (0,)
+
+    np.testing.assert_array_equal(voxels.radius_rows(axes, (25, 25, 10), 5), [0, 2])
+    np.testing.assert_array_equal(voxels.radius_rows(axes, (50, 25, 5), 25), [0, 1])
+
+    rows = voxels.select("Layer 2", Z_AXIS)
+    roi = {"X": [50, 150], "Y": [0, 50], "Z": [0, 20]}
+    np.testing.assert_array_equal(voxels.crop_rows(rows, axes, roi), [3])
+    assert voxels.crop_rows(rows, axes, None) is rows
+
+
+def test_select_bitmasks():
+    points = POINTS.assign(Region=["a", "b", "a", "a"])
+    voxels = VolumetricBlock.from_dataframe(points)
+    layers = voxels.layer_masks(Z_AXIS)
+    assert [np.unpackbits(m, count=4).tolist() for m in layers] == [
+        [1, 1, 0, 0],
+        [0, 0, 1, 1],
+    ]
+    assert voxels.layer_masks(Z_AXIS) is layers
+    assert set(voxels.value_masks("Region")) == {"a", "b"}
+
+    np.testing.assert_array_equal(
+        voxels.select("All", Z_AXIS, filters={"Region": "a"}), [0, 2, 3]
+    )
+    np.testing.assert_array_equal(
+        voxels.select(
+            "Layer 2",
+            Z_AXIS,
+            "Pixels with islet tissue",
+            LABELS,
+            filters={"Region": "a"},
+        ),
+        [3],
+    )
+    assert voxels.select("All", Z_AXIS, filters={"Region": "c"}).shape == (0,)
+    no_category = VolumetricBlock.from_dataframe(points.drop(columns="Category"))
+    assert (
+        no_category.select("All", Z_AXIS, "Pixels with islet tissue", LABELS).size == 0
+    )
+
+
+def test_isosurface_mesh():
+    axes = {a: list(range(0, 210, 10)) for a in "XYZ"}
+    centers = np.arange(5, 200, 10)
+    x, y, z = np.meshgrid(centers, centers, centers, indexing="ij")
+    distance = np.sqrt((x - 100) ** 2 + (y - 100) ** 2 + (z - 100) ** 2)
+    vertices, triangles = isosurface_mesh(-distance, axes, -50)
+    radii = np.linalg.norm(vertices - 100, axis=1)
+    assert radii.min() > 49 and radii.max() < 50.01
+
+    # closed and consistently oriented: every edge is used once in each direction, and
+    # triangles face away from the center, where the values are highest
+    directed = np.concatenate(
+        [triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]]
+    )
+    assert np.unique(directed, axis=0).shape[0] == directed.shape[0]
+    assert (
+        np.unique(np.sort(directed, axis=1), axis=0).shape[0] * 2 == directed.shape[0]
+    )
+    corners = vertices[triangles]
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    assert ((normals * (corners.mean(axis=1) - 100)).sum(axis=1) > 0).all()
+
+    # voxels without a value are below every threshold, so the surface closes around the
+    # one voxel with a value
+    grid = np.full((3, 3, 3), np.nan)
+    grid[1, 1, 1] = 2.0
+    vertices, triangles = isosurface_mesh(grid, {a: [0, 10, 20, 30] for a in "XYZ"}, 1)
+    assert triangles.shape[0] > 0
+    assert vertices.min() > 5 and vertices.max() < 25
+    assert isosurface_mesh(grid, axes, 3)[1].shape == (0, 3)
+
+
+def test_block_from_vti():
+    from pages.constants import FILE_DESTINATION as FD
+
+    loc = f"{FD["volumetric-map"]}/P1-20C"
+    axes = make_axes(pd.read_csv(f"{loc}/vol_measurements.csv"))
+    path = f"{loc}/HubMAP_TMC_p1_20C_3D_protINT_May8_sorted.vti"
+    voxels = VolumetricBlock.from_vti(path, axes)
+    from_csv = VolumetricBlock.from_csv(f"{loc}/points_data.csv")
+    assert len(voxels) == 9 * 5 * 4
+    assert "ALB" in voxels.columns
+    for name in ["ALB", "SOD1"]:
+        grid = voxels.grid(name, axes)
+        np.testing.assert_allclose(
+            grid, from_csv.grid(name, axes), rtol=1e-6, equal_nan=True
+        )
+        # the grid is the column itself, not a copy scattered from the rows
+        assert np.shares_memory(grid, voxels.column(name))
+    np.testing.assert_array_equal(
+        voxels.grid_cells(axes)[voxels.select("Layer 2", axes["Z"])][:, 2], 1
+    )
+
+    # without axes, cells are placed by the image's origin and spacing
+    voxels = VolumetricBlock.from_vti(path)
+    assert (voxels.x.min(), voxels.x.max()) == (0.5, 8.5)
+    with pytest.raises(ValueError):
+        VolumetricBlock.from_vti(path, coarse_axes(axes, 2))
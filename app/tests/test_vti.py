@@ -0,0 +1,197 @@
+import base64
+import os
+import sys
+import zlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+if os.getcwd() not in sys.path:
+    sys.path.append(os.getcwd())
+from components.vti import ImageData
+from pages.constants import FILE_DESTINATION as FD
+
+VTI_FILE = "HubMAP_TMC_p1_20C_3D_protINT_May8_sorted.vti"
+
+
+def binary_array(values, header_type, compressed, encoded, block_size=64) -> bytes:
+    """Encodes an array the way VTK's XML writers do."""
+    data = values.tobytes()
+    if not compressed:
+        raw = np.array([len(data)], dtype=header_type).tobytes() + data
+        return base64.b64encode(raw) if encoded else raw
+    blocks = [
+        zlib.compress(data[i : i + block_size]) for i in range(0, len(data), block_size)
+    ]
+    last = len(data) - (len(blocks) - 1) * block_size if blocks else 0
+    header = np.array(
+        [len(blocks), block_size, last, *[len(b) for b in blocks]], dtype=header_type
+    ).tobytes()
+    if encoded:
+        return base64.b64encode(header) + base64.b64encode(b"".join(blocks))
+    return header + b"".join(blocks)
+
+
+def write_vti(
+    path,
+    arrays: dict,
+    extent=(0, 3, 0, 2, 0, 2),
+    data_format="appended",
+    encoding="base64",
+    compressed=True,
+    header_type="<u4",
+    pieces=None,
+):
+    """Writes cell arrays, given in VTK order, to a VTK ImageData file. pieces splits the
+    grid into pieces along Z at the given layers."""
+    types = {"f4": "Float32", "f8": "Float64", "u1": "UInt8"}
+    compressor = ' compressor="vtkZLibDataCompressor"' if compressed else ""
+    byte_order = "BigEndian" if header_type.startswith(">") else "LittleEndian"
+    whole = " ".join(str(n) for n in extent)
+    shape = [extent[1] - extent[0], extent[3] - extent[2], extent[5] - extent[4]]
+    bounds = [extent[4], *(pieces or []), extent[5]]
+    lines = [
+        '<?xml version="1.0"?>',
+        f'<VTKFile type="ImageData" version="1.0" byte_order="{byte_order}" '
+        f'header_type="{"UInt64" if header_type[-1] == "8" else "UInt32"}"{compressor}>',
+        f'<ImageData WholeExtent="{whole}" Origin="10 20 30" Spacing="2 3 4">',
+    ]
+    appended = b""
+    for low, high in zip(bounds[:-1], bounds[1:]):
+        piece = [*extent[:4], low, high]
+        lines.append(f'<Piece Extent="{" ".join(str(n) for n in piece)}">')
+        lines.append("<PointData></PointData><CellData>")
+        per_layer = shape[0] * shape[1]
+        rows = slice((low - extent[4]) * per_layer, (high - extent[4]) * per_layer)
+        for name, values in arrays.items():
+            values = values[rows]
+            components = values.shape[1] if values.ndim > 1 else 1
+            attributes = (
+                f'type="{types[values.dtype.str[1:]]}" Name="{name}" '
+                f'NumberOfComponents="{components}"'
+            )
+            if data_format == "ascii":
+                text = " ".join(str(v) for v in values.ravel())
+                lines.append(
+                    f'<DataArray {attributes} format="ascii">{text}</DataArray>'
+                )
+                continue
+            data = binary_array(
+                values,
+                header_type,
+                compressed,
+                data_format == "binary" or encoding == "base64",
+            )
+            if data_format == "binary":
+                lines.append(
+                    f'<DataArray {attributes} format="binary">\n'
+                    f"{data.decode()}\n</DataArray>"
+                )
+            else:
+                lines.append(
+                    f'<DataArray {attributes} format="appended" offset="{len(appended)}"/>'
+                )
+                appended += data
+        lines.append("</CellData></Piece>")
+    lines.append("</ImageData>")
+    content = "\n".join(lines).encode()
+    if data_format == "appended":
+        content += f'\n<AppendedData encoding="{encoding}">\n_'.encode()
+        content += appended + b"\n</AppendedData>"
+    content += b"\n</VTKFile>\n"
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+@pytest.fixture
+def arrays():
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=3 * 2 * 2).astype(np.float32)
+    values[4] = np.nan
+    return {
+        "A": values,
+        "B": np.arange(12, dtype=np.float64),
+        "Islet": (np.arange(12) % 2).astype(np.uint8),
+    }
+
+
+@pytest.mark.parametrize(
+    "data_format, encoding, compressed, header_type",
+    [
+        ("appended", "base64", True, "<u4"),
+        ("appended", "base64", False, "<u4"),
+        ("appended", "raw", True, "<u4"),
+        ("appended", "raw", False, "<u8"),
+        ("binary", None, True, "<u8"),
+        ("binary", None, False, "<u4"),
+        ("ascii", None, False, "<u4"),
+    ],
+)
+def test_read_formats(tmp_path, arrays, data_format, encoding, compressed, header_type):
+    path = tmp_path / "block.vti"
+    write_vti(
+        path,
+        arrays,
+        data_format=data_format,
+        encoding=encoding,
+        compressed=compressed,
+        header_type=header_type,
+    )
+    image = ImageData(path)
+    assert image.extent == [0, 3, 0, 2, 0, 2]
+    assert image.origin == [10, 20, 30]
+    assert image.spacing == [2, 3, 4]
+    assert image.cell_shape == (3, 2, 2)
+    assert image.cell_arrays == ["A", "B", "Islet"]
+    for name, values in arrays.items():
+        read = image.cell_array(name)
+        assert read.dtype == values.dtype
+        np.testing.assert_array_equal(read, values)
+
+
+def test_read_big_endian(tmp_path, arrays):
+    path = tmp_path / "block.vti"
+    write_vti(path, {"A": arrays["A"].astype(">f4")}, header_type=">u4")
+    np.testing.assert_array_equal(ImageData(path).cell_array("A"), arrays["A"])
+
+
+def test_read_pieces_and_components(tmp_path, arrays):
+    path = tmp_path / "block.vti"
+    vectors = np.arange(36, dtype=np.float32).reshape(12, 3)
+    write_vti(path, {"A": arrays["A"], "V": vectors}, pieces=[1])
+    image = ImageData(path)
+    np.testing.assert_array_equal(image.cell_array("A"), arrays["A"])
+    np.testing.assert_array_equal(image.cell_array("V"), vectors)
+    assert image.components == {"A": 1, "V": 3}
+
+
+def test_read_bytes(tmp_path, arrays):
+    path = tmp_path / "block.vti"
+    write_vti(path, arrays)
+    image = ImageData("upload.vti", path.read_bytes())
+    np.testing.assert_array_equal(image.cell_array("B"), arrays["B"])
+    with pytest.raises(ValueError, match="upload.vti"):
+        ImageData("upload.vti", b"not xml")
+
+
+def test_read_invalid(tmp_path):
+    path = tmp_path / "block.vti"
+    path.write_text("<VTKFile type='PolyData'></VTKFile>")
+    with pytest.raises(ValueError):
+        ImageData(path)
+    path.write_text("not xml")
+    with pytest.raises(ValueError):
+        ImageData(path)
+
+
+def test_read_published_block():
+    loc = f"{FD["volumetric-map"]}/P1-20C"
+    image = ImageData(f"{loc}/{VTI_FILE}")
+    assert image.cell_shape == (9, 5, 4)
+    # the voxel table is the image's cells, in the order of their Block ID
+    points = pd.read_csv(f"{loc}/points_data.csv").sort_values("Block ID")
+    for name in ["CYB5A", "SOD1", "ALB"]:
+        np.testing.assert_allclose(
+            image.cell_array(name), points[name], rtol=1e-6, equal_nan=True
+        )
@@ -0,0 +1,288 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections.abc import Callable
+from contextlib import contextmanager
+
+# not available on Windows, where builds are only coalesced per process
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import numpy as np
+from plotly.io.json import to_json_plotly
+
+logger = logging.getLogger(__name__)
+
+# Share of its filesystem that a figure cache may fill. Docker gives containers a 64 MB
+# /dev/shm unless shm_size is set, so the cache must not count on max_bytes fitting.
+DISK_SHARE = 0.5
+
+# Figures are stored as the dicts sent to the browser (see figures.encode_figure). Their
+# large arrays are base64-encoded typed arrays, which are loaded as they are. Trace
+# properties that hold per-vertex or per-voxel data, and their types, for figures stored
+# with plain lists instead: these are restored as NumPy arrays. JSON has no NaN, so
+# missing values come back from null.
+ARRAY_PROPS = {
+    "x": np.float64,
+    "y": np.float64,
+    "z": np.float64,
+    "i": np.int64,
+    "j": np.int64,
+    "k": np.int64,
+    "intensity": np.float64,
+    "value": np.float64,
+    "surfacecolor": np.float64,
+    "customdata": np.float64,
+}
+
+
+def data_version(directory: str) -> str:
+    """Returns a short fingerprint of the files in a directory (names, modification times
+    and sizes). It changes whenever a file is published, replaced or removed. Raises
+    FileNotFoundError if the directory does not exist."""
+    stamps = sorted(
+        (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+        for entry in os.scandir(directory)
+        if entry.is_file()
+    )
+    return hashlib.sha256(repr(stamps).encode()).hexdigest()[:16]
+
+
+def read_figure(path: str) -> dict:
+    """Reads a figure dict written by write_figure. It is returned as stored, without
+    building a plotly Figure, so that it can be sent to the browser as it is."""
+    with open(path) as f:
+        fig = json.load(f)
+    for trace in fig.get("data", []):
+        for prop, dtype in ARRAY_PROPS.items():
+            if isinstance(trace.get(prop), list):
+                trace[prop] = np.array(trace[prop], dtype=dtype)
+    return fig
+
+
+def write_figure(path: str, fig: dict) -> None:
+    """Writes a figure dict (see figures.encode_figure) as JSON, creating its directory if
+    needed. The file is written under a temporary name first, so readers in other
+    processes never see part of it."""
+    write_text(path, to_json_plotly(fig))
+
+
+def write_text(path: str, text: str) -> None:
+    """Writes text to path through a temporary file, see write_figure."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def same_file(fd: int, path: str) -> bool:
+    """Returns whether an open file is the one currently at path."""
+    try:
+        return os.path.samestat(os.fstat(fd), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+
+def remove_lock_file(path: str) -> None:
+    """Deletes a lock file of FigureCache unless a build holds it. The file is deleted
+    while locked, so a process waiting for it sees that it is gone once it gets the lock,
+    see FigureCache._file_lock."""
+    if fcntl is None:
+        return
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except FileNotFoundError:
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.remove(path)
+    except OSError:
+        # in use, so it is left for the build that holds it
+        pass
+    finally:
+        os.close(fd)
+
+
+class FigureCache:
+    """Size-bounded cache of figure dicts (see figures.encode_figure) in a directory. It is
+    meant to live on a shared filesystem such as /dev/shm, so a figure built by one
+    gunicorn worker is served by all of them. Entries are evicted least recently used
+    first to keep the directory within limit(): max_bytes, or DISK_SHARE of its
+    filesystem if that is smaller. Errors reading or writing the directory are logged and
+    treated as misses, so a missing or full cache only costs the time to build the
+    figure.
+
+    get_or_build coalesces concurrent builds of the same figure: one caller builds it while
+    the others wait, within a process through a lock per key and across processes through
+    a lock file next to the entry. Waiters in the same process are handed the built figure
+    directly, so they do not build it again if it could not be cached."""
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 2**20):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._build_locks = {}
+
+    @staticmethod
+    def key(**params) -> str:
+        """Returns the cache key for a figure built from params."""
+        text = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key: str) -> dict | None:
+        """Returns the cached figure for key, or None if there is none."""
+        fig = self._load(key)
+        self._count(fig is not None)
+        return fig
+
+    def get_or_build(self, key: str, build: Callable[[], dict]) -> dict:
+        """Returns the cached figure for key, calling build and caching its result if there
+        is none. If the same figure is already being built, waits for it instead of building
+        it again. Exceptions raised by build are passed on to the caller."""
+        fig = self._load(key)
+        if fig is None:
+            with self._building(key) as built:
+                # another caller may have finished the figure while this one waited, in
+                # this process or in another one
+                fig = built[0] if built else self._load(key)
+                if fig is None:
+                    self._count(False)
+                    fig = build()
+                    built.append(fig)
+                    self.put(key, fig)
+                    return fig
+        self._count(True)
+        return fig
+
+    def _load(self, key: str) -> dict | None:
+        path = self._path(key)
+        try:
+            fig = read_figure(path)
+            # mark the entry as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read cached figure {path}: {e}")
+            return None
+        return fig
+
+    @contextmanager
+    def _building(self, key: str):
+        """Holds the build lock of key while the caller builds the figure, yielding a list
+        shared with the callers waiting for the same lock, into which the figure is put
+        once it is built."""
+        with self._lock:
+            entry = self._build_locks.setdefault(key, [threading.Lock(), 0, []])
+            entry[1] += 1
+        try:
+            with entry[0], self._file_lock(key):
+                yield entry[2]
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._build_locks[key]
+
+    @contextmanager
+    def _file_lock(self, key: str):
+        fd = None
+        if fcntl is not None:
+            path = os.path.join(self.directory, f"{key}.lock")
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                while fd is None:
+                    fd = os.open(path, os.O_RDWR | os.O_CREAT)
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                    # evict may have deleted the lock file while this process waited for
+                    # it. The lock is then held on a file that other processes no longer
+                    # open, so it is taken again on the current one.
+                    if not same_file(fd, path):
+                        os.close(fd)
+                        fd = None
+            except OSError as e:
+                logger.warning(f"Could not lock figure {key} in {self.directory}: {e}")
+        try:
+            yield
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def limit(self) -> int:
+        """Returns the most bytes the cache may hold."""
+        try:
+            total = shutil.disk_usage(self.directory).total
+        except OSError:
+            return self.max_bytes
+        return min(self.max_bytes, int(total * DISK_SHARE))
+
+    def put(self, key: str, fig: dict) -> None:
+        """Stores a figure under key, first evicting old entries to make room for it.
+        Figures bigger than the whole cache are not stored. If the filesystem fills up
+        anyway, e.g. with entries written by other processes, all other entries are evicted
+        and the figure is written once more."""
+        text = to_json_plotly(fig)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if len(text) > self.limit():
+                return
+            self.evict(reserve=len(text))
+            try:
+                write_text(self._path(key), text)
+            except OSError:
+                self.evict(reserve=self.limit())
+                write_text(self._path(key), text)
+        except OSError as e:
+            logger.warning(f"Could not cache figure in {self.directory}: {e}")
+
+    def evict(self, reserve: int = 0) -> None:
+        """Deletes the least recently used entries until the cache and reserve more bytes
+        fit in limit()."""
+        limit = self.limit() - reserve
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            remove_lock_file(f"{path[: -len(".json")]}.lock")
+            total -= size
+
+    def stats(self) -> dict:
+        """Returns this process's hit and miss counts."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
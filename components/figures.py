@@ -0,0 +1,660 @@
+import base64
+import shutil
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+from components.figure_cache import data_version, read_figure, write_figure
+from components.volumetric import (
+    VolumetricBlock,
+    axis_centers,
+    block_average,
+    cell_cube_vertices,
+    coarse_axes,
+    cube_faces,
+    culled_cube_mesh,
+    find_global_value_bounds,
+    grid_shape,
+    histogram_edges,
+    isosurface_mesh,
+    make_axes,
+    make_defaults,
+    open_voxels,
+    voxel_sizes,
+    voxel_source,
+)
+
+# Views of all layers of a block with more voxels than VOXEL_BUDGET are drawn from block
+# averages of LOD_FACTORS voxels per axis, the first that fits. A single layer is always
+# drawn at full resolution.
+VOXEL_BUDGET = 50_000
+LOD_FACTORS = [2, 4]
+
+# Settings of a volumetric map view when the page is first opened. The default protein is
+# marked in each block's value_ranges.csv.
+DEFAULT_SETTINGS = {
+    "color": "haline",
+    "value": "",
+    "cubeopacity": 0.4,
+    "pointopacity": 0.1,
+    "layer": "All",
+    "category_selected": "All",
+    "cube_mesh": False,
+    "color_range": "global",
+    "roi": None,
+    "threshold": None,
+}
+
+# The settings each view's figure depends on
+VIEW_PARAMS = {
+    "cube-tab": [
+        "color",
+        "value",
+        "layer",
+        "category_selected",
+        "cubeopacity",
+        "cube_mesh",
+        "color_range",
+        "roi",
+    ],
+    "point-tab": ["color", "value", "layer", "pointopacity", "color_range", "roi"],
+    "layer-tab": ["color", "value", "layer", "color_range", "roi"],
+    "sphere-tab": [
+        "color",
+        "value",
+        "layer",
+        "category_selected",
+        "color_range",
+        "roi",
+    ],
+    "iso-tab": ["color", "value", "threshold", "color_range", "roi"],
+}
+
+# Version of the figures built here, part of the names of prerendered figures and of
+# figure cache keys. Bump it when a change to the builders or to encode_figure changes the
+# figures they produce, so that figures from an earlier release are not served.
+RENDER_VERSION = 1
+
+# Views whose geometry does not depend on the protein, so that a protein change only
+# replaces the values they are colored by
+FIXED_GEOMETRY_TABS = ["cube-tab", "point-tab", "layer-tab"]
+
+
+# Large data arrays are sent to the browser as base64-encoded typed arrays, which plotly.js
+# decodes natively, instead of as lists of numbers. Set BINARY_ARRAYS to False to send
+# plain JSON.
+BINARY_ARRAYS = True
+BINARY_MIN_SIZE = 256
+# Typed array type for each trace property. Triangle indices use the smallest type that
+# holds them. Intensities are float32 in memory (see volumetric.compact_column), so
+# single precision loses nothing.
+BINARY_DTYPES = {
+    "x": "f4",
+    "y": "f4",
+    "z": "f4",
+    "i": "index",
+    "j": "index",
+    "k": "index",
+    "intensity": "f4",
+    "value": "f4",
+    "surfacecolor": "f4",
+    "customdata": "f4",
+}
+
+
+def encode_array(prop: str, values):
+    """Returns a trace property's values as a plotly.js typed array spec, or unchanged if
+    binary arrays are switched off or the property is not a large numeric array."""
+    if not BINARY_ARRAYS or prop not in BINARY_DTYPES:
+        return values
+    array = np.asarray(values)
+    if array.size < BINARY_MIN_SIZE or array.dtype.kind not in "biuf":
+        return values
+    dtype = BINARY_DTYPES[prop]
+    if dtype == "index":
+        dtype = "u2" if array.min() >= 0 and array.max() < 2**16 else "i4"
+    data = np.ascontiguousarray(array, dtype=np.dtype(dtype).newbyteorder("<"))
+    spec = {"dtype": dtype, "bdata": base64.b64encode(data).decode("ascii")}
+    if array.ndim > 1:
+        spec["shape"] = ",".join(str(n) for n in array.shape)
+    return spec
+
+
+def encode_traces(fig: go.Figure) -> list:
+    """Returns fig's traces as dicts with their large arrays encoded by encode_array."""
+    traces = []
+    for trace in fig.data:
+        trace_dict = dict(trace.to_plotly_json())
+        for prop in BINARY_DTYPES:
+            if prop in trace_dict:
+                trace_dict[prop] = encode_array(prop, trace_dict[prop])
+        traces.append(trace_dict)
+    return traces
+
+
+def encode_figure(fig: go.Figure) -> dict:
+    """Returns fig as a dict ready to send to the browser, with its large arrays encoded by
+    encode_array. Figures are cached in this form, so serving them takes no conversion."""
+    return {"data": encode_traces(fig), "layout": fig.layout.to_plotly_json()}
+
+
+def lod_factor(n: int, layer: str) -> int:
+    """Returns how many voxels per axis to average when drawing n voxels of a layer."""
+    if layer != "All" or n <= VOXEL_BUDGET:
+        return 1
+    for factor in LOD_FACTORS:
+        if n / factor**3 <= VOXEL_BUDGET:
+            return factor
+    return LOD_FACTORS[-1]
+
+
+def lod_cells(voxels: VolumetricBlock, value: str, axes: dict, rows, factor: int):
+    """Returns the (n, 3) cells of the grid from coarse_axes(axes, factor) that hold any of
+    rows, and the average value of those rows in each cell."""
+    if rows.shape[0] == len(voxels):
+        grid = voxels.grid(value, axes, factor)
+    else:
+        fine = np.full(grid_shape(axes), np.nan)
+        fine[tuple(voxels.grid_cells(axes)[rows].T)] = voxels.column(value)[rows]
+        grid = block_average(fine, factor)
+    cells = np.unique(voxels.grid_cells(axes)[rows] // factor, axis=0)
+    return cells, grid[tuple(cells.T)]
+
+
+def set_lod_title(fig, factor: int):
+    if factor > 1:
+        fig.update_layout(
+            title=dict(
+                text=f"Averaged over {factor} × {factor} × {factor} voxels. Select a "
+                "layer to see it at full resolution.",
+                font=dict(size=13),
+            )
+        )
+
+
+def crop_grid(voxels: VolumetricBlock, grid: np.ndarray, axes: dict, roi) -> np.ndarray:
+    """Returns a copy of a grid from voxels.grid blanked outside a region of interest, or
+    the grid itself if roi is None."""
+    if not roi:
+        return grid
+    rows = voxels.crop_rows(np.arange(len(voxels)), axes, roi)
+    cells = tuple(voxels.grid_cells(axes)[rows].T)
+    cropped = np.full_like(grid, np.nan)
+    cropped[cells] = grid[cells]
+    return cropped
+
+
+# Graph functions
+def set_layout(fig, axes):
+    fig.update_layout(
+        scene=dict(
+            xaxis=dict(
+                nticks=10,
+                range=[axes["X"][0], axes["X"][-1]],
+            ),
+            yaxis=dict(
+                nticks=6,
+                range=[axes["Y"][0], axes["Y"][-1]],
+            ),
+            zaxis=dict(
+                nticks=5,
+                range=[axes["Z"][0], axes["Z"][-1]],
+            ),
+            aspectmode="manual",
+            aspectratio=dict(x=0.9, y=0.5, z=0.4),
+            camera=dict(eye=dict(x=0.7, y=0.7, z=0.7)),
+        ),
+        # keep the user's camera when the figure is restyled or rebuilt
+        uirevision=True,
+    )
+
+
+def make_point_fig(
+    axes,
+    value_ranges,
+    voxels: VolumetricBlock,
+    opacity=0.1,
+    colorscheme="haline",
+    value="",
+    layer="All",
+    roi=None,
+):
+    """Create figure for point view of volumetric map data"""
+    rows = voxels.crop_rows(voxels.select(layer, axes["Z"]), axes, roi)
+    factor = lod_factor(rows.shape[0], layer)
+    if factor > 1:
+        cells, values = lod_cells(voxels, value, axes, rows, factor)
+        lod_axes = coarse_axes(axes, factor)
+        X, Y, Z = [axis_centers(lod_axes, a)[cells[:, n]] for n, a in enumerate("XYZ")]
+    else:
+        X = voxels.x[rows]
+        Y = voxels.y[rows]
+        Z = voxels.z[rows]
+        values = voxels.column(value)[rows]
+
+    fig2 = go.Figure(
+        data=go.Volume(
+            x=X,
+            y=Y,
+            z=Z,
+            value=values,
+            isomin=value_ranges[0],
+            isomax=value_ranges[1],
+            opacity=opacity,
+            colorscale=colorscheme,
+            surface_count=21,
+            name="Point View",
+        )
+    )
+
+    set_layout(fig2, axes)
+    set_lod_title(fig2, factor)
+    return fig2
+
+
+def make_layer_fig(
+    axes,
+    value_ranges,
+    voxels: VolumetricBlock,
+    colorscheme="haline",
+    value="",
+    layer="All",
+    roi=None,
+):
+    """Create figure for layer view of volumetric map data"""
+    grid = crop_grid(voxels, voxels.grid(value, axes), axes, roi)
+    X = axis_centers(axes, "X")
+    Y = axis_centers(axes, "Y")
+    Z = axis_centers(axes, "Z")
+
+    if layer == "All":
+        layers = range(grid.shape[2])
+    else:
+        layers = [int(layer.split()[-1]) - 1]
+
+    data = []
+    for k in layers:
+        data.append(
+            go.Surface(
+                x=X,
+                y=Y,
+                z=np.full((Y.shape[0], X.shape[0]), Z[k]),
+                colorscale=colorscheme,
+                surfacecolor=grid[:, :, k].T,
+                name=f"Layer {k + 1}",
+                cmin=value_ranges[0],
+                cmax=value_ranges[1],
+                showscale=not data,
+            ),
+        )
+
+    fig = go.Figure(data=data)
+    set_layout(fig, axes)
+    return fig
+
+
+def make_sphere_template(resolution=5):
+    """Calculate the vertices and triangles of a sphere of radius 1 centered at the origin,
+    sampled at resolution * 2 - 1 longitudes and resolution latitudes. Returns an (n, 3)
+    ndarray of vertices and an (m, 3) ndarray of triangles."""
+    u = np.linspace(0, 2 * np.pi, resolution * 2)[:-1]
+    v = np.linspace(0, np.pi, resolution)[1:-1]
+    nu = u.shape[0]
+    rings = np.stack(
+        [
+            np.outer(np.sin(v), np.cos(u)),
+            np.outer(np.sin(v), np.sin(u)),
+            np.outer(np.cos(v), np.ones(nu)),
+        ],
+        axis=-1,
+    ).reshape(-1, 3)
+    vertices = np.concatenate([[[0, 0, 1]], rings, [[0, 0, -1]]])
+
+    # ring r, longitude i is vertex 1 + r * nu + i; the poles are the first and last vertex
+    south = vertices.shape[0] - 1
+    i = np.arange(nu)
+    i_next = (i + 1) % nu
+    triangles = [np.stack([np.zeros(nu, int), 1 + i, 1 + i_next], axis=-1)]
+    for r in range(v.shape[0] - 1):
+        top = 1 + r * nu
+        bottom = top + nu
+        triangles.append(np.stack([top + i, top + i_next, bottom + i_next], axis=-1))
+        triangles.append(np.stack([top + i, bottom + i_next, bottom + i], axis=-1))
+    last = 1 + (v.shape[0] - 1) * nu
+    triangles.append(np.stack([np.full(nu, south), last + i_next, last + i], axis=-1))
+    return vertices, np.concatenate(triangles)
+
+
+SPHERE_VERTICES, SPHERE_TRIANGLES = make_sphere_template()
+
+
+def make_sphere_fig(
+    axes,
+    value_ranges,
+    category_labels,
+    voxels: VolumetricBlock,
+    opacity=1,
+    colorscheme="haline",
+    value="",
+    layer="All",
+    category_opt="All",
+    radius=14,
+    roi=None,
+):
+    """Create figure for sphere view of volumetric map data. Every voxel with a value is
+    drawn as a copy of the same sphere template, and all spheres share one trace."""
+    rows = voxels.crop_rows(
+        voxels.select(layer, axes["Z"], category_opt, category_labels), axes, roi
+    )
+    values = voxels.column(value)[rows]
+    has_value = ~np.isnan(values)
+    rows = rows[has_value]
+    values = values[has_value]
+
+    n = rows.shape[0]
+    nv = SPHERE_VERTICES.shape[0]
+    centers = np.stack([voxels.x[rows], voxels.y[rows], voxels.z[rows]], axis=-1)
+    vertices = (
+        centers[:, np.newaxis, :] + radius * SPHERE_VERTICES[np.newaxis]
+    ).reshape(-1, 3)
+    faces = (
+        np.arange(n)[:, np.newaxis, np.newaxis] * nv + SPHERE_TRIANGLES[np.newaxis]
+    ).reshape(-1, 3)
+    intensity = np.repeat(values, nv)
+
+    fig4 = go.Figure(
+        data=go.Mesh3d(
+            x=vertices[:, 0],
+            y=vertices[:, 1],
+            z=vertices[:, 2],
+            i=faces[:, 0],
+            j=faces[:, 1],
+            k=faces[:, 2],
+            intensity=intensity,
+            colorscale=colorscheme,
+            cmin=value_ranges[0],
+            cmax=value_ranges[1],
+            opacity=opacity,
+            # float32 values, shown to the precision they are stored with
+            hovertemplate="val: %{intensity:.7~g}<extra></extra>",
+            name="Sphere View",
+        )
+    )
+    set_layout(fig4, axes)
+    return fig4
+
+
+def make_cube_fig(
+    axes,
+    value_ranges,
+    category_labels,
+    voxels: VolumetricBlock,
+    sizes,
+    opacity=0.4,
+    colorscheme="haline",
+    value="",
+    layer="All",
+    category_opt="All",
+    culled=False,
+    roi=None,
+):
+    """Create figure for cube view of volumetric map data. If culled is True, faces shared
+    by neighboring voxels are left out and each triangle is colored by its voxel's value."""
+    rows = voxels.crop_rows(
+        voxels.select(layer, axes["Z"], category_opt, category_labels), axes, roi
+    )
+    factor = lod_factor(rows.shape[0], layer)
+
+    if factor > 1:
+        cells, cell_values = lod_cells(voxels, value, axes, rows, factor)
+        lod_axes = coarse_axes(axes, factor)
+        if culled:
+            vertices, faces, face_cells = culled_cube_mesh(cells, lod_axes)
+            values = cell_values[face_cells]
+            intensitymode = "cell"
+        else:
+            vertices = cell_cube_vertices(cells, lod_axes).reshape(-1, 3)
+            values = np.repeat(cell_values, 8)
+            faces = cube_faces(cells.shape[0])
+            intensitymode = "vertex"
+    elif culled:
+        vertices, faces, face_voxels = culled_cube_mesh(
+            voxels.grid_cells(axes)[rows], axes
+        )
+        values = voxels.column(value)[rows][face_voxels]
+        intensitymode = "cell"
+    else:
+        # eight vertices per voxel, ordered as described in volumetric.CUBE_CORNERS
+        vertices = voxels.cube_vertices(sizes)[rows].reshape(-1, 3)
+        values = np.repeat(voxels.column(value)[rows], 8)
+        faces = cube_faces(rows.shape[0])
+        intensitymode = "vertex"
+
+    fig1 = go.Figure(
+        data=go.Mesh3d(
+            x=vertices[:, 0],
+            y=vertices[:, 1],
+            z=vertices[:, 2],
+            i=faces[:, 0],
+            j=faces[:, 1],
+            k=faces[:, 2],
+            intensity=values,
+            intensitymode=intensitymode,
+            opacity=opacity,
+            colorscale=colorscheme,
+            cmin=value_ranges[0],
+            cmax=value_ranges[1],
+        )
+    )
+
+    set_layout(fig1, axes)
+    set_lod_title(fig1, factor)
+    return fig1
+
+
+def make_isosurface_fig(
+    axes,
+    value_ranges,
+    voxels: VolumetricBlock,
+    colorscheme="haline",
+    value="",
+    threshold=None,
+    roi=None,
+):
+    """Create figure for isosurface view of volumetric map data: the surface around the
+    voxels where a protein is at or above threshold, colored by the threshold's place in
+    the color scale. The threshold defaults to the middle of value_ranges."""
+    if threshold is None:
+        threshold = (value_ranges[0] + value_ranges[1]) / 2
+    grid = crop_grid(voxels, voxels.grid(value, axes), axes, roi)
+    factor = lod_factor(np.count_nonzero(~np.isnan(grid)), "All")
+    if factor > 1:
+        grid = block_average(grid, factor)
+        vertices, triangles = isosurface_mesh(
+            grid, coarse_axes(axes, factor), threshold
+        )
+    else:
+        vertices, triangles = isosurface_mesh(grid, axes, threshold)
+
+    fig5 = go.Figure(
+        data=go.Mesh3d(
+            x=vertices[:, 0],
+            y=vertices[:, 1],
+            z=vertices[:, 2],
+            i=triangles[:, 0],
+            j=triangles[:, 1],
+            k=triangles[:, 2],
+            intensity=np.full(vertices.shape[0], threshold),
+            colorscale=colorscheme,
+            cmin=value_ranges[0],
+            cmax=value_ranges[1],
+            hovertemplate=f"{value} at least {threshold:.3g}<extra></extra>",
+            name="Isosurface",
+        )
+    )
+    set_layout(fig5, axes)
+    set_lod_title(fig5, factor)
+    if triangles.shape[0] == 0:
+        fig5.update_layout(
+            title=dict(
+                text=f"No voxels have {value} at or above {threshold:.3g}.",
+                font=dict(size=13),
+            )
+        )
+    return fig5
+
+
+def make_histogram_fig(stats: pd.DataFrame, value: str, value_range) -> go.Figure:
+    """Builds a bar chart of a protein's histogram in value_stats.csv, with the color range
+    of the volumetric map shaded."""
+    edges = histogram_edges(stats, value)
+    counts = stats.loc[
+        [label for label in stats.index if label.startswith("Bin ")], value
+    ]
+    fig = go.Figure(
+        go.Bar(
+            x=(edges[:-1] + edges[1:]) / 2,
+            y=counts.to_numpy(),
+            width=np.diff(edges),
+            customdata=np.column_stack([edges[:-1], edges[1:]]),
+            hovertemplate="%{customdata[0]:.3~g} to %{customdata[1]:.3~g}: "
+            "%{y} voxels<extra></extra>",
+        )
+    )
+    fig.add_vrect(
+        x0=value_range[0],
+        x1=value_range[1],
+        fillcolor="grey",
+        opacity=0.2,
+        line_width=0,
+    )
+    fig.update_layout(
+        title=f"Distribution of {value}",
+        xaxis_title="Value",
+        yaxis_title="Voxels",
+        height=250,
+        margin=dict(l=20, r=20, t=40, b=20),
+        bargap=0,
+    )
+    return fig
+
+
+def make_view_fig(
+    tab, voxels: VolumetricBlock, sizes, axes, value_ranges, category_labels, settings
+):
+    """Builds the figure for a tab of the volumetric map from settings shaped like
+    DEFAULT_SETTINGS."""
+    if tab == "cube-tab":
+        return make_cube_fig(
+            axes,
+            value_ranges,
+            category_labels,
+            voxels,
+            sizes,
+            colorscheme=settings["color"],
+            value=settings["value"],
+            opacity=settings["cubeopacity"],
+            layer=settings["layer"],
+            category_opt=settings["category_selected"],
+            culled=bool(settings["cube_mesh"]),
+            roi=settings["roi"],
+        )
+    elif tab == "point-tab":
+        return make_point_fig(
+            axes,
+            value_ranges,
+            voxels,
+            colorscheme=settings["color"],
+            value=settings["value"],
+            opacity=settings["pointopacity"],
+            layer=settings["layer"],
+            roi=settings["roi"],
+        )
+    elif tab == "layer-tab":
+        return make_layer_fig(
+            axes,
+            value_ranges,
+            voxels,
+            colorscheme=settings["color"],
+            value=settings["value"],
+            layer=settings["layer"],
+            roi=settings["roi"],
+        )
+    elif tab == "sphere-tab":
+        return make_sphere_fig(
+            axes,
+            value_ranges,
+            category_labels,
+            voxels,
+            colorscheme=settings["color"],
+            value=settings["value"],
+            layer=settings["layer"],
+            category_opt=settings["category_selected"],
+            roi=settings["roi"],
+        )
+    elif tab == "iso-tab":
+        return make_isosurface_fig(
+            axes,
+            value_ranges,
+            voxels,
+            colorscheme=settings["color"],
+            value=settings["value"],
+            threshold=settings["threshold"],
+            roi=settings["roi"],
+        )
+
+
+def view_settings(tab: str, settings: dict) -> dict:
+    """Returns the settings that a tab's figure depends on."""
+    return {key: settings[key] for key in VIEW_PARAMS[tab]}
+
+
+def default_settings(ranges_df: pd.DataFrame) -> dict:
+    """Returns DEFAULT_SETTINGS with the block's default protein."""
+    return {**DEFAULT_SETTINGS, "value": make_defaults(ranges_df)["d_value"]}
+
+
+def prerendered_path(block_dir: str, tab: str, version: str) -> str:
+    """Returns where the default figure of a tab is prerendered for a version of a block's
+    data (see figure_cache.data_version) by this RENDER_VERSION."""
+    return f"{block_dir}/prerendered/{tab}-r{RENDER_VERSION}-{version}.json"
+
+
+def read_prerendered(block_dir: str, tab: str, version: str) -> dict | None:
+    """Returns the prerendered default figure of a tab, encoded by encode_figure, or None if
+    there is none for this version of the block's data."""
+    try:
+        return read_figure(prerendered_path(block_dir, tab, version))
+    except (OSError, ValueError):
+        return None
+
+
+def prerender_default_views(block_dir: str) -> list[str]:
+    """Builds the default figure of every tab of a published block and writes it next to
+    the block's data, replacing figures prerendered for earlier versions of the data.
+    Returns the paths written."""
+    ranges_df = pd.read_csv(f"{block_dir}/value_ranges.csv", index_col="Row Label")
+    category_labels = pd.read_csv(f"{block_dir}/category_labels.csv").iloc[0].to_dict()
+    vol_measurements = pd.read_csv(f"{block_dir}/vol_measurements.csv")
+    axes = make_axes(vol_measurements)
+    voxels = open_voxels(voxel_source(block_dir, "points_data"), axes)
+
+    value_ranges = find_global_value_bounds(ranges_df.iloc[0:2].to_dict())
+    settings = default_settings(ranges_df)
+    version = data_version(block_dir)
+    shutil.rmtree(f"{block_dir}/prerendered", ignore_errors=True)
+    paths = []
+    for tab in VIEW_PARAMS:
+        fig = make_view_fig(
+            tab,
+            voxels,
+            voxel_sizes(vol_measurements),
+            axes,
+            value_ranges,
+            category_labels,
+            settings,
+        )
+        paths.append(prerendered_path(block_dir, tab, version))
+        write_figure(paths[-1], encode_figure(fig))
+    return paths
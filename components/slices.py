@@ -0,0 +1,88 @@
+import base64
+import io
+
+import numpy as np
+from PIL import Image
+from plotly.colors import sample_colorscale
+
+from components.volumetric import VolumetricBlock, grid_shape
+
+# Layers of a block are drawn as images by looking their values up in a table of LUT_SIZE
+# colors sampled from a Plotly color scale, so a slice never needs a WebGL scene
+LUT_SIZE = 256
+IMAGE_FORMATS = {"png": {"optimize": True}, "webp": {"lossless": True}}
+
+
+def make_lut(colorscale: list) -> np.ndarray:
+    """Returns a (LUT_SIZE, 4) uint8 table of opaque RGBA colors sampled evenly from a
+    Plotly color scale, given as a list of [position, color] pairs."""
+    colors = sample_colorscale(
+        colorscale, np.linspace(0, 1, LUT_SIZE), colortype="tuple"
+    )
+    lut = np.full((LUT_SIZE, 4), 255, dtype=np.uint8)
+    lut[:, :3] = np.rint(np.array(colors) * 255)
+    return lut
+
+
+def layer_grids(
+    voxels: VolumetricBlock, names: list, axes: dict, layer: int, roi=None
+) -> np.ndarray:
+    """Returns a (len(names), nx, ny) array of the values of several columns in one layer
+    (counted from 0) of the regular grid from make_axes, with NaN where the block has no
+    voxel or outside a region of interest. Raises ValueError if the grid has no such
+    layer."""
+    nx, ny, nz = grid_shape(axes)
+    if not 0 <= layer < nz:
+        raise ValueError(f"Layer {layer} is outside the {nz} layers of the grid")
+    rows = voxels.crop_rows(voxels.select(f"Layer {layer + 1}", axes["Z"]), axes, roi)
+    cells = voxels.grid_cells(axes)[rows]
+    grids = np.full((len(names), nx, ny), np.nan, dtype=np.float32)
+    for i, name in enumerate(names):
+        grids[i, cells[:, 0], cells[:, 1]] = voxels.column(name)[rows]
+    return grids
+
+
+def colorize(grids: np.ndarray, lut: np.ndarray, value_ranges) -> np.ndarray:
+    """Colors a stack of (p, nx, ny) layers in a single pass, each over its own
+    [min, max] in the (p, 2) value_ranges. Values outside the range take the color of its
+    nearest end and NaN cells are transparent. Returns (p, ny, nx, 4) uint8 RGBA images
+    with Y increasing upwards."""
+    ranges = np.asarray(value_ranges, dtype=np.float32).reshape(-1, 2)
+    low = ranges[:, 0, None, None]
+    span = (ranges[:, 1] - ranges[:, 0])[:, None, None]
+    # a protein with a single value is drawn with the bottom color
+    scale = np.divide(LUT_SIZE - 1, span, out=np.zeros_like(span), where=span > 0)
+    empty = np.isnan(grids)
+    values = np.where(empty, low, grids)
+    indices = np.clip(np.rint((values - low) * scale), 0, LUT_SIZE - 1)
+    images = lut[indices.astype(np.uint8)]
+    images[empty, 3] = 0
+    return images.transpose(0, 2, 1, 3)[:, ::-1]
+
+
+def encode_image(image: np.ndarray, image_format: str = "png") -> str:
+    """Returns an (h, w, 4) uint8 RGBA image as a data URI for html.Img. image_format is
+    one of IMAGE_FORMATS. Both are lossless, WebP is usually smaller."""
+    buffer = io.BytesIO()
+    Image.fromarray(np.ascontiguousarray(image)).save(
+        buffer, format=image_format, **IMAGE_FORMATS[image_format]
+    )
+    encoded = base64.b64encode(buffer.getvalue()).decode()
+    return f"data:image/{image_format};base64,{encoded}"
+
+
+def render_layer(
+    voxels: VolumetricBlock,
+    names: list,
+    axes: dict,
+    layer: int,
+    lut: np.ndarray,
+    value_ranges,
+    roi=None,
+    image_format: str = "png",
+) -> list[str]:
+    """Draws one layer (counted from 0) of the block for several columns, colored by lut
+    over the (len(names), 2) value_ranges. Returns a data URI per column, one pixel per
+    voxel."""
+    images = colorize(layer_grids(voxels, names, axes, layer, roi), lut, value_ranges)
+    return [encode_image(image, image_format) for image in images]
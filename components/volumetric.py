@@ -0,0 +1,1049 @@
+import itertools
+import math
+import os
+import struct
+import threading
+import zipfile
+from collections import OrderedDict
+from collections.abc import Callable
+
+import numpy as np
+import pandas as pd
+
+from components.vti import ImageData
+
+
+class BlockCache:
+    """Thread-safe, size-bounded LRU cache for data loaded from files. An entry is reloaded
+    when the file it was loaded from changes on disk (modification time or size)."""
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str, loader: Callable, key=None):
+        """Returns the cached result of loader(path), calling the loader if the entry is
+        missing or stale. key tells apart loaders that read the same file differently and
+        defaults to the path. Raises FileNotFoundError if path does not exist. Cached objects
+        are shared between callers and must be treated as read-only."""
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        key = str(path) if key is None else key
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(key)
+                return entry[1]
+        value = loader(path)
+        with self._lock:
+            self._entries[key] = (stamp, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class Memo:
+    """Thread-safe LRU cache of arrays derived from a block, holding at most max_entries of
+    them."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build: Callable):
+        """Returns the cached result of build() for key, calling build if there is none."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        value = build()
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    @property
+    def nbytes(self) -> int:
+        """Returns the size of the cached arrays, including arrays in lists and dicts."""
+        with self._lock:
+            values = list(self._entries.values())
+        total = 0
+        while values:
+            value = values.pop()
+            if isinstance(value, dict):
+                values.extend(value.values())
+            elif isinstance(value, (list, tuple)):
+                values.extend(value)
+            else:
+                total += getattr(value, "nbytes", 0)
+        return total
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def make_defaults(ranges_df: pd.DataFrame) -> dict:
+    defaults = {"d_scheme": "haline", "d_layer": "All", "d_category": "All"}
+    d_val = ranges_df.columns[np.nonzero(ranges_df.loc["Default"])].values[0]
+    defaults["d_value"] = d_val
+    return defaults
+
+
+def make_axes(df: pd.DataFrame) -> dict:
+    axes = {}
+    axis_labels = ["X", "Y", "Z"]
+
+    for label in axis_labels:
+        axis_min = df.loc[0, f"{label} Min"]
+        axis_max = df.loc[0, f"{label} Max"]
+        axis_step = df.loc[0, f"{label} Size"]
+        axes[label] = [x for x in range(axis_min, axis_max + 1, axis_step)]
+
+    return axes
+
+
+def find_global_value_bounds(value_info: dict) -> tuple[float, float]:
+    value_keys = value_info.keys()
+    mins = [value_info[key]["Min"] for key in value_keys]
+    maxes = [value_info[key]["Max"] for key in value_keys]
+    return math.floor(min(mins)), math.ceil(max(maxes))
+
+
+# Quantiles and number of equal-width histogram bins in a block's value_stats.csv
+STAT_QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+HISTOGRAM_BINS = 32
+
+
+def value_stats(
+    df: pd.DataFrame, values: list, bins: int = HISTOGRAM_BINS
+) -> pd.DataFrame:
+    """Summarizes the protein columns of a voxel table, one column per protein, shaped like
+    value_ranges.csv: rows Min, Max, Count, NaN Count, a row per quantile in STAT_QUANTILES
+    (Q01 for the 1st percentile) and the voxel counts of bins equal-width bins from Min to
+    Max (Bin 1 to Bin {bins}). Proteins with no values have NaN statistics and empty bins."""
+    data = np.column_stack([df[v].to_numpy(dtype=np.float64) for v in values])
+    present = ~np.isnan(data)
+    counts = present.sum(axis=0)
+    found = counts > 0
+    mins = np.where(found, np.where(present, data, np.inf).min(axis=0), np.nan)
+    maxs = np.where(found, np.where(present, data, -np.inf).max(axis=0), np.nan)
+    quantiles = np.full((len(STAT_QUANTILES), len(values)), np.nan)
+    quantiles[:, found] = np.nanquantile(data[:, found], STAT_QUANTILES, axis=0)
+
+    # bin every value at once, numbering the bins of protein c from c * bins
+    rows, cols = np.nonzero(present)
+    widths = np.where(maxs > mins, maxs - mins, 1)
+    idx = ((data[rows, cols] - mins[cols]) / widths[cols] * bins).astype(np.int64)
+    idx = np.clip(idx, 0, bins - 1) + cols * bins
+    histogram = np.bincount(idx, minlength=len(values) * bins).reshape(-1, bins)
+
+    stats = {
+        "Min": mins,
+        "Max": maxs,
+        "Count": counts,
+        "NaN Count": data.shape[0] - counts,
+    }
+    for q, row in zip(STAT_QUANTILES, quantiles):
+        stats[f"Q{round(q * 100):02d}"] = row
+    for b in range(bins):
+        stats[f"Bin {b + 1}"] = histogram[:, b]
+    stats = pd.DataFrame.from_dict(stats, orient="index", columns=values)
+    stats.index.name = "Row Label"
+    return stats
+
+
+def histogram_edges(stats: pd.DataFrame, value: str) -> np.ndarray:
+    """Returns the bin edges of a protein's histogram in value_stats.csv."""
+    bins = sum(label.startswith("Bin ") for label in stats.index)
+    return np.linspace(stats.loc["Min", value], stats.loc["Max", value], bins + 1)
+
+
+def stats_value_range(
+    stats: pd.DataFrame | None, value: str, mode: str, default: tuple
+) -> tuple:
+    """Returns the color range for a protein: its Min and Max for mode "protein", its 1st and
+    99th percentiles for "robust", and default for "global" or if the protein has no
+    statistics."""
+    rows = {"protein": ("Min", "Max"), "robust": ("Q01", "Q99")}.get(mode)
+    if rows is None or stats is None or value not in stats.columns:
+        return tuple(default)
+    low, high = (float(stats.loc[row, value]) for row in rows)
+    if math.isnan(low) or math.isnan(high):
+        return tuple(default)
+    return low, high
+
+
+# Corner j of a voxel is offset in x, y and z by bits 0, 1 and 2 of j, giving this vertex
+# order:
+# [
+#     [x, y, z],
+#     [x + x_dist, y, z],
+#     [x, y + y_dist, z],
+#     [x + x_dist, y + y_dist, z],
+#     [x, y, z + z_dist],
+#     [x + x_dist, y, z + z_dist],
+#     [x, y + y_dist, z + z_dist],
+#     [x + x_dist, y + y_dist, z + z_dist],
+# ]
+CUBE_CORNERS = (np.arange(8)[:, np.newaxis] >> np.arange(3)) & 1
+
+# Two triangles for each face of a voxel, as indices into its eight corners
+CUBE_TRIANGLES = np.array(
+    [
+        [0, 1, 2],
+        [0, 1, 4],
+        [0, 2, 4],
+        [4, 5, 1],
+        [4, 2, 6],
+        [4, 5, 6],
+        [3, 2, 6],
+        [3, 5, 1],
+        [3, 2, 1],
+        [7, 6, 5],
+        [7, 6, 3],
+        [7, 3, 5],
+    ]
+)
+
+
+# Neighbor direction and the four corners of the voxel face that points towards it
+CUBE_FACE_CORNERS = [
+    ((-1, 0, 0), [0, 2, 6, 4]),
+    ((1, 0, 0), [1, 3, 7, 5]),
+    ((0, -1, 0), [0, 1, 5, 4]),
+    ((0, 1, 0), [2, 3, 7, 6]),
+    ((0, 0, -1), [0, 1, 3, 2]),
+    ((0, 0, 1), [4, 5, 7, 6]),
+]
+
+
+def voxel_sizes(vol_measurements: pd.DataFrame) -> tuple:
+    """Returns the (X, Y, Z) size of a voxel from vol_measurements.csv"""
+    return tuple(vol_measurements.loc[0, [f"{a} Size" for a in "XYZ"]].to_list())
+
+
+def cube_offsets(sizes: tuple) -> np.ndarray:
+    """Returns the (8, 3) offsets from a voxel's center to its corners. Corners are pulled
+    in by 0.001 on the upper side so that neighboring cubes do not share vertices."""
+    half = np.asarray(sizes, dtype=np.float64) / 2
+    return np.where(CUBE_CORNERS == 1, half - 0.001, -half)
+
+
+def cube_faces(n: int) -> np.ndarray:
+    """Returns the (n * 12, 3) triangle indices for n cubes laid out 8 vertices apart."""
+    starts = np.arange(n)[:, np.newaxis, np.newaxis] * 8
+    return (starts + CUBE_TRIANGLES).reshape(-1, 3)
+
+
+def grid_shape(axes: dict) -> tuple:
+    """Returns the number of voxels along each axis of the regular grid from make_axes."""
+    return tuple(len(axes[a]) - 1 for a in "XYZ")
+
+
+def axis_centers(axes: dict, axis: str) -> np.ndarray:
+    """Returns the center of every voxel along an axis of the regular grid from make_axes."""
+    edges = np.asarray(axes[axis], dtype=np.float64)
+    return (edges[:-1] + edges[1:]) / 2
+
+
+def coarse_axes(axes: dict, factor: int) -> dict:
+    """Returns the axes of the grid made by merging factor x factor x factor voxels of the
+    regular grid from make_axes. The last cell along an axis is smaller if the number of
+    voxels is not a multiple of factor."""
+    coarse = {}
+    for a in "XYZ":
+        edges = list(axes[a])
+        coarse[a] = edges[::factor]
+        if (len(edges) - 1) % factor:
+            coarse[a].append(edges[-1])
+    return coarse
+
+
+def block_average(grid: np.ndarray, factor: int) -> np.ndarray:
+    """Averages a dense grid over factor x factor x factor blocks, ignoring NaN. Blocks
+    with no values are NaN."""
+    shape = [-(-n // factor) * factor for n in grid.shape]
+    padded = np.full(shape, np.nan, dtype=grid.dtype)
+    padded[: grid.shape[0], : grid.shape[1], : grid.shape[2]] = grid
+    blocks = padded.reshape(
+        shape[0] // factor,
+        factor,
+        shape[1] // factor,
+        factor,
+        shape[2] // factor,
+        factor,
+    )
+    counts = np.count_nonzero(~np.isnan(blocks), axis=(1, 3, 5))
+    sums = np.nansum(blocks, axis=(1, 3, 5))
+    return np.divide(
+        sums,
+        counts,
+        out=np.full(counts.shape, np.nan, dtype=grid.dtype),
+        where=counts > 0,
+    )
+
+
+def cell_cube_vertices(cells: np.ndarray, axes: dict) -> np.ndarray:
+    """Returns the (n, 8, 3) corners of the cells of a grid given as (n, 3) indices, in the
+    order of CUBE_CORNERS. Like cube_offsets, upper corners are pulled in by 0.001."""
+    lower = np.stack(
+        [
+            np.asarray(axes[a], dtype=np.float64)[cells[:, n]]
+            for n, a in enumerate("XYZ")
+        ],
+        axis=-1,
+    )
+    upper = np.stack(
+        [
+            np.asarray(axes[a], dtype=np.float64)[cells[:, n] + 1] - 0.001
+            for n, a in enumerate("XYZ")
+        ],
+        axis=-1,
+    )
+    return np.where(
+        CUBE_CORNERS[np.newaxis] == 1, upper[:, np.newaxis], lower[:, np.newaxis]
+    )
+
+
+def culled_cube_mesh(cells: np.ndarray, axes: dict) -> tuple:
+    """Builds the outer surface of a set of voxels on the regular grid from make_axes, given
+    as (n, 3) cell indices. Faces shared by two voxels are dropped and vertices shared by
+    neighboring voxels are merged. Returns the (m, 3) vertices, the (t, 3) triangles and,
+    for each triangle, the position in cells of the voxel it belongs to."""
+    shape = grid_shape(axes)
+    # pad the occupancy grid by one voxel on every side so neighbors are always in bounds
+    occupied = np.zeros([n + 2 for n in shape], dtype=bool)
+    padded = cells + 1
+    occupied[padded[:, 0], padded[:, 1], padded[:, 2]] = True
+
+    quads = []
+    quad_cells = []
+    for direction, corners in CUBE_FACE_CORNERS:
+        neighbors = padded + direction
+        visible = np.flatnonzero(
+            ~occupied[neighbors[:, 0], neighbors[:, 1], neighbors[:, 2]]
+        )
+        quads.append(cells[visible][:, np.newaxis, :] + CUBE_CORNERS[corners])
+        quad_cells.append(visible)
+    quads = np.concatenate(quads)
+    quad_cells = np.concatenate(quad_cells)
+
+    # number lattice points so that coincident vertices get the same id, then keep each
+    # point once
+    lattice = np.array(shape) + 1
+    ids = np.ravel_multi_index(quads.reshape(-1, 3).T, lattice).reshape(-1, 4)
+    point_ids, quad_vertices = np.unique(ids, return_inverse=True)
+    quad_vertices = quad_vertices.reshape(-1, 4)
+    points = np.stack(np.unravel_index(point_ids, lattice), axis=-1)
+    vertices = np.stack(
+        [
+            np.asarray(axes[a], dtype=np.float64)[points[:, i]]
+            for i, a in enumerate("XYZ")
+        ],
+        axis=-1,
+    )
+
+    # split each quad into two triangles
+    triangles = np.concatenate(
+        [quad_vertices[:, [0, 1, 2]], quad_vertices[:, [0, 2, 3]]], axis=1
+    ).reshape(-1, 3)
+    return vertices, triangles, np.repeat(quad_cells, 2)
+
+
+# The six tetrahedra a cube between eight grid points is split into for isosurface_mesh, as
+# corners in the order of CUBE_CORNERS. All of them share the diagonal from corner 0 to
+# corner 7, so neighboring cubes are split along the same face diagonals and the surface
+# has no cracks.
+CUBE_TETRAHEDRA = np.array(
+    [
+        [0, 1, 3, 7],
+        [0, 1, 5, 7],
+        [0, 2, 3, 7],
+        [0, 2, 6, 7],
+        [0, 4, 5, 7],
+        [0, 4, 6, 7],
+    ]
+)
+
+
+def tetrahedron_cases() -> list:
+    """Returns, for each pattern of tetrahedron corners at or above the threshold (bit c
+    set for corner c), the triangles of the surface inside the tetrahedron. A triangle is
+    three edges, each an (above, below) pair of corners that the surface cuts."""
+    cases = []
+    for code in range(16):
+        above = [c for c in range(4) if code >> c & 1]
+        below = [c for c in range(4) if not code >> c & 1]
+        if len(above) == 1:
+            cases.append([[(above[0], c) for c in below]])
+        elif len(above) == 3:
+            cases.append([[(c, below[0]) for c in above]])
+        elif len(above) == 2:
+            (a, b), (c, d) = above, below
+            # the surface is the quad ac, ad, bd, bc
+            cases.append([[(a, c), (a, d), (b, d)], [(a, c), (b, d), (b, c)]])
+        else:
+            cases.append([])
+    return cases
+
+
+TETRAHEDRON_CASES = tetrahedron_cases()
+
+
+def isosurface_mesh(grid: np.ndarray, axes: dict, threshold: float) -> tuple:
+    """Extracts the surface where a dense grid from VolumetricBlock.grid crosses threshold,
+    by marching tetrahedra between the voxel centers. Voxels without a value count as below
+    the threshold, and the grid is padded with such voxels so surfaces are closed at the
+    edge of the block. Returns the (m, 3) vertices and (t, 3) triangles, with vertices
+    shared by neighboring triangles merged and triangles facing away from higher values."""
+    finite = grid[~np.isnan(grid)]
+    if finite.size == 0 or finite.max() < threshold:
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+    low = min(finite.min(), threshold)
+    below = low - (finite.max() - low or 1)
+    values = np.pad(
+        np.where(np.isnan(grid), below, grid).astype(np.float64),
+        1,
+        constant_values=below,
+    )
+    shape = values.shape
+    # grid points are the voxel centers, plus one voxel beyond each end of every axis
+    coords = []
+    for a in "XYZ":
+        edges = np.asarray(axes[a], dtype=np.float64)
+        centers = axis_centers(axes, a)
+        coords.append(
+            np.concatenate(
+                [
+                    [centers[0] - (edges[1] - edges[0])],
+                    centers,
+                    [centers[-1] + (edges[-1] - edges[-2])],
+                ]
+            )
+        )
+
+    # only cubes with corners on both sides of the threshold hold part of the surface
+    above = values >= threshold
+    cube_shape = tuple(n - 1 for n in shape)
+    corners_above = [
+        above[dx : dx + cube_shape[0], dy : dy + cube_shape[1], dz : dz + cube_shape[2]]
+        for dx, dy, dz in CUBE_CORNERS
+    ]
+    mixed = np.logical_or.reduce(corners_above) & ~np.logical_and.reduce(corners_above)
+    origins = np.ravel_multi_index(np.nonzero(mixed), shape)
+    offsets = np.ravel_multi_index(CUBE_CORNERS.T, shape)
+    cube_corners = origins[:, np.newaxis] + offsets
+
+    # each triangle as three cut edges, each an (above, below) pair of grid points
+    cut_edges = []
+    flat_above = above.ravel()
+    for tetrahedron in CUBE_TETRAHEDRA:
+        points = cube_corners[:, tetrahedron]
+        codes = (flat_above[points] << np.arange(4)).sum(axis=1)
+        for code, triangles in enumerate(TETRAHEDRON_CASES):
+            selected = points[codes == code]
+            for triangle in triangles:
+                cut_edges.append(selected[:, np.array(triangle)])
+    cut_edges = np.concatenate(cut_edges)
+
+    # a vertex for every cut edge, placed by linear interpolation
+    keys = cut_edges[..., 0] * values.size + cut_edges[..., 1]
+    edge_keys, triangles = np.unique(keys, return_inverse=True)
+    triangles = triangles.reshape(-1, 3)
+    start, end = np.divmod(edge_keys, values.size)
+    flat_values = values.ravel()
+    t = (threshold - flat_values[start]) / (flat_values[end] - flat_values[start])
+
+    def position(points):
+        return np.stack(
+            [c[i] for c, i in zip(coords, np.unravel_index(points, shape))], axis=-1
+        )
+
+    vertices = position(start) + t[:, np.newaxis] * (position(end) - position(start))
+
+    # turn triangles whose normal points towards higher values
+    corners = vertices[triangles]
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    downhill = position(cut_edges[:, 0, 1]) - position(cut_edges[:, 0, 0])
+    flip = (normals * downhill).sum(axis=1) < 0
+    triangles[flip] = triangles[flip][:, ::-1]
+    return vertices, triangles
+
+
+def expand_cube_vertices(points_df: pd.DataFrame, sizes: tuple) -> pd.DataFrame:
+    """Returns a copy of points_df with every row repeated eight times, once for each corner
+    of the voxel around its center, with X/Y/Z Center replaced by the corner's coordinates.
+    Row i of points_df becomes rows 8 * i to 8 * i + 7 of the result."""
+    n = points_df.shape[0]
+    cubes_df = points_df.take(np.repeat(np.arange(n), 8))
+    cubes_df.index = np.repeat(points_df.index.to_numpy() * 8, 8) + np.tile(
+        np.arange(8), n
+    )
+    centers = points_df[["X Center", "Y Center", "Z Center"]].to_numpy(np.float64)
+    vertices = centers[:, np.newaxis, :] + cube_offsets(sizes)[np.newaxis]
+    cubes_df[["X Center", "Y Center", "Z Center"]] = vertices.reshape(-1, 3)
+    return cubes_df
+
+
+# Voxel coordinates keep double precision. Every other float column holds intensities,
+# which are kept as float32.
+COORDINATE_COLUMNS = ["X Center", "Y Center", "Z Center"]
+# Intensity columns with at least this share of missing values are stored sparsely
+SPARSE_MIN_NAN = 0.5
+
+
+class SparseColumn:
+    """A mostly-NaN intensity column, stored as a bitmap of the rows that have a value (see
+    np.packbits) and the float32 values of those rows."""
+
+    def __init__(self, valid: np.ndarray, values: np.ndarray, length: int):
+        self.valid = valid
+        self.values = values
+        self.length = length
+
+    @classmethod
+    def from_dense(cls, array: np.ndarray) -> "SparseColumn":
+        present = ~np.isnan(array)
+        return cls(
+            np.packbits(present), array[present].astype(np.float32), array.shape[0]
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return self.valid.nbytes + self.values.nbytes
+
+    def value(self, i: int) -> float:
+        """Returns the value of row i, or NaN, without densifying the column."""
+        bits = np.unpackbits(self.valid[: i // 8 + 1], count=i + 1)
+        return float(self.values[np.count_nonzero(bits[:i])]) if bits[i] else math.nan
+
+    def dense(self) -> np.ndarray:
+        """Returns the column as a float32 array with NaN for missing values."""
+        present = np.unpackbits(self.valid, count=self.length).astype(bool)
+        array = np.full(self.length, np.nan, dtype=np.float32)
+        array[present] = self.values
+        return array
+
+
+def compact_column(
+    name: str, array: np.ndarray | SparseColumn
+) -> np.ndarray | SparseColumn:
+    """Returns the form a column is kept in: intensities as float32, as a SparseColumn if
+    they are mostly NaN. Other columns are returned unchanged."""
+    if (
+        isinstance(array, SparseColumn)
+        or name in COORDINATE_COLUMNS
+        or array.dtype.kind != "f"
+    ):
+        return array
+    array = array.astype(np.float32, copy=False)
+    if array.shape[0] and np.isnan(array).mean() >= SPARSE_MIN_NAN:
+        return SparseColumn.from_dense(array)
+    return array
+
+
+def column_array(column: pd.Series) -> np.ndarray:
+    """Converts a column to the fixed dtype it is stored with in a column archive."""
+    column = column.infer_objects()
+    if pd.api.types.is_bool_dtype(column):
+        return column.to_numpy(dtype=bool)
+    elif pd.api.types.is_integer_dtype(column):
+        return column.to_numpy(dtype=np.int64)
+    elif column.name in COORDINATE_COLUMNS:
+        return column.to_numpy(dtype=np.float64)
+    elif pd.api.types.is_numeric_dtype(column):
+        return column.to_numpy(dtype=np.float32)
+    else:
+        return column.astype(str).to_numpy(dtype=str)
+
+
+def write_columns(df: pd.DataFrame, path: str) -> None:
+    """Writes a DataFrame as an uncompressed .npz archive holding one array per column, so
+    that it can be loaded without parsing text. Columns are stored in the form given by
+    compact_column."""
+    # Column names can contain characters that are not safe in archive member names, so
+    # members are numbered and the names are stored separately
+    arrays = {
+        "columns": np.array([str(c) for c in df.columns], dtype=str),
+        "rows": np.array([df.shape[0]]),
+    }
+    for i, column in enumerate(df.columns):
+        array = compact_column(str(column), column_array(df[column]))
+        if isinstance(array, SparseColumn):
+            arrays[f"c{i}_valid"] = array.valid
+            arrays[f"c{i}_values"] = array.values
+        else:
+            arrays[f"c{i}"] = array
+    with open(path, "wb") as f:
+        np.savez(f, **arrays)
+
+
+def map_member(path: str, member: str) -> np.ndarray | None:
+    """Memory-maps an array stored in an .npz archive read-only. Pages of a mapped file are
+    shared by every process that maps it, so gunicorn workers do not each hold a copy.
+    Returns None if the member cannot be mapped (compressed, empty or of object dtype)."""
+    with zipfile.ZipFile(path) as zf:
+        info = zf.getinfo(f"{member}.npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(path, "rb") as f:
+        # The member's data follows its local file header, which has a fixed 30 byte part
+        # followed by the file name and an extra field of variable length
+        f.seek(info.header_offset)
+        name_length, extra_length = struct.unpack("<HH", f.read(30)[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if dtype.hasobject or 0 in shape:
+        return None
+    return np.memmap(
+        path,
+        dtype=dtype,
+        mode="r",
+        offset=offset,
+        shape=shape,
+        order="F" if fortran_order else "C",
+    )
+
+
+def archive_columns(path: str) -> tuple[list[str], Callable]:
+    """Opens a column archive written by write_columns. Returns its column names and a
+    function that reads a column by name. Columns are memory-mapped rather than read where
+    possible, and sparse columns are returned as a SparseColumn."""
+    with np.load(path) as npz:
+        columns = [str(c) for c in npz["columns"]]
+        members = set(npz.files)
+        if "rows" in members:
+            length = int(npz["rows"][0])
+
+    def read_member(member):
+        mapped = map_member(path, member)
+        if mapped is not None:
+            return mapped
+        with np.load(path) as npz:
+            return npz[member]
+
+    def read_column(name):
+        member = f"c{columns.index(name)}"
+        if f"{member}_valid" in members:
+            return SparseColumn(
+                read_member(f"{member}_valid"), read_member(f"{member}_values"), length
+            )
+        return read_member(member)
+
+    return columns, read_column
+
+
+def read_columns(path: str) -> pd.DataFrame:
+    """Reads a column archive written by write_columns."""
+    columns, read_column = archive_columns(path)
+    data = {}
+    for name in columns:
+        array = read_column(name)
+        data[name] = array.dense() if isinstance(array, SparseColumn) else array
+    return pd.DataFrame(data)
+
+
+def voxel_source(directory: str, name: str) -> str:
+    """Returns the path of the file a block's voxel table is read from. A VTK image
+    (name.vti) and the column archive the config portal writes from a spreadsheet
+    (name.npz) are both uploads of the same table, so whichever was written last is used,
+    the image if both were written at the same time. Blocks published with neither are
+    read from name.csv."""
+    written = {}
+    for path in [f"{directory}/{name}.vti", f"{directory}/{name}.npz"]:
+        try:
+            written[path] = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            pass
+    if not written:
+        return f"{directory}/{name}.csv"
+    return max(written, key=written.get)
+
+
+def open_voxels(path: str, axes: dict | None = None) -> "VolumetricBlock":
+    """Opens a voxel table returned by voxel_source, placing the cells of a VTK image on
+    axes (see VolumetricBlock.from_vti)."""
+    if path.endswith(".vti"):
+        return VolumetricBlock.from_vti(path, axes)
+    if path.endswith(".npz"):
+        return VolumetricBlock.from_archive(path)
+    return VolumetricBlock.from_csv(path)
+
+
+class VolumetricBlock:
+    """Column-projected access to a block's voxel table. Coordinates are loaded when the
+    block is created and every other column is loaded the first time it is requested, so
+    memory use grows with the columns that are actually viewed. Arrays derived from the
+    columns, such as grids and masks, are cached in Memos of a few entries each."""
+
+    # Derived arrays kept per kind. Grids are kept for a few proteins at a couple of
+    # levels of detail, masks for the layers and a few categorical columns, and the others
+    # only depend on the axes and voxel sizes, which rarely change for a block.
+    MAX_GRIDS = 16
+    MAX_MASKS = 8
+    MAX_GEOMETRY = 2
+
+    def __init__(
+        self,
+        columns: list,
+        read_column: Callable[[str], np.ndarray],
+        grid_axes: dict | None = None,
+    ):
+        """grid_axes are the axes of a regular grid from make_axes whose cells are the
+        rows of the table in order, X varying fastest, as in a VTK image. Grids on those
+        axes are then reshaped from columns rather than scattered."""
+        self.columns = [str(c) for c in columns]
+        self._read_column = read_column
+        self._grid_key = (
+            None if grid_axes is None else tuple(tuple(grid_axes[a]) for a in "XYZ")
+        )
+        self._loaded = {}
+        self._cube_vertices = Memo(self.MAX_GEOMETRY)
+        self._grid_cells = Memo(self.MAX_GEOMETRY)
+        self._grids = Memo(self.MAX_GRIDS)
+        self._row_grids = Memo(self.MAX_GEOMETRY)
+        self._edges = Memo(self.MAX_GEOMETRY)
+        self._masks = Memo(self.MAX_MASKS)
+        self._dense = (None, None)
+        self.x = self.column("X Center")
+        self.y = self.column("Y Center")
+        self.z = self.column("Z Center")
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> "VolumetricBlock":
+        return cls(df.columns, lambda name: df[name].to_numpy())
+
+    @classmethod
+    def from_csv(cls, path: str) -> "VolumetricBlock":
+        """Opens a voxel table saved as a csv. Text has to be parsed from the start of the
+        file to find any column, so the whole file is parsed once, when the block is
+        opened. Columns are held as parsed until the block first requests them."""
+        columns = pd.read_csv(path, nrows=0).columns
+        lock = threading.Lock()
+        unread = {}
+        parsed = []
+
+        def read_column(name):
+            with lock:
+                if not parsed:
+                    unread.update(
+                        (str(c), s.to_numpy()) for c, s in pd.read_csv(path).items()
+                    )
+                    parsed.append(True)
+                if name in unread:
+                    return unread.pop(name)
+            # only reached if two threads load the same column at once
+            return pd.read_csv(path, usecols=[name])[name].to_numpy()
+
+        return cls(columns, read_column)
+
+    @classmethod
+    def from_archive(cls, path: str) -> "VolumetricBlock":
+        """Opens a column archive written by write_columns (see archive_columns)."""
+        return cls(*archive_columns(path))
+
+    @classmethod
+    def from_vti(cls, path: str, axes: dict | None = None) -> "VolumetricBlock":
+        """Opens the scalar cell arrays of a VTK ImageData file (see vti.ImageData) as a
+        voxel table with a row per cell. Cells are placed on the regular grid from
+        make_axes if axes is given, and by the file's origin and spacing otherwise. Raises
+        ValueError if the file does not have a cell for every voxel of axes."""
+        image = ImageData(path)
+        if axes is None:
+            axes = {
+                a: (origin + spacing * np.arange(low, low + n + 1)).tolist()
+                for a, origin, spacing, low, n in zip(
+                    "XYZ",
+                    image.origin,
+                    image.spacing,
+                    image.extent[::2],
+                    image.cell_shape,
+                )
+            }
+        elif grid_shape(axes) != image.cell_shape:
+            raise ValueError(
+                f"{path} has {image.cell_shape} cells, expected {grid_shape(axes)}"
+            )
+        centers = np.meshgrid(*[axis_centers(axes, a) for a in "XYZ"], indexing="ij")
+        coordinates = {
+            f"{a} Center": c.ravel(order="F") for a, c in zip("XYZ", centers)
+        }
+        names = [n for n in image.cell_arrays if image.components[n] == 1]
+
+        def read_column(name):
+            if name in coordinates:
+                return coordinates[name]
+            return image.cell_array(name)
+
+        return cls([*coordinates, *names], read_column, grid_axes=axes)
+
+    def __len__(self) -> int:
+        return self.x.shape[0]
+
+    def column(self, name: str) -> np.ndarray:
+        """Returns a column as a NumPy array, loading it on first use. Raises KeyError if the
+        block has no such column. Columns are kept in the form given by compact_column, and
+        only the most recently requested sparse column is kept dense as well."""
+        stored = self._stored(name)
+        if isinstance(stored, SparseColumn):
+            dense = self._dense
+            if dense[0] != name:
+                dense = (name, stored.dense())
+                self._dense = dense
+            return dense[1]
+        return stored
+
+    def _stored(self, name: str) -> np.ndarray | SparseColumn:
+        if name not in self._loaded:
+            if name not in self.columns:
+                raise KeyError(name)
+            self._loaded[name] = compact_column(name, self._read_column(name))
+        return self._loaded[name]
+
+    def row_values(self, row: int, names: list) -> dict:
+        """Returns the values of a row in the given columns. Sparse columns are read without
+        densifying them."""
+        values = {}
+        for name in names:
+            stored = self._stored(name)
+            if isinstance(stored, SparseColumn):
+                values[name] = stored.value(row)
+            else:
+                values[name] = stored[row].item()
+        return values
+
+    @property
+    def nbytes(self) -> int:
+        """Returns the size of the loaded columns, in the form they are kept."""
+        return sum(stored.nbytes for stored in self._loaded.values())
+
+    @property
+    def cache_nbytes(self) -> int:
+        """Returns the size of the cached arrays derived from the columns."""
+        return sum(
+            memo.nbytes
+            for memo in [
+                self._cube_vertices,
+                self._grid_cells,
+                self._grids,
+                self._row_grids,
+                self._edges,
+                self._masks,
+            ]
+        )
+
+    def cube_vertices(self, sizes: tuple) -> np.ndarray:
+        """Returns the (n, 8, 3) corners of the cube around every voxel. The result is
+        cached."""
+
+        def build():
+            centers = np.stack([self.x, self.y, self.z], axis=-1).astype(np.float64)
+            return centers[:, np.newaxis, :] + cube_offsets(sizes)[np.newaxis]
+
+        return self._cube_vertices.get(tuple(sizes), build)
+
+    def grid_cells(self, axes: dict) -> np.ndarray:
+        """Returns the (n, 3) index of the cell of the regular grid from make_axes that each
+        voxel's center falls in. The result is cached."""
+
+        def build():
+            cells = [
+                np.searchsorted(axes[a], coords, side="right") - 1
+                for a, coords in zip("XYZ", [self.x, self.y, self.z])
+            ]
+            return np.stack(
+                [np.clip(c, 0, n - 1) for c, n in zip(cells, grid_shape(axes))],
+                axis=-1,
+            )
+
+        return self._grid_cells.get(tuple(tuple(axes[a]) for a in "XYZ"), build)
+
+    def grid(self, name: str, axes: dict, factor: int = 1) -> np.ndarray:
+        """Returns a column scattered into a dense (nx, ny, nz) array on the regular grid
+        from make_axes, with NaN where the block has no voxel. A layer of the block is then
+        grid[:, :, k]. If factor is above 1, the grid is averaged over blocks of factor
+        voxels along each axis, matching coarse_axes(axes, factor). The result is cached."""
+        key = (name, tuple(tuple(axes[a]) for a in "XYZ"), factor)
+
+        def build():
+            if factor > 1:
+                return block_average(self.grid(name, axes), factor)
+            if key[1] == self._grid_key:
+                # the rows are the cells of this grid
+                return self.column(name).reshape(grid_shape(axes), order="F")
+            column = self.column(name)
+            grid = np.full(grid_shape(axes), np.nan, np.result_type(column, np.float32))
+            cells = self.grid_cells(axes)
+            grid[cells[:, 0], cells[:, 1], cells[:, 2]] = column
+            return grid
+
+        return self._grids.get(key, build)
+
+    def row_grid(self, axes: dict) -> np.ndarray:
+        """Returns a dense (nx, ny, nz) array on the regular grid from make_axes holding the
+        row of the voxel in each cell, or -1 where the block has no voxel. The result is
+        cached."""
+
+        def build():
+            rows = np.full(grid_shape(axes), -1, dtype=np.int64)
+            cells = self.grid_cells(axes)
+            rows[cells[:, 0], cells[:, 1], cells[:, 2]] = np.arange(len(self))
+            return rows
+
+        return self._row_grids.get(tuple(tuple(axes[a]) for a in "XYZ"), build)
+
+    def axis_edges(self, axes: dict) -> list:
+        """Returns the cell edges along each axis of the regular grid from make_axes as
+        float arrays. The result is cached."""
+        return self._edges.get(
+            tuple(tuple(axes[a]) for a in "XYZ"),
+            lambda: [np.asarray(axes[a], dtype=np.float64) for a in "XYZ"],
+        )
+
+    def find_row(
+        self,
+        point,
+        axes: dict,
+        tolerance: float = 0.01,
+        selected: np.ndarray | None = None,
+    ) -> int | None:
+        """Returns the row of the voxel at an (x, y, z) point of a figure of the block, such
+        as a clicked vertex, or None if there is none. A point within tolerance of a cell
+        boundary, like a vertex shared by neighboring cubes, may belong to the cells on
+        either side; the cell the point falls in is tried first. If selected holds the rows
+        drawn in the figure, e.g. from select and crop_rows, only those are considered, so a
+        face on the edge of a selection is not taken for the hidden voxel behind it."""
+        rows = self.row_grid(axes)
+        if selected is not None:
+            drawn = np.zeros(len(self), dtype=bool)
+            drawn[selected] = True
+            rows = np.where((rows >= 0) & drawn[rows], rows, -1)
+        options = []
+        for edges, coord, n in zip(self.axis_edges(axes), point, rows.shape):
+            cell = np.searchsorted(edges, coord, side="right") - 1
+            low = np.searchsorted(edges, coord - tolerance, side="right") - 1
+            high = np.searchsorted(edges, coord + tolerance, side="right") - 1
+            near = [cell] + [k for k in range(low, high + 1) if k != cell]
+            options.append([k for k in near if 0 <= k < n])
+        for cell in itertools.product(*options):
+            if rows[cell] >= 0:
+                return int(rows[cell])
+        return None
+
+    def box_rows(self, axes: dict, low, high) -> np.ndarray:
+        """Returns the sorted rows of the voxels whose centers lie in the axis-aligned box
+        from low to high, both (x, y, z) and inclusive. Only the cells of row_grid that
+        overlap the box are visited, so the cost grows with the box rather than the block."""
+        rows = self.row_grid(axes)
+        cells = []
+        for edges, lo, hi, n in zip(self.axis_edges(axes), low, high, rows.shape):
+            start = max(np.searchsorted(edges, lo, side="right") - 1, 0)
+            stop = min(np.searchsorted(edges, hi, side="right"), n)
+            cells.append(slice(start, max(start, stop)))
+        found = rows[tuple(cells)]
+        found = np.sort(found[found >= 0])
+        inside = np.ones(found.shape[0], dtype=bool)
+        for coords, lo, hi in zip([self.x, self.y, self.z], low, high):
+            inside &= (coords[found] >= lo) & (coords[found] <= hi)
+        return found[inside]
+
+    def radius_rows(self, axes: dict, center, radius: float) -> np.ndarray:
+        """Returns the sorted rows of the voxels whose centers lie within radius of an
+        (x, y, z) center."""
+        center = np.asarray(center, dtype=np.float64)
+        found = self.box_rows(axes, center - radius, center + radius)
+        offsets = np.stack([self.x[found], self.y[found], self.z[found]], axis=-1)
+        return found[((offsets - center) ** 2).sum(axis=1) <= radius**2]
+
+    def crop_rows(self, rows: np.ndarray, axes: dict, roi: dict | None) -> np.ndarray:
+        """Narrows sorted rows to a region of interest given as {"X": [min, max], "Y": ...,
+        "Z": ...}, or returns them unchanged if roi is None."""
+        if not roi:
+            return rows
+        low, high = zip(*(roi[a] for a in "XYZ"))
+        found = self.box_rows(axes, low, high)
+        selected = np.zeros(len(self), dtype=bool)
+        selected[rows] = True
+        return found[selected[found]]
+
+    def layer_masks(self, z_axis: list) -> list:
+        """Returns a packed bitmask (see np.packbits) of the rows in each layer, built for
+        all layers at once. The result is cached."""
+
+        def build():
+            layers = np.searchsorted(z_axis, self.z, side="right") - 1
+            return [np.packbits(layers == k) for k in range(len(z_axis) - 1)]
+
+        return self._masks.get(("layers", tuple(z_axis)), build)
+
+    def value_masks(self, name: str) -> dict:
+        """Returns a packed bitmask of the rows holding each value of a categorical column,
+        built for all values at once. The result is cached."""
+
+        def build():
+            values, inverse = np.unique(self.column(name), return_inverse=True)
+            return {
+                value: np.packbits(inverse == i)
+                for i, value in enumerate(values.tolist())
+            }
+
+        return self._masks.get(name, build)
+
+    def mask_rows(self, masks: list) -> np.ndarray:
+        """Returns the rows set in all of the packed bitmasks, or every row if there are
+        none. The masks are combined with a bitwise AND before they are unpacked, so each
+        extra mask only costs one pass over len(self) / 8 bytes."""
+        if not masks:
+            return np.arange(len(self))
+        combined = np.bitwise_and.reduce(masks) if len(masks) > 1 else masks[0]
+        # unpacked bits are 0 or 1, so they can be read as booleans, which is much faster
+        # to search than uint8
+        return np.flatnonzero(np.unpackbits(combined, count=len(self)).view(bool))
+
+    def select(
+        self,
+        layer: str,
+        z_axis: list,
+        category_opt: str = "All",
+        category_labels: dict | None = None,
+        filters: dict | None = None,
+    ) -> np.ndarray:
+        """Returns the indices of the rows in a layer ("All" or "Layer <n>") that match a
+        category option from category_labels.csv and hold the given value of each
+        categorical column in filters. No row matches a filter on a column the block does
+        not have, such as the Category of a VTK image without that array."""
+        category_labels = category_labels or {}
+        filters = filters or {}
+        masks = []
+        if layer != "All":
+            masks.append(self.layer_masks(z_axis)[int(layer.split()[-1]) - 1])
+        if category_opt == category_labels.get("Label (Only True)"):
+            filters = {**filters, "Category": True}
+        elif category_opt == category_labels.get("Label (Only False)"):
+            filters = {**filters, "Category": False}
+        for name, value in filters.items():
+            found = None
+            if name in self.columns:
+                found = self.value_masks(name).get(value)
+            if found is None:
+                # no row holds this value
+                found = np.zeros((len(self) + 7) // 8, dtype=np.uint8)
+            masks.append(found)
+        return self.mask_rows(masks)
@@ -0,0 +1,208 @@
+import base64
+import lzma
+import xml.etree.ElementTree as ET
+import zlib
+
+import numpy as np
+
+# Reads VTK ImageData (.vti) files, the XML format VTK and ParaView write volumes in, with
+# NumPy alone. See https://docs.vtk.org/en/latest/design_documents/VTKFileFormats.html
+
+# NumPy types of VTK's data array types
+VTK_TYPES = {
+    "Int8": "i1",
+    "UInt8": "u1",
+    "Int16": "i2",
+    "UInt16": "u2",
+    "Int32": "i4",
+    "UInt32": "u4",
+    "Int64": "i8",
+    "UInt64": "u8",
+    "Float32": "f4",
+    "Float64": "f8",
+}
+DECOMPRESSORS = {
+    "vtkZLibDataCompressor": zlib.decompress,
+    "vtkLZMADataCompressor": lzma.decompress,
+}
+
+
+def base64_length(n_bytes: int) -> int:
+    """Returns the number of base64 characters that encode n_bytes bytes."""
+    return -(-n_bytes // 3) * 4
+
+
+class ImageData:
+    """The arrays of a VTK ImageData file on its regular grid. Arrays may be stored as
+    ascii, inline binary or appended data, base64-encoded or raw, and compressed with zlib
+    or lzma. The file is read once and each array is decoded the first time it is
+    requested. Raises ValueError if the file is not a valid ImageData file in one of these
+    forms. content, if given, is used as the file's bytes instead of reading path, which
+    then only names the file in errors.
+
+    A grid of extent [x0, x1, y0, y1, z0, z1] has (x1 - x0 + 1) x (y1 - y0 + 1) x
+    (z1 - z0 + 1) points and one cell fewer along each axis. Arrays are returned in VTK
+    order, with X varying fastest, then Y, then Z."""
+
+    def __init__(self, path: str, content: bytes | None = None):
+        if content is None:
+            with open(path, "rb") as f:
+                content = f.read()
+        # Raw appended data is not valid XML, so only the markup before it is parsed
+        self._appended = None
+        self._appended_encoding = None
+        start = content.find(b"<AppendedData")
+        try:
+            if start >= 0:
+                tag_end = content.index(b">", start)
+                tag = ET.fromstring(content[start:tag_end].rstrip(b"/") + b"/>")
+                self._appended_encoding = tag.get("encoding", "raw")
+                self._appended = memoryview(content)[content.index(b"_", tag_end) + 1 :]
+                content = content[:start] + b"</VTKFile>"
+            root = ET.fromstring(content)
+        except (ET.ParseError, ValueError) as e:
+            raise ValueError(f"{path} is not a VTK XML file: {e}")
+
+        if root.tag != "VTKFile" or root.get("type") != "ImageData":
+            raise ValueError(f"{path} is not a VTK ImageData file")
+        byte_order = (
+            "<" if root.get("byte_order", "LittleEndian") == "LittleEndian" else ">"
+        )
+        self._byte_order = byte_order
+        self._header_type = np.dtype(
+            byte_order + VTK_TYPES[root.get("header_type", "UInt32")]
+        )
+        compressor = root.get("compressor")
+        if compressor is not None and compressor not in DECOMPRESSORS:
+            raise ValueError(f"{path} is compressed with unsupported {compressor}")
+        self._decompress = DECOMPRESSORS.get(compressor)
+
+        image = root.find("ImageData")
+        if image is None:
+            raise ValueError(f"{path} has no ImageData element")
+        self.extent = [int(n) for n in image.get("WholeExtent").split()]
+        self.origin = [float(n) for n in image.get("Origin", "0 0 0").split()]
+        self.spacing = [float(n) for n in image.get("Spacing", "1 1 1").split()]
+
+        # the elements of each array in every piece of the grid
+        self._arrays = {"PointData": {}, "CellData": {}}
+        # the number of components of each array, 1 for scalars
+        self.components = {}
+        for piece in image.iter("Piece"):
+            extent = [int(n) for n in piece.get("Extent", "").split()] or self.extent
+            for kind, arrays in self._arrays.items():
+                for array in piece.findall(f"{kind}/DataArray"):
+                    arrays.setdefault(array.get("Name"), []).append((extent, array))
+                    self.components[array.get("Name")] = int(
+                        array.get("NumberOfComponents", 1)
+                    )
+        self.point_arrays = list(self._arrays["PointData"])
+        self.cell_arrays = list(self._arrays["CellData"])
+
+    @property
+    def point_shape(self) -> tuple[int, int, int]:
+        """Returns the number of points of the grid along X, Y and Z."""
+        return tuple(self.extent[2 * a + 1] - self.extent[2 * a] + 1 for a in range(3))
+
+    @property
+    def cell_shape(self) -> tuple[int, int, int]:
+        """Returns the number of cells of the grid along X, Y and Z."""
+        return tuple(max(n - 1, 1) for n in self.point_shape)
+
+    def point_array(self, name: str) -> np.ndarray:
+        """Returns a point array as a flat array in VTK order, or (n, components) for arrays
+        with several components. Raises KeyError if there is no such array."""
+        return self._read("PointData", name, self.point_shape, cells=False)
+
+    def cell_array(self, name: str) -> np.ndarray:
+        """Returns a cell array as a flat array in VTK order, or (n, components) for arrays
+        with several components. Raises KeyError if there is no such array."""
+        return self._read("CellData", name, self.cell_shape, cells=True)
+
+    def _read(self, kind: str, name: str, shape: tuple, cells: bool) -> np.ndarray:
+        pieces = self._arrays[kind][name]
+        if len(pieces) == 1 and pieces[0][0] == self.extent:
+            return self._decode_array(pieces[0][1])
+        # Pieces are copied into their part of the whole grid, in (z, y, x) order
+        whole = None
+        for extent, element in pieces:
+            values = self._decode_array(element)
+            components = values.shape[1:]
+            if whole is None:
+                whole = np.full(
+                    shape[::-1] + components, np.nan, np.result_type(values, np.float32)
+                )
+            parts = []
+            for a in range(3):
+                low = extent[2 * a] - self.extent[2 * a]
+                high = extent[2 * a + 1] - self.extent[2 * a] + (0 if cells else 1)
+                parts.append(slice(low, max(high, low + 1)))
+            target = whole[tuple(parts[::-1])]
+            target[...] = values.reshape(target.shape)
+        return whole.reshape((-1,) + whole.shape[3:])
+
+    def _decode_array(self, element) -> np.ndarray:
+        dtype = np.dtype(self._byte_order + VTK_TYPES[element.get("type")])
+        components = int(element.get("NumberOfComponents", 1))
+        data_format = element.get("format")
+        if data_format == "ascii":
+            values = np.array((element.text or "").split(), dtype=dtype)
+        elif data_format == "binary":
+            text = "".join((element.text or "").split()).encode()
+            values = np.frombuffer(self._decode_binary(text, encoded=True), dtype)
+        elif data_format == "appended":
+            if self._appended is None:
+                raise ValueError(f"Array {element.get('Name')} has no appended data")
+            data = self._appended[int(element.get("offset", 0)) :]
+            encoded = self._appended_encoding == "base64"
+            values = np.frombuffer(self._decode_binary(data, encoded), dtype)
+        else:
+            raise ValueError(
+                f"Array {element.get('Name')} has unknown format {data_format}"
+            )
+        # native byte order, so the values can be used like any other array
+        values = values.astype(dtype.newbyteorder("="), copy=False)
+        return values.reshape(-1, components) if components > 1 else values
+
+    def _header(self, data, encoded: bool, count: int) -> np.ndarray:
+        """Reads the first count integers of the header of a binary array."""
+        size = count * self._header_type.itemsize
+        if encoded:
+            header = base64.b64decode(bytes(data[: base64_length(size)]))[:size]
+        else:
+            header = bytes(data[:size])
+        if len(header) < size:
+            raise ValueError("Binary data array is truncated")
+        return np.frombuffer(header, self._header_type).astype(np.int64)
+
+    def _decode_binary(self, data, encoded: bool) -> bytes:
+        """Returns the bytes of a binary array, from its data: the text of an inline array or
+        the appended data from the array's offset on."""
+        item = self._header_type.itemsize
+        if self._decompress is None:
+            # the header is the size of the array in bytes. Encoded, the header and the
+            # array are a single base64 string.
+            (size,) = self._header(data, encoded, 1)
+            if encoded:
+                decoded = base64.b64decode(bytes(data[: base64_length(item + size)]))
+                return decoded[item : item + size]
+            return bytes(data[item : item + size])
+
+        # The header is the number of blocks, the size of a block before compression, the
+        # size of the last block and the compressed size of each block. Encoded, the
+        # header and the blocks are separate base64 strings.
+        (blocks,) = self._header(data, encoded, 1)
+        header = self._header(data, encoded, 3 + blocks)
+        sizes = header[3:]
+        if encoded:
+            start = base64_length((3 + blocks) * item)
+            end = start + base64_length(int(sizes.sum()))
+            body = base64.b64decode(bytes(data[start:end]))
+        else:
+            start = (3 + blocks) * item
+            body = data[start : start + int(sizes.sum())]
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        return b"".join(
+            self._decompress(bytes(body[low:high]))
+            for low, high in zip(offsets[:-1], offsets[1:])
+        )
@@ -15,6 +15,7 @@ from collections.abc import Callable
 import numpy as np
 
 from pages import constants
+from components import figures, volumetric, vti
 
 MAX_TITLE_LENGTH = 2048
 MAX_FILENAME_LENGTH = 255
@@ -836,76 +837,6 @@ def get_volumetric_map_folder(filename):
     return True, block.iloc[0]
 
 
-def make_cubes_df(
-    points_df: pd.DataFrame, vol_measurements: pd.DataFrame
-) -> pd.DataFrame:
-    """For each point representing the center of a rectangular prism, calculates eight points representing
-    its vertices."""
-    # Vertices are ordered as follows:
-    # [
-    #     [x, y, z],
-    #     [x + x_dist, y, z],
-    #     [x, y + y_dist, z],
-    #     [x + x_dist, y + y_dist, z],
-    #     [x, y, z + z_dist],
-    #     [x + x_dist, y, z + z_dist],
-    #     [x, y + y_dist, z + z_dist],
-    #     [x + x_dist, y + y_dist, z + z_dist],
-    # ]
-
-    x_transform = vol_measurements.loc[0, "X Size"] / 2
-    y_transform = vol_measurements.loc[0, "Y Size"] / 2
-    z_transform = vol_measurements.loc[0, "Z Size"] / 2
-
-    transform = {
-        "x": [
-            -x_transform,
-            x_transform - 0.001,
-            -x_transform,
-            x_transform - 0.001,
-            -x_transform,
-            x_transform - 0.001,
-            -x_transform,
-            x_transform - 0.001,
-        ],
-        "y": [
-            -y_transform,
-            -y_transform,
-            y_transform - 0.001,
-            y_transform - 0.001,
-            -y_transform,
-            -y_transform,
-            y_transform - 0.001,
-            y_transform - 0.001,
-        ],
-        "z": [
-            -z_transform,
-            -z_transform,
-            -z_transform,
-            -z_transform,
-            z_transform - 0.001,
-            z_transform - 0.001,
-            z_transform - 0.001,
-            z_transform - 0.001,
-        ],
-    }
-
-    cubes_df = pd.DataFrame().reindex(columns=points_df.columns)
-    # for each row in the source df, make 8 rows in the new df. Each row represents a vertex of a rectangular
-    # prism around the provided point
-    for i in points_df.index:
-        new_x = [points_df.loc[i, "X Center"] + x for x in transform["x"]]
-        new_y = [points_df.loc[i, "Y Center"] + y for y in transform["y"]]
-        new_z = [points_df.loc[i, "Z Center"] + z for z in transform["z"]]
-        for j in range(8):
-            idx = j + (i * 8)
-            cubes_df.loc[idx] = points_df.loc[i]
-            cubes_df.loc[idx, "X Center"] = new_x[j]
-            cubes_df.loc[idx, "Y Center"] = new_y[j]
-            cubes_df.loc[idx, "Z Center"] = new_z[j]
-    return cubes_df
-
-
 def check_volumetric_map_data_xlsx(file: bytes) -> tuple[bool, str]:
     header_check = check_excel_headers(file, "volumetric-map", fillna=False)
     if header_check[0]:
@@ -920,12 +851,15 @@ def check_volumetric_map_data_xlsx(file: bytes) -> tuple[bool, str]:
             if key == "points_data":
                 # data must be sorted for Dash to display it correctly
                 item.sort_values(by=["X Center", "Y Center", "Z Center"], inplace=True)
+                # binary copy of the voxel table, which the display app reads in preference
+                # to the csv
+                volumetric.write_columns(item, f"{loc}/{key}.npz")
             item.to_csv(f"{loc}/{key}.csv", index=False)
-        # create cubes csv
-        cubes_df = make_cubes_df(
-            header_check[2]["points_data"], header_check[2]["vol_measurements"]
-        )
-        cubes_df.to_csv(f"{loc}/cube_data.csv", index=False)
+        # statistics of every protein, so the display app can offer per-protein color
+        # ranges and histograms without reading the voxel data
+        points = header_check[2]["points_data"]
+        values = [c for c in header_check[2]["value_ranges"].columns if c in points]
+        volumetric.value_stats(points, values).to_csv(f"{loc}/value_stats.csv")
         return True, ""
     else:
         return False, header_check[1]
@@ -940,6 +874,34 @@ def save_generic_file(loc: str, file: bytes, filename: str) -> tuple[bool, str]:
     return True, ""
 
 
+def check_vti_file(loc: str, file: bytes, filename: str) -> tuple[bool, str]:
+    """Checks that an uploaded VTK image can be read before it is saved, since the display
+    app uses points_data.vti as a block's voxel data. The image must have a scalar cell
+    array for the Category filter and, once the block's value ranges have been uploaded,
+    for each of its proteins. If the block's measurements have been uploaded, it must
+    have a cell for every voxel of the block."""
+    try:
+        image = vti.ImageData(filename, file)
+        if image.cell_arrays:
+            image.cell_array(image.cell_arrays[0])
+    except (ValueError, KeyError) as err:
+        return False, f"{filename} is not a readable VTK image: {err}"
+    required = ["Category"]
+    if os.path.exists(f"{loc}/value_ranges.csv"):
+        ranges = pd.read_csv(f"{loc}/value_ranges.csv", index_col="Row Label")
+        required.extend(str(c) for c in ranges.columns)
+    scalars = {n for n in image.cell_arrays if image.components[n] == 1}
+    missing = [n for n in required if n not in scalars]
+    if missing:
+        return False, f"{filename} has no scalar cell array for {", ".join(missing)}"
+    if os.path.exists(f"{loc}/vol_measurements.csv"):
+        axes = volumetric.make_axes(pd.read_csv(f"{loc}/vol_measurements.csv"))
+        shape = volumetric.grid_shape(axes)
+        if shape != image.cell_shape:
+            return False, f"{filename} has {image.cell_shape} cells, expected {shape}"
+    return True, ""
+
+
 def process_volumetric_map_data(file: bytes, filename: str) -> tuple[bool, str]:
     """Takes a file, checks the headers if metadata file, and saves them file to the depot.
     Overwrites file if it already exists.
@@ -972,6 +934,10 @@ def process_volumetric_map_data(file: bytes, filename: str) -> tuple[bool, str]:
             if not block[0]:
                 return False, block[1]
             loc = f"{FD["volumetric-map"]["downloads"]["depot"]}/{block[1]}"
+            if filename == "points_data.vti":
+                checked = check_vti_file(loc, file, filename)
+                if not checked[0]:
+                    return checked
             return save_generic_file(loc, file, filename)
         except Exception as err:
             app_logger.debug(traceback.print_exc())
@@ -1004,6 +970,16 @@ def publish_entries(src: str, dest: str, key_col: str):
         old_list.to_csv(dest, index=False)
 
 
+def prerender_volumetric_map(block_dir: str) -> None:
+    """Prerenders the default figures of a published block, so that the first visitor does
+    not wait for them to be built. The public-facing app builds them itself if this fails."""
+    try:
+        figures.prerender_default_views(block_dir)
+    except Exception:
+        app_logger.warning(f"Could not prerender figures for {block_dir}")
+        app_logger.debug(traceback.print_exc())
+
+
 def publish_volumetric_map_data() -> tuple[str, str, str]:
     """Publishes volumetric map data.
     Returns (title of update toast, description of update, success status)"""
@@ -1012,9 +988,9 @@ def publish_volumetric_map_data() -> tuple[str, str, str]:
     dirs_to_move = [x for x in p.iterdir() if x.is_dir()]
     try:
         for item in dirs_to_move:
-            move_dir(
-                item, f"{FD["volumetric-map"]["downloads"]["publish"]}/{item.name}"
-            )
+            block_dir = f"{FD["volumetric-map"]["downloads"]["publish"]}/{item.name}"
+            move_dir(item, block_dir)
+            prerender_volumetric_map(block_dir)
         # update entries in published downloads.csv
         publish_entries(
             FD["volumetric-map"]["downloads-file"]["depot"],
@@ -0,0 +1,63 @@
+# Compares the memory taken by data tables as loaded by pandas and as kept by
+# VolumetricBlock (float32 intensities, mostly-NaN columns stored sparsely), then measures
+# the arrays a block derives from its columns once every protein has been viewed. Run from
+# the display app folder, e.g. python ../scripts/bench-block-memory.py assets/HuBMAP_ili_data10-11-24.csv
+import argparse
+import os
+import sys
+
+import pandas as pd
+
+if os.getcwd() not in sys.path:
+    sys.path.append(os.getcwd())
+from components import volumetric
+from pages.constants import FILE_DESTINATION as FD
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "paths",
+    nargs="*",
+    default=[
+        "assets/HuBMAP_ili_data10-11-24.csv",
+        f"{FD["volumetric-map"]}/P1-20C/points_data.csv",
+    ],
+)
+parser.add_argument("--block", default="P1-20C")
+args = parser.parse_args()
+
+print(f"{'table':<44}{'rows':>7}{'columns':>9}{'sparse':>8}{'pandas':>11}{'block':>11}")
+for path in args.paths:
+    df = pd.read_csv(path)
+    before = int(df.memory_usage(deep=True).sum())
+    after = 0
+    sparse = 0
+    for name in df.columns:
+        stored = volumetric.compact_column(str(name), volumetric.column_array(df[name]))
+        sparse += isinstance(stored, volumetric.SparseColumn)
+        after += stored.nbytes
+    print(
+        f"{os.path.basename(path):<44}{df.shape[0]:>7}{df.shape[1]:>9}{sparse:>8}"
+        f"{before:>11}{after:>11}"
+    )
+
+# Grids of every protein at full resolution and averaged, layer and category masks and the
+# cube geometry, each kind bounded by the MAX_* limits of VolumetricBlock
+loc = f"{FD["volumetric-map"]}/{args.block}"
+vol_measurements = pd.read_csv(f"{loc}/vol_measurements.csv")
+axes = volumetric.make_axes(vol_measurements)
+proteins = pd.read_csv(f"{loc}/value_ranges.csv", index_col="Row Label").columns
+voxels = volumetric.VolumetricBlock.from_csv(f"{loc}/points_data.csv")
+for name in proteins:
+    voxels.grid(name, axes)
+    voxels.grid(name, axes, 2)
+voxels.layer_masks(axes["Z"])
+if "Category" in voxels.columns:
+    voxels.value_masks("Category")
+voxels.cube_vertices(volumetric.voxel_sizes(vol_measurements))
+voxels.row_grid(axes)
+print()
+print(f"{'block':<44}{'proteins':>9}{'grids':>7}{'columns':>11}{'derived':>11}")
+print(
+    f"{args.block:<44}{len(proteins):>9}{len(voxels._grids):>7}"
+    f"{voxels.nbytes:>11}{voxels.cache_nbytes:>11}"
+)
@@ -0,0 +1,58 @@
+# Compares the full and culled Cube View meshes of a published block. Run from the display
+# app folder, e.g. python ../scripts/bench-cube-mesh.py P1-20C --tile 10
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+if os.getcwd() not in sys.path:
+    sys.path.append(os.getcwd())
+from components import figures, volumetric
+from pages.constants import FILE_DESTINATION as FD
+
+parser = argparse.ArgumentParser()
+parser.add_argument("block", nargs="?", default="P1-20C")
+parser.add_argument(
+    "--tile",
+    type=int,
+    default=1,
+    help="repeat the block this many times along X to simulate a larger block",
+)
+args = parser.parse_args()
+
+loc = f"{FD["volumetric-map"]}/{args.block}"
+points = pd.read_csv(f"{loc}/points_data.csv")
+vol_measurements = pd.read_csv(f"{loc}/vol_measurements.csv")
+labels = pd.read_csv(f"{loc}/category_labels.csv").iloc[0].to_dict()
+value = pd.read_csv(f"{loc}/value_ranges.csv").columns[1]
+
+width = vol_measurements.loc[0, "X Max"] - vol_measurements.loc[0, "X Min"]
+points = pd.concat(
+    [
+        points.assign(**{"X Center": points["X Center"] + k * width})
+        for k in range(args.tile)
+    ],
+    ignore_index=True,
+)
+vol_measurements.loc[0, "X Max"] += (args.tile - 1) * width
+axes = volumetric.make_axes(vol_measurements)
+voxels = volumetric.VolumetricBlock.from_dataframe(points)
+sizes = volumetric.voxel_sizes(vol_measurements)
+
+print(f"{args.block} x{args.tile}: {len(voxels)} voxels, protein {value}")
+print(f"{'mesh':<8}{'vertices':>10}{'triangles':>11}{'json bytes':>12}{'seconds':>9}")
+for culled in [False, True]:
+    start = time.perf_counter()
+    fig = figures.make_cube_fig(
+        axes, (0, 1), labels, voxels, sizes, value=value, culled=culled
+    )
+    json_bytes = len(fig.to_json())
+    elapsed = time.perf_counter() - start
+    trace = fig["data"][0]
+    print(
+        f"{'culled' if culled else 'full':<8}{np.size(trace['x']):>10}"
+        f"{np.size(trace['i']):>11}{json_bytes:>12}{elapsed:>9.3f}"
+    )
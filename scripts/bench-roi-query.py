@@ -0,0 +1,68 @@
+# Times region of interest queries on a published block against a boolean scan of the
+# voxel table. Run from the display app folder, e.g.
+# python ../scripts/bench-roi-query.py P1-20C --tile 300
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+if os.getcwd() not in sys.path:
+    sys.path.append(os.getcwd())
+from components import volumetric
+from pages.constants import FILE_DESTINATION as FD
+
+parser = argparse.ArgumentParser()
+parser.add_argument("block", nargs="?", default="P1-20C")
+parser.add_argument(
+    "--tile",
+    type=int,
+    default=1,
+    help="repeat the block this many times along X to simulate a larger block",
+)
+args = parser.parse_args()
+
+loc = f"{FD["volumetric-map"]}/{args.block}"
+points = pd.read_csv(f"{loc}/points_data.csv")
+vol_measurements = pd.read_csv(f"{loc}/vol_measurements.csv")
+
+width = vol_measurements.loc[0, "X Max"] - vol_measurements.loc[0, "X Min"]
+points = pd.concat(
+    [
+        points.assign(**{"X Center": points["X Center"] + k * width})
+        for k in range(args.tile)
+    ],
+    ignore_index=True,
+)
+vol_measurements.loc[0, "X Max"] += (args.tile - 1) * width
+axes = volumetric.make_axes(vol_measurements)
+voxels = volumetric.VolumetricBlock.from_dataframe(points)
+voxels.row_grid(axes)
+
+# a box of about 5 x 5 x 5 voxels in the middle of the block, and a sphere inside it
+sizes = np.array(volumetric.voxel_sizes(vol_measurements), dtype=np.float64)
+center = np.array([np.median(voxels.x), np.median(voxels.y), np.median(voxels.z)])
+low, high = center - 2.5 * sizes, center + 2.5 * sizes
+radius = 2.5 * sizes.min()
+
+
+def scan():
+    inside = np.ones(len(voxels), dtype=bool)
+    for coords, lo, hi in zip([voxels.x, voxels.y, voxels.z], low, high):
+        inside &= (coords >= lo) & (coords <= hi)
+    return np.flatnonzero(inside)
+
+
+assert np.array_equal(scan(), voxels.box_rows(axes, low, high))
+print(f"{args.block} x{args.tile}: {len(voxels)} voxels")
+print(f"{'query':<8}{'rows':>7}{'ms':>9}")
+for name, query in [
+    ("scan", scan),
+    ("box", lambda: voxels.box_rows(axes, low, high)),
+    ("radius", lambda: voxels.radius_rows(axes, center, radius)),
+]:
+    runs = 200
+    ms = timeit.timeit(query, number=runs) / runs * 1000
+    print(f"{name:<8}{query().shape[0]:>7}{ms:>9.3f}")
@@ -0,0 +1,55 @@
+# Compares opening a block's voxel data from a VTK image with opening the same data as a
+# csv, and building grids of a few proteins from each. Run from the display app folder,
+# e.g. python ../scripts/bench-vti-source.py assets/HubMAP_TMC_p1_20C_3D_protINT_May8_sorted.vti
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+if os.getcwd() not in sys.path:
+    sys.path.append(os.getcwd())
+from components import volumetric, vti
+from pages.constants import FILE_DESTINATION as FD
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "path",
+    nargs="?",
+    default="assets/HubMAP_TMC_p1_20C_3D_protINT_May8_sorted.vti",
+)
+parser.add_argument("--block", default="P1-20C")
+parser.add_argument("--proteins", type=int, default=7)
+args = parser.parse_args()
+
+vol_measurements = pd.read_csv(
+    f"{FD["volumetric-map"]}/{args.block}/vol_measurements.csv"
+)
+axes = volumetric.make_axes(vol_measurements)
+image = vti.ImageData(args.path)
+names = [n for n in image.cell_arrays if image.components[n] == 1]
+
+# the same voxels, written as a csv with every column of the image
+voxels = volumetric.VolumetricBlock.from_vti(args.path, axes)
+table = pd.DataFrame({name: voxels.column(name) for name in voxels.columns})
+csv_path = os.path.join(tempfile.mkdtemp(), "points_data.csv")
+table.to_csv(csv_path, index=False)
+
+print(f"{len(voxels)} voxels, {len(names)} arrays")
+print(f"{'source':<8}{'MB':>8}{'open ms':>10}{'grids ms':>10}")
+for source, path, open_block in [
+    ("csv", csv_path, volumetric.VolumetricBlock.from_csv),
+    ("vti", args.path, lambda p: volumetric.VolumetricBlock.from_vti(p, axes)),
+]:
+    start = time.perf_counter()
+    block = open_block(path)
+    opened = time.perf_counter()
+    for name in names[: args.proteins]:
+        block.grid(name, axes)
+    done = time.perf_counter()
+    print(
+        f"{source:<8}{os.path.getsize(path) / 2**20:>8.2f}"
+        f"{(opened - start) * 1000:>10.1f}{(done - opened) * 1000:>10.1f}"
+    )